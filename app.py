@@ -1,35 +1,261 @@
-import logging
-from flask import Flask, jsonify, request, render_template
+import time
+# Used by the startup report, which measures how long the app takes to import its modules and load the model
+STARTED = time.perf_counter()
+
+import os
+import sys
+import hmac
+import json
+import functools
+import itertools
+import threading
+from flask import Flask, Response, g, jsonify, request, render_template, send_file, stream_with_context
+import numpy as np
 import pandas as pd
 
+import metrics
+import schema
+import forecast
+import batching
+import log_utils
+import profiling
+import model_store
+import prediction_cache
 from predict import LechePredictor
+from preprocessing import cols_model
 
 
 # create Flask app instance
 app = Flask(__name__)
 app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
 
-# create and train model. This happens once whenever the app is started
+IMPORTED = time.perf_counter()
+
+# load the model. This happens once whenever the app is started
 predictor = LechePredictor()
+LOADED = time.perf_counter()
+
+# predictions of every period covered by the datasets in data/, built by refresh_forecasts
+forecasts = None
+
+# cache of the predictions of input rows already seen, it is cleared whenever the model is reloaded
+cache = prediction_cache.PredictionCache()
+
+# checks of the columnar POST requests, compiled once when the app starts
+input_schema = schema.InputSchema()
+
+# coalesces concurrent single-row predictions into batches, disabled unless BATCH_WINDOW_MS is set
+batcher = batching.PredictionBatcher()
+
+# profiles of the requests that asked to be profiled or were sampled, see profiling.py
+profiles = profiling.ProfileStore()
 
 # Set log configurations, and create logging decorator function
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
-formatter = logging.Formatter(fmt='%(asctime)s:%(levelname)s:%(name)s:%(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-file_handler = logging.FileHandler('logs/app.log')
-file_handler.setFormatter(formatter)
-log.addHandler(file_handler)
+log = log_utils.get_log(__name__, 'logs/app.log')
+logger = log_utils.make_logger(log)
+
+# The admin endpoints are disabled unless ADMIN_TOKEN is set. If MODEL_WATCH_INTERVAL is set, the model
+# store is checked every MODEL_WATCH_INTERVAL seconds and a newly published model version is loaded, and the
+# forecasts are rebuilt if the datasets in data/ have changed.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# Number of rows predicted at a time by the bulk endpoint, unless the request sets chunk_size (up to BULK_MAX_CHUNK_SIZE)
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+BULK_MAX_CHUNK_SIZE = int(os.environ.get('BULK_MAX_CHUNK_SIZE', 10000))
+MODEL_WATCH_INTERVAL = float(os.environ.get('MODEL_WATCH_INTERVAL', 0))
+reload_lock = threading.Lock()
+forecast_lock = threading.Lock()
+# Functions called with the version whenever a new model is loaded, serve.py uses it to have the other worker processes load it too
+reload_callbacks = []
+
+
+@logger
+def reload_predictor():
+    '''This function loads the current version of the model store and swaps it in for the predictor
+    in use. The new predictor is fully loaded before the swap, and requests that are already running
+    keep using the predictor they started with, so no request is dropped.
+
+    Returns:
+        bool: True if a new version was loaded'''
+
+    global predictor
+    with reload_lock:
+        version = model_store.current_version()
+        if version is None or version == predictor.version:
+            return False
+        new_predictor = LechePredictor(version)
+        predictor = new_predictor
+        cache.clear()
+
+    log.info('Reloaded model version %s', version)
+    refresh_forecasts()
+    for callback in reload_callbacks:
+        callback(version)
+    return True
+
+
+@logger
+def refresh_forecasts():
+    '''This function rebuilds the forecast table (see forecast.py) when the model or the datasets
+    it was built from have changed. The new table is swapped in for the old one once it is complete.
+    If it cannot be built, the old table is kept.
+
+    Returns:
+        bool: True if the table was rebuilt'''
+
+    global forecasts
+    with forecast_lock:
+        current_predictor = predictor
+        try:
+            if (forecasts is not None and forecasts.version == current_predictor.version
+                    and forecasts.signature == forecast.data_signature()):
+                return False
+            forecasts = forecast.build(current_predictor)
+        except Exception:
+            log.exception('Could not build the forecasts')
+            return False
+
+    return True
+
+
+def watch_model_store(interval):
+    '''This function runs in a background thread, and reloads the predictor whenever a new
+    model version is published, and the forecasts whenever the datasets change.'''
+
+    while True:
+        time.sleep(interval)
+        try:
+            if not reload_predictor():
+                refresh_forecasts()
+        except Exception:
+            log.exception('Could not reload the model')
+
+
+refresh_forecasts()
+FORECASTS_BUILT = time.perf_counter()
+
+if MODEL_WATCH_INTERVAL > 0:
+    threading.Thread(target=watch_model_store, args=(MODEL_WATCH_INTERVAL,), daemon=True).start()
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.before_request
+def start_profile():
+    '''Profiles the request (see profiling.py) if it has the X-Profile header and the X-Admin-Token
+    header, or if it is sampled (PROFILE_SAMPLE_RATE). Otherwise this only costs a header lookup.
+    The id of the request can be set with the X-Request-Id header.'''
+
+    if (profiling.PROFILE_HEADER in request.headers and is_admin()) or profiling.sampled():
+        g.request_id = profiling.request_id(request.headers.get('X-Request-Id'))
+        try:
+            g.profiler = profiles.start()
+        except ValueError:
+            # another request of this process is already profiled, and only one profiler can run at a time on Python 3.12+
+            pass
+
+
+@app.after_request
+def save_profile(response):
+    '''Saves the profile of a profiled request, and returns its id in the X-Profile-Id header. The
+    profile of a streamed response (bulk_predict) is saved when the stream ends instead, so that it
+    covers the predictions, which are only made while the response is sent.'''
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profile_id = profiles.new_id(g.request_id)
+        response.headers['X-Profile-Id'] = profile_id
+        # the request context is gone when a stream is closed, so the values saved are taken now,
+        # except the number of rows, which is read from g when the profile is saved
+        save = functools.partial(_save_profile, profiler, profile_id, g._get_current_object(), request.endpoint,
+                                 request.method, request.path, response.status_code, predictor.version)
+        if response.is_streamed:
+            response.call_on_close(save)
+        else:
+            save()
 
+    return response
+
+
+def _save_profile(profiler, profile_id, request_globals, endpoint, method, path, status, model_version):
+    try:
+        profiles.save(profiler, request_globals.request_id, profile_id=profile_id, endpoint=endpoint, method=method,
+                      path=path, rows=request_globals.get('rows'), status=status,
+                      seconds=time.perf_counter() - request_globals.start, model_version=model_version)
+        metrics.profiles_total.inc(endpoint)
+    except Exception:
+        log.exception('Could not save the profile of request %s', request_globals.request_id)
+
+
+@app.teardown_request
+def record_request(exception=None):
+    '''Records the latency of every request in the request_seconds histogram, by endpoint.'''
+
+    if request.endpoint is not None and 'start' in g:
+        metrics.request_seconds.observe(time.perf_counter() - g.start, request.endpoint)
+        metrics.requests_total.inc(request.endpoint)
+
+    # the profiler is still running if the request failed before its profile was saved
+    if 'profiler' in g:
+        g.pop('profiler').disable()
+
+
+def is_admin():
+    '''Checks the X-Admin-Token header of the request against ADMIN_TOKEN.'''
+
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
 
-def logger(original_func):
-    '''This function sets up the logger actions. It should be used as a decorator.'''
-    def wrapper(*args, **kwargs):
-        log.info('{} function executed with args: {}, and kwargs: {}'.format(original_func.__name__, args, kwargs))
-        return original_func(*args, **kwargs)
-    return wrapper
 
 @logger
+def predict_with_cache(current_predictor, data_df):
+    '''This function makes the predictions for the input rows like separate_new_data and make_prediction
+    do, but reuses the cached prediction of rows that have already been seen. Only the rows that
+    are not cached go through the preprocessing and the model. If the rows cannot be predicted
+    on their own (see prediction_cache.row_periods), the cache is not used. Single rows that are not
+    cached are predicted together with the rows of other concurrent requests when batching is enabled.
+
+    Parameters:
+        current_predictor: the LechePredictor used for the request
+        data_df: a DataFrame with the raw input rows
+
+    Returns:
+        data: a DataFrame containing the variables after processing, and their associated
+        predictions'''
+
+    with metrics.stage_seconds.time('cache_lookup'):
+        periods = prediction_cache.row_periods(data_df)
+        if periods is not None:
+            keys = cache.make_keys(data_df, current_predictor.version)
+            records = [cache.get(key) for key in keys]
+            misses = [i for i, record in enumerate(records) if record is prediction_cache.MISSING]
+
+    if periods is None:
+        precipitaciones, banco_central = current_predictor.separate_new_data(data_df)
+        return current_predictor.make_prediction(precipitaciones, banco_central)
+
+    if len(misses) == 1 and batcher.enabled:
+        predicted = [batcher.predict_row(current_predictor, data_df.iloc[misses], periods[misses[0]])]
+    elif misses:
+        predicted = current_predictor.predict_rows(data_df.iloc[misses], periods[misses])
+    else:
+        predicted = []
+
+    # rows without valid values have no output (None), this is cached too
+    for i, record in zip(misses, predicted):
+        records[i] = record
+        cache.put(keys[i], record)
+
+    data = pd.DataFrame([record for record in records if record is not None], columns=cols_model + ['prediction'])
+    current_predictor.find_cols_all_na(data[cols_model])
+
+    return data
+
+
 @app.route('/health/')
+@logger
 def health():
     '''This is a very simple check to make sure the app is operational. If
     the response code is 200, the app is functional.'''
@@ -37,8 +263,8 @@ def health():
     return '<h2>Service is operational!</h2>'
 
 
-@logger
 @app.route('/')
+@logger
 def index():
     '''This renders the home page, which contains some information on how
     to use the app.'''
@@ -46,8 +272,8 @@ def index():
     return render_template('index.html')
 
 
-@logger
 @app.route('/get_predict/', methods=['GET'])
+@logger
 def get_predict():
     '''This function creates an endpoint that can be used to make a prediction using a GET request. 
     It outputs a JSON file with the variables and their associated prediction.
@@ -57,42 +283,309 @@ def get_predict():
 
     There is an example link for how this can be used in the home page.'''
 
+    # The same predictor is used for the whole request, even if the model is reloaded meanwhile
+    current_predictor = predictor
+
     try:
-        data_df = pd.DataFrame(dict(request.args), index=[0])
-        predictor.find_missing_cols(data_df)
-        precipitaciones, banco_central = predictor.separate_new_data(data_df)
+        with metrics.stage_seconds.time('parse_query'):
+            data_df = pd.DataFrame(dict(request.args), index=[0])
+        current_predictor.find_missing_cols(data_df)
+        metrics.request_rows.observe(len(data_df), 'get_predict')
+        g.rows = len(data_df)
 
-        return predictor.make_prediction(precipitaciones, banco_central).to_json(orient='records')
+        data = predict_with_cache(current_predictor, data_df)
+        with metrics.stage_seconds.time('to_json'):
+            return data.to_json(orient='records')
     
     except Exception as e:
+        metrics.errors_total.inc('get_predict', type(e).__name__)
 
         return jsonify({'error': str(e)})
 
 
-@logger
 @app.route('/post_predict/', methods=['POST'])
+@logger
 def post_predict():
     '''This function creates an endpoint that can be used to make a series of 
     predictions using a POST request. It outputs a JSON file with the variables 
-    and their associated predictions. To use it, submit a JSON file in the POST request.'''
+    and their associated predictions. To use it, submit a JSON file in the POST request, either
+    in the format of DataFrame.to_json ({"column": {"index": value}}) or in the columnar format
+    ({"column": [values...]}). Columnar requests are checked against input_schema, and every
+    problem found is returned at once in the 'errors' list of the response.'''
+
+    # The same predictor is used for the whole request, even if the model is reloaded meanwhile
+    current_predictor = predictor
 
     try:
         content_type = request.headers.get('Content-Type')
         if content_type != 'application/json':
             return 'Content-Type not supported! Please submit JSON files only.'
 
-        data_json = request.get_json()
-        data_df = pd.DataFrame(data_json)
+        with metrics.stage_seconds.time('parse_json'):
+            data_json = request.get_json()
+            columnar = input_schema.is_columnar(data_json)
+            data_df = input_schema.to_frame(data_json) if columnar else pd.DataFrame(data_json)
 
-        predictor.find_missing_cols(data_df)
-        precipitaciones, banco_central = predictor.separate_new_data(data_df)
+        # columnar requests have already been checked by the schema
+        if not columnar:
+            current_predictor.find_missing_cols(data_df)
+        metrics.request_rows.observe(len(data_df), 'post_predict')
+        g.rows = len(data_df)
     
-        return predictor.make_prediction(precipitaciones, banco_central).to_json(orient='records')
+        data = predict_with_cache(current_predictor, data_df)
+        with metrics.stage_seconds.time('to_json'):
+            return data.to_json(orient='records')
+
+    except schema.SchemaError as e:
+        metrics.errors_total.inc('post_predict', type(e).__name__)
+
+        return jsonify({'error': str(e), 'errors': e.errors})
     
     except Exception as e:
+        metrics.errors_total.inc('post_predict', type(e).__name__)
         
         return jsonify({'error': str(e)})
 
 
+def read_ndjson_chunks(stream, chunk_size):
+    '''This function reads an NDJSON stream (one JSON object per line) and yields DataFrames
+    of up to chunk_size rows, so the whole body is never held in memory.'''
+
+    records = []
+    for line in stream:
+        if line.strip():
+            records.append(json.loads(line))
+        if len(records) == chunk_size:
+            yield pd.DataFrame(records)
+            records = []
+    if records:
+        yield pd.DataFrame(records)
+
+
+@app.route('/bulk_predict/', methods=['POST'])
+@logger
+def bulk_predict():
+    '''This function creates an endpoint for large numbers of predictions. The request body is read
+    as a stream of NDJSON (Content-Type: application/x-ndjson) or CSV (Content-Type: text/csv) rows,
+    and the rows are predicted in chunks of chunk_size rows (a query parameter). The predictions of
+    each chunk are streamed back as NDJSON as soon as the chunk is done, so memory use does not
+    grow with the size of the request.
+
+    Each chunk is processed on its own, so the precipitaciones and banco_central values of a period
+    must be in the same chunk, ideally in the same row. If a chunk fails, a line with the error and
+    the number of the chunk is returned instead of its predictions, and the next chunks are still
+    processed.'''
+
+    current_predictor = predictor
+    content_type = (request.headers.get('Content-Type') or '').split(';')[0].strip()
+
+    try:
+        chunk_size = min(int(request.args.get('chunk_size', BULK_CHUNK_SIZE)), BULK_MAX_CHUNK_SIZE)
+        assert chunk_size > 0, 'chunk_size must be a positive number'
+    except (AssertionError, ValueError) as e:
+        return jsonify({'error': str(e)})
+
+    if content_type in ('application/x-ndjson', 'application/ndjson'):
+        chunks = read_ndjson_chunks(request.stream, chunk_size)
+    elif content_type == 'text/csv':
+        chunks = pd.read_csv(request.stream, chunksize=chunk_size)
+    else:
+        return 'Content-Type not supported! Please submit NDJSON or CSV files only.'
+
+    def generate():
+        for i in itertools.count():
+            try:
+                data_df = next(chunks)
+            except StopIteration:
+                return
+            except Exception as e:
+                # the rest of the body cannot be read
+                metrics.errors_total.inc('bulk_predict', type(e).__name__)
+                yield json.dumps({'error': str(e), 'chunk': i}) + '\n'
+                return
+            g.rows = g.get('rows', 0) + len(data_df)
+
+            try:
+                current_predictor.find_missing_cols(data_df)
+                metrics.request_rows.observe(len(data_df), 'bulk_predict')
+                data = predict_with_cache(current_predictor, data_df)
+                with metrics.stage_seconds.time('to_json'):
+                    lines = data.to_json(orient='records', lines=True).rstrip('\n')
+                if lines:
+                    yield lines + '\n'
+            except Exception as e:
+                metrics.errors_total.inc('bulk_predict', type(e).__name__)
+                yield json.dumps({'error': str(e), 'chunk': i}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def parse_period(text):
+    '''This function converts a 'YYYY-MM' string into a period (year * 12 + month).'''
+
+    year, _, month = text.partition('-')
+    assert year.isdigit() and month.isdigit() and 1 <= int(month) <= 12, \
+        f"'{text}' is not a month in the format YYYY-MM"
+    return int(year) * 12 + int(month)
+
+
+@app.route('/forecast/<int:ano>/<int:mes>/', methods=['GET'])
+@logger
+def forecast_period(ano, mes):
+    '''This function creates an endpoint that returns the prediction of a month (e.g. /forecast/2019/4/)
+    that is covered by the datasets in data/. The predictions of these months are made when the app
+    starts or a new model is loaded, so they are only looked up in an array.'''
+
+    table = forecasts
+    if table is None:
+        return jsonify({'error': 'The forecasts are not available'}), 503
+    if not 1 <= mes <= 12:
+        return jsonify({'error': f'{mes} is not a month'}), 400
+
+    prediction = table.get(ano * 12 + mes)
+    if prediction is None:
+        return jsonify({'error': f'There is no forecast for {ano}-{mes:02d}'}), 404
+
+    return jsonify({'ano': ano, 'mes': mes, 'prediction': prediction, 'model_version': table.version})
+
+
+@app.route('/forecast/', methods=['GET'])
+@logger
+def forecast_range():
+    '''This function creates an endpoint that returns the predictions of every month covered by the
+    datasets in data/ between the start and end parameters (both included, in the format YYYY-MM),
+    e.g. /forecast/?start=2018-01&end=2018-12. Without parameters, every month is returned.'''
+
+    table = forecasts
+    if table is None:
+        return jsonify({'error': 'The forecasts are not available'}), 503
+
+    try:
+        start = parse_period(request.args['start']) if request.args.get('start') else None
+        end = parse_period(request.args['end']) if request.args.get('end') else None
+    except AssertionError as e:
+        return jsonify({'error': str(e)}), 400
+
+    periods, predictions = table.between(start, end)
+    years, months = np.divmod(periods - 1, 12)
+    return jsonify({'model_version': table.version,
+                    'forecasts': [{'ano': year, 'mes': month + 1, 'prediction': prediction}
+                                  for year, month, prediction in zip(years.tolist(), months.tolist(), predictions.tolist())]})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    '''This function creates an endpoint with the latency histograms of every stage of the
+    prediction requests (parsing, checks, preprocessing, merge, model and serialization), the
+    latency of every endpoint, the number of rows per request and the number of errors by
+    type, in the Prometheus text format. Under serve.py, they are those of every worker together.'''
+
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/admin/reload/', methods=['POST'])
+@logger
+def admin_reload():
+    '''This function creates an admin endpoint that loads the current model version without
+    restarting the app. A 'version' parameter can be passed to make an existing version the
+    current one first (e.g. to roll back). The request must include the X-Admin-Token header.'''
+
+    if not is_admin():
+        return jsonify({'error': 'Not authorized'}), 403
+
+    try:
+        if request.args.get('version'):
+            model_store.set_current(request.args['version'])
+        reloaded = reload_predictor()
+
+        return jsonify({'version': predictor.version, 'reloaded': reloaded})
+
+    except Exception as e:
+
+        return jsonify({'error': str(e)})
+
+
+@app.route('/admin/cache/', methods=['GET'])
+@logger
+def admin_cache():
+    '''This function creates an admin endpoint that returns the size and the hit, miss and eviction
+    counters of the prediction cache. Under serve.py, each worker has its own cache, so the counters
+    are those of the worker that handles the request, whose process id is returned as 'pid'. The
+    request must include the X-Admin-Token header.'''
+
+    if not is_admin():
+        return jsonify({'error': 'Not authorized'}), 403
+
+    return jsonify(dict(cache.stats(), pid=os.getpid()))
+
+
+@app.route('/admin/batching/', methods=['GET'])
+@logger
+def admin_batching():
+    '''This function creates an admin endpoint that returns the settings of the micro-batching of
+    single-row predictions, the number of batches of each size and the queueing delay of the rows.
+    Under serve.py, each worker batches its own requests, so these are the statistics of the worker
+    that handles the request, whose process id is returned as 'pid'. The request must include the
+    X-Admin-Token header.'''
+
+    if not is_admin():
+        return jsonify({'error': 'Not authorized'}), 403
+
+    return jsonify(dict(batcher.stats(), pid=os.getpid()))
+
+
+@app.route('/admin/profiles/', methods=['GET'])
+@logger
+def admin_profiles():
+    '''This function creates an admin endpoint that lists the profiles of requests that are kept
+    (see profiling.py), most recent first, with their request id, endpoint, number of input rows and
+    duration. The request must include the X-Admin-Token header.'''
+
+    if not is_admin():
+        return jsonify({'error': 'Not authorized'}), 403
+
+    return jsonify(profiles.list())
+
+
+@app.route('/admin/profiles/<profile_id>/', methods=['GET'])
+@logger
+def admin_profile(profile_id):
+    '''This function creates an admin endpoint that returns the profile of a request as text, with
+    the functions sorted by cumulative time. The sort, limit (number of functions) and filter (a
+    regular expression on the file and function names, e.g. filter=predict|preprocessing) parameters
+    change the report, and format=pstats returns the profile file instead, to open with pstats or
+    snakeviz. The request must include the X-Admin-Token header.'''
+
+    if not is_admin():
+        return jsonify({'error': 'Not authorized'}), 403
+
+    if request.args.get('format') == 'pstats':
+        path = profiles.path(profile_id)
+        if path is None:
+            return jsonify({'error': f'There is no profile {profile_id}'}), 404
+        return send_file(os.path.abspath(path), mimetype='application/octet-stream', as_attachment=True,
+                         download_name=profile_id + '.prof')
+
+    try:
+        report = profiles.report(profile_id, request.args.get('sort', 'cumulative'),
+                                 int(request.args.get('limit', profiling.REPORT_LIMIT)), request.args.get('filter'))
+    except (AssertionError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    if report is None:
+        return jsonify({'error': f'There is no profile {profile_id}'}), 404
+
+    return Response(report, mimetype='text/plain')
+
+
+# Startup report. The app only needs the preprocessing and prediction code, so the training modules should not be
+# imported (unless the model store is empty and the pickled sklearn pipeline is loaded instead).
+startup_report = {'imports_seconds': IMPORTED - STARTED, 'model_load_seconds': LOADED - IMPORTED,
+                  'forecasts_seconds': FORECASTS_BUILT - LOADED, 'total_seconds': time.perf_counter() - STARTED, 'model_version': predictor.version,
+                  'training_modules_loaded': [name for name in ('train', 'sklearn', 'scipy', 'joblib') if name in sys.modules]}
+for phase in ('imports', 'model_load', 'forecasts', 'total'):
+    metrics.startup_seconds.set(startup_report[f'{phase}_seconds'], phase)
+log.info('Startup report: %s', startup_report)
+
+
 if __name__ == '__main__':
     app.run()
\ No newline at end of file
@@ -0,0 +1,160 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+import train
+
+
+# Settings used when no options are given: the number of months predicted from each origin, the number of months
+# the first origin is trained on, and the seed of the random noise added by mutual_info_regression
+HORIZONS = 12
+MIN_TRAIN = 36
+SEED = 0
+
+
+def _label(period):
+    year, month = divmod(int(period) - 1, 12)
+    return f'{year}-{month + 1:02d}'
+
+
+def _values(text):
+    return [float(x) if '.' in x else int(x) for x in text.split(',')]
+
+
+def _backtest_origin(X, y, origin, horizons, window, param_grid, seed):
+    '''Fits every candidate of param_grid on the rows before origin (the last window rows, or all of
+    them when window is 0) and predicts the next horizons rows. The transforms of the training rows
+    are shared between candidates (see train.candidate_predictions).
+
+    Returns:
+        predictions: an array with one row per candidate (in the order of the candidates of
+        backtest) and one column per horizon, NaN after the last row'''
+
+    start = max(0, origin - window) if window else 0
+    test = slice(origin, min(origin + horizons, len(X)))
+
+    blocks = [predictions.T for _, _, predictions in train.candidate_predictions(X[start:origin], y[start:origin], X[test],
+                                                                                  np.random.RandomState(seed + origin), param_grid)]
+    predictions = np.full((sum(len(block) for block in blocks), horizons), np.nan)
+    predictions[:, :test.stop - origin] = np.concatenate(blocks)
+
+    return predictions
+
+
+def backtest(data, horizons=HORIZONS, min_train=MIN_TRAIN, window=0, step=1, param_grid=train.PARAM_GRID, n_jobs=-1, seed=SEED):
+    '''This function evaluates the model month by month with a rolling origin: for every origin (from
+    the min_train-th month on, every step months), the pipeline is fitted on the months before the
+    origin and predicts the next horizons months, for every candidate of param_grid. Origins are run
+    in parallel across processes.
+
+    Parameters:
+        data: Pandas DataFrame of the merged datasets (see train.preprocess)
+        horizons (int): number of months predicted from each origin
+        min_train (int): number of months before the first origin
+        window (int): number of months the pipeline is fitted on, 0 fits it on every month before the origin
+        step (int): number of months between two origins
+        param_grid (dict): the values of selector__k, poly__degree and model__alpha to evaluate
+        n_jobs (int): number of processes, -1 uses all cores
+        seed (int): seed of mutual_info_regression, each origin uses seed + its position
+
+    Returns:
+        report: a dict with the root mean squared, mean absolute and mean absolute percentage
+        errors of each candidate per horizon, and the errors of the best candidate per period'''
+
+    data = data.iloc[np.argsort(train._training_periods(data), kind='stable')].reset_index(drop=True)
+    periods = train._training_periods(data)
+    X = data.drop(['Precio_leche'], axis = 1).to_numpy(dtype=np.float64)
+    y = data['Precio_leche'].to_numpy(dtype=np.float64)
+    assert min_train < len(data), f'There are {len(data)} months, fewer than min_train + 1 ({min_train + 1})'
+
+    candidates = [{'selector__k': k, 'poly__degree': degree, 'model__alpha': alpha}
+                  for k in param_grid['selector__k'] for degree in param_grid['poly__degree'] for alpha in param_grid['model__alpha']]
+    origins = np.arange(min_train, len(data), step)
+
+    predictions = np.stack(Parallel(n_jobs=n_jobs)(delayed(_backtest_origin)(X, y, origin, horizons, window, param_grid, seed)
+                                                   for origin in origins))
+
+    # errors[origin, candidate, horizon], NaN where the target is after the last month
+    targets = origins[:, None] + np.arange(horizons)[None, :]
+    actual = np.where(targets < len(y), y[np.minimum(targets, len(y) - 1)], np.nan)
+    errors = predictions - actual[:, None, :]
+
+    with np.errstate(invalid='ignore'):
+        rmse = np.sqrt(np.nanmean(errors ** 2, axis=0))
+        mae = np.nanmean(np.abs(errors), axis=0)
+        mape = 100 * np.nanmean(np.abs(errors) / np.abs(actual)[:, None, :], axis=0)
+        overall = np.sqrt(np.nanmean(errors ** 2, axis=(0, 2)))
+    best = int(np.nanargmin(overall))
+
+    # errors of the best candidate by target month and horizon
+    by_period = np.full((len(data), horizons), np.nan)
+    valid = targets < len(y)
+    by_period[targets[valid], np.nonzero(valid)[1]] = errors[:, best, :][valid]
+    first_target = origins[0]
+
+    return {'months': len(data), 'first_month': _label(periods[0]), 'last_month': _label(periods[-1]),
+            'origins': len(origins), 'horizons': horizons, 'min_train': min_train, 'window': window, 'step': step,
+            'rows_per_horizon': np.sum(valid, axis=0).tolist(),
+            'candidates': [{'params': params, 'rmse': overall[i].item(), 'rmse_by_horizon': rmse[i].tolist(),
+                            'mae_by_horizon': mae[i].tolist(), 'mape_by_horizon': mape[i].tolist()}
+                           for i, params in enumerate(candidates)],
+            'best': candidates[best],
+            'periods': [{'month': _label(periods[j]), 'actual': y[j].item(),
+                         'errors_by_horizon': [None if np.isnan(error) else error.item() for error in by_period[j]]}
+                        for j in range(first_target, len(data))]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward backtest of the milk price model: refit at every origin and '
+                                                 'report the errors by horizon and by month.')
+    parser.add_argument('--horizons', type=int, default=HORIZONS, help='number of months predicted from each origin')
+    parser.add_argument('--min-train', type=int, default=MIN_TRAIN, help='number of months before the first origin')
+    parser.add_argument('--window', type=int, default=0,
+                        help='fit on the last WINDOW months before each origin instead of on all of them')
+    parser.add_argument('--step', type=int, default=1, help='number of months between two origins')
+    parser.add_argument('--k', type=_values, default=train.PARAM_GRID['selector__k'], help='comma separated values of selector__k')
+    parser.add_argument('--degree', type=_values, default=train.PARAM_GRID['poly__degree'], help='comma separated values of poly__degree')
+    parser.add_argument('--alpha', type=_values, default=train.PARAM_GRID['model__alpha'], help='comma separated values of model__alpha')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='number of processes running the origins')
+    parser.add_argument('--seed', type=int, default=SEED, help='seed of mutual_info_regression')
+    parser.add_argument('--data-dir', help='directory with precipitaciones.csv, banco_central.csv and precio_leche.csv '
+                                           '(e.g. written by python -m benchmark --data-dir), defaults to data/')
+    parser.add_argument('--top', type=int, default=10, help='number of candidates printed')
+    parser.add_argument('--output', default='backtest_results.json', help='path of the JSON report')
+    args = parser.parse_args()
+
+    if args.data_dir:
+        data = train.preprocess(*[pd.read_csv(os.path.join(args.data_dir, f'{name}.csv'))
+                                  for name in ('precipitaciones', 'banco_central', 'precio_leche')])
+    else:
+        data = train.load_preprocessed()
+
+    start = time.perf_counter()
+    report = backtest(data, horizons=args.horizons, min_train=args.min_train, window=args.window, step=args.step,
+                      param_grid={'selector__k': args.k, 'poly__degree': args.degree, 'model__alpha': args.alpha},
+                      n_jobs=args.n_jobs, seed=args.seed)
+    report['seconds'] = time.perf_counter() - start
+    report['created'] = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{report['origins']} origins from {report['months']} months ({report['first_month']} to {report['last_month']}), "
+          f"{len(report['candidates'])} candidates, {report['seconds']:.1f} s")
+    shown = [h for h in (1, 3, 6, 12, 24) if h <= args.horizons]
+    print(f"{'k':>3} {'degree':>6} {'alpha':>6} {'RMSE':>9}  " + ' '.join(f'{"RMSE h=" + str(h):>10}' for h in shown))
+    for candidate in sorted(report['candidates'], key=lambda candidate: candidate['rmse'])[:args.top]:
+        params = candidate['params']
+        print(f"{params['selector__k']:>3} {params['poly__degree']:>6} {params['model__alpha']:>6} {candidate['rmse']:9.3f}  "
+              + ' '.join(f"{candidate['rmse_by_horizon'][h - 1]:10.3f}" for h in shown))
+
+    print('errors of the best candidate by month (horizon 1):')
+    for row in report['periods'][-args.top:]:
+        print(f"{row['month']}  actual {row['actual']:8.2f}  error {row['errors_by_horizon'][0]:8.2f}")
+
+    sys.exit(0)
@@ -0,0 +1,163 @@
+import os
+import time
+import threading
+import collections
+import pandas as pd
+
+
+# Micro-batching settings, these can be overridden with environment variables when the service is deployed.
+# Single-row predictions that arrive within BATCH_WINDOW_MS milliseconds of each other are predicted together,
+# up to BATCH_MAX_SIZE rows at a time. A window of 0 disables batching.
+BATCH_WINDOW_MS = float(os.environ.get('BATCH_WINDOW_MS', 0))
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 32))
+
+
+class _Batch:
+    '''The rows waiting to be predicted together, and the results handed back to their callers.'''
+
+    def __init__(self, predictor, deadline):
+        self.predictor = predictor
+        self.deadline = deadline
+        self.rows, self.periods, self.enqueued = [], [], []
+        self.closed = False
+        self.results = None
+        self.done = threading.Event()
+
+
+class PredictionBatcher:
+    '''This class coalesces concurrent single-row predictions into batches, so that many requests
+    share one pass of the preprocessing and of the model instead of paying its fixed cost each.
+
+    The first row of a batch waits up to window seconds (or until the batch has max_size rows) and
+    then predicts the whole batch from its own thread, the other callers wait for their result.
+    Rows are only batched with rows of the same model, columns and dtypes, and never with a row of
+    the same period, so that each row is predicted exactly as it would be on its own.
+
+    Attributes:
+        window: number of seconds the first row of a batch waits for other rows
+        max_size: maximum number of rows in a batch
+        batches, rows, fallbacks: counters of batches run, rows predicted, and batches that failed
+        and were predicted row by row
+
+    Methods:
+        enabled: True if rows are batched
+        predict_row: predicts one row, together with the rows of other concurrent calls
+        stats: returns the batch size and queueing delay metrics
+    '''
+
+    def __init__(self, window_ms=BATCH_WINDOW_MS, max_size=BATCH_MAX_SIZE):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.batches = self.rows = self.fallbacks = 0
+        self._batch_sizes = collections.Counter()
+        self._queue_delay_total = self._queue_delay_max = 0.0
+        self._open = {}
+        self._cond = threading.Condition()
+
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_size > 1
+
+
+    def predict_row(self, predictor, row, period):
+        '''This function predicts a single input row. The call blocks until the batch the row was
+        added to has been predicted.
+
+        Parameters:
+            predictor: the LechePredictor used for the request
+            row: a DataFrame with one raw input row
+            period: the period (year * 12 + month) of the row, see prediction_cache.row_periods
+
+        Returns:
+            record: a dict of the processed variables and prediction of the row, or None if the
+            row has no valid values'''
+
+        key = (id(predictor), tuple(row.columns), tuple(row.dtypes))
+
+        with self._cond:
+            batch = next((batch for batch in self._open.get(key, []) if period not in batch.periods), None)
+            leader = batch is None
+            if leader:
+                batch = _Batch(predictor, time.monotonic() + self.window)
+                self._open.setdefault(key, []).append(batch)
+
+            index = len(batch.rows)
+            batch.rows.append(row)
+            batch.periods.append(period)
+            batch.enqueued.append(time.monotonic())
+            if len(batch.rows) >= self.max_size:
+                self._close(key, batch)
+
+            # the first caller of the batch waits for the other rows and then predicts all of them
+            while leader and not batch.closed:
+                remaining = batch.deadline - time.monotonic()
+                if remaining <= 0:
+                    self._close(key, batch)
+                else:
+                    self._cond.wait(remaining)
+
+        if leader:
+            self._run(batch)
+        else:
+            batch.done.wait()
+
+        result = batch.results[index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def _close(self, key, batch):
+        '''Stops adding rows to a batch and wakes up its leader. Must be called holding self._cond.'''
+
+        batch.closed = True
+        self._open[key].remove(batch)
+        if not self._open[key]:
+            del self._open[key]
+        self._cond.notify_all()
+
+
+    def _run(self, batch):
+        '''Predicts the rows of a batch and hands out the results. If the batch fails (e.g. because
+        one row has a badly formatted value), the rows are predicted one by one, so that each
+        caller gets the same result or error it would get without batching.'''
+
+        start = time.monotonic()
+        results = [RuntimeError('The batch was not predicted')] * len(batch.rows)
+        fallback = False
+        try:
+            results = batch.predictor.predict_rows(pd.concat(batch.rows, ignore_index=True), batch.periods)
+        except Exception:
+            fallback = True
+            results = []
+            for row, period in zip(batch.rows, batch.periods):
+                try:
+                    results.extend(batch.predictor.predict_rows(row, [period]))
+                except Exception as e:
+                    results.append(e)
+        finally:
+            batch.results = results
+            batch.done.set()
+
+            delays = [start - enqueued for enqueued in batch.enqueued]
+            with self._cond:
+                self.batches += 1
+                self.rows += len(batch.rows)
+                self.fallbacks += fallback
+                self._batch_sizes[len(batch.rows)] += 1
+                self._queue_delay_total += sum(delays)
+                self._queue_delay_max = max(self._queue_delay_max, max(delays))
+
+
+    def stats(self):
+        '''Returns a dict with the settings of the batcher, the number of batches of each size,
+        and the mean and maximum time rows waited before their batch was predicted.'''
+
+        with self._cond:
+            return {'enabled': self.enabled, 'window_ms': self.window * 1000, 'max_size': self.max_size,
+                    'batches': self.batches, 'rows': self.rows, 'fallbacks': self.fallbacks,
+                    'mean_batch_size': self.rows / self.batches if self.batches else 0.0,
+                    'batch_sizes': {str(size): count for size, count in sorted(self._batch_sizes.items())},
+                    'mean_queue_delay_ms': 1000 * self._queue_delay_total / self.rows if self.rows else 0.0,
+                    'max_queue_delay_ms': 1000 * self._queue_delay_max}
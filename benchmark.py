@@ -0,0 +1,411 @@
+import os
+import gc
+import sys
+import json
+import time
+import socket
+import subprocess
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import threading
+import http.client
+import urllib.parse
+import numpy as np
+import pandas as pd
+
+import train
+from predict import LechePredictor
+from preprocessing import cols_precipitaciones, cols_banco_central
+
+
+# Sizes used when no options are given. Prediction batches use up to MAX_MONTHS distinct months, since
+# pandas timestamps only go up to the year 2262; larger batches repeat months in the precipitaciones data.
+BATCH_SIZES = [1, 10, 100, 1000, 10000, 100000]
+HTTP_BATCH_SIZES = [1, 100, 1000]
+TRAIN_MONTHS = 500
+MAX_MONTHS = 3600
+FIRST_YEAR = 1900
+# A result is a regression when its median time is more than TOLERANCE times slower than the baseline
+TOLERANCE = 0.25
+# Maximum time in seconds to import the app (imports and model loading), and modules the app must not import
+STARTUP_BUDGET = 1.0
+TRAINING_MODULES = ['train', 'sklearn', 'scipy', 'joblib']
+# Number of concurrent clients and seconds of load of the serving benchmarks
+SERVE_CONCURRENCY = 16
+SERVE_DURATION = 10.0
+
+# Run in a new interpreter by bench_startup, prints the startup report of the app as JSON
+STARTUP_SCRIPT = '''
+import json, time
+start = time.perf_counter()
+import app
+print(json.dumps(dict(app.startup_report, import_seconds=time.perf_counter() - start)))
+'''
+
+MESES = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
+
+
+def _dotted(values):
+    '''Formats positive numbers like the banco_central dataset does: 9 significant digits
+    with a '.' every 3 digits, e.g. 101.421423 -> '101.421.423' and 92.5256728 -> '925.256.728'.'''
+
+    exponents = np.floor(np.log10(values))
+    digits = np.minimum(np.round(values * 10.0 ** (8 - exponents)), 999999999).astype(np.int64)
+
+    return ['{:,}'.format(n).replace(',', '.') for n in digits]
+
+
+def generate_data(n_months, n_rows=None, seed=0):
+    '''This function generates synthetic precipitaciones, banco_central and precio_leche datasets
+    with the same columns and formats as the files in data/ (dates, dotted-number strings and
+    Spanish month names), so they go through the same preprocessing as the real data.
+
+    Parameters:
+        n_months (int): number of distinct months, starting in January of FIRST_YEAR
+        n_rows (int): number of precipitaciones rows, the months are repeated when n_rows is
+        larger than n_months. Defaults to n_months
+        seed (int): seed of the random values
+
+    Returns:
+        precipitaciones: DataFrame like data/precipitaciones.csv
+        banco_central: DataFrame like data/banco_central.csv, one row per month
+        precio_leche: DataFrame like data/precio_leche.csv, one row per month'''
+
+    rng = np.random.default_rng(seed)
+    n_rows = n_months if n_rows is None else n_rows
+    periods = np.arange(n_months)
+    years, months = FIRST_YEAR + periods // 12, periods % 12 + 1
+    dates = ['{:04d}-{:02d}-01'.format(year, month) for year, month in zip(years, months)]
+
+    rows = np.arange(n_rows) % n_months
+    precipitaciones = pd.DataFrame({'date': [dates[i] for i in rows]})
+    for col in cols_precipitaciones[1:]:
+        precipitaciones[col] = rng.gamma(0.5, 40.0, n_rows) * (rng.random(n_rows) > 0.1)
+
+    # Imacec and IVCM values are indices around 100, the other values are large integers
+    banco_central = {'Periodo': [date + ' 00:00:00 UTC' for date in dates]}
+    for col in cols_banco_central[1:]:
+        if 'Imacec' in col or 'IVCM' in col:
+            banco_central[col] = _dotted(rng.uniform(60.0, 140.0, n_months))
+        else:
+            banco_central[col] = _dotted(rng.uniform(1e6, 1e9, n_months))
+    banco_central = pd.DataFrame(banco_central)
+
+    # The price depends on a few of the variables, so that training finds a model like with the real data
+    imacec = train.to_100_column(banco_central['Imacec_empalmado'])
+    precio = 50 + 0.02 * periods + 0.5 * imacec.to_numpy() + rng.normal(0, 2, n_months)
+    precio_leche = pd.DataFrame({'Anio': years, 'Mes': [MESES[month - 1] for month in months], 'Precio_leche': precio.round(2)})
+
+    return precipitaciones, banco_central, precio_leche
+
+
+def write_data(directory, n_months, seed=0):
+    '''This function writes the synthetic datasets of generate_data as CSV files in directory,
+    with the same names as in data/ (precio_leche.csv uses CRLF line endings, like the original).
+
+    Returns:
+        files: a dict in the format of train.DATA_FILES'''
+
+    os.makedirs(directory, exist_ok=True)
+    precipitaciones, banco_central, precio_leche = generate_data(n_months, seed=seed)
+    files = {name: os.path.join(directory, name + '.csv') for name in train.DATA_FILES}
+
+    precipitaciones.to_csv(files['precipitaciones'], index=False)
+    banco_central.to_csv(files['banco_central'], index=False)
+    precio_leche.to_csv(files['precio_leche'], index=False, lineterminator='\r\n')
+
+    return files
+
+
+def measure(func, setup=None, repeat=5):
+    '''This function times func, calling setup (not timed) before every run to create its arguments.
+
+    Returns:
+        dict: the median, minimum and mean time in seconds, and the number of runs'''
+
+    times = []
+    for _ in range(repeat):
+        args = (setup() if setup is not None else None) or ()
+        gc.collect()
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+
+    return {'median': statistics.median(times), 'min': min(times), 'mean': statistics.mean(times), 'repeat': repeat}
+
+
+def bench_train(files, repeat, n_jobs):
+    '''Times train.load_data, train.preprocess, train.load_banco_central, train.train_model and
+    train.update_model on the synthetic datasets.'''
+
+    data_files = dict(train.DATA_FILES)
+    train.DATA_FILES.update(files)
+    try:
+        raw = train.load_data()
+        data = train.preprocess(*[frame.copy() for frame in raw])
+        n_rows = len(data)
+
+        # the incremental update adds the last month to a model trained on the other months
+        X, y, periods = data.drop(['Precio_leche'], axis=1), data['Precio_leche'], train._training_periods(data)
+        new = periods == periods.max()
+        model = train.train_model(data[~new], n_jobs=n_jobs)
+        state = train.training_state(model, X[~new], y[~new], periods[~new])
+
+        return {'train.load_data': dict(measure(train.load_data, repeat=repeat), rows=n_rows),
+                'train.preprocess': dict(measure(train.preprocess, lambda: [frame.copy() for frame in raw], repeat), rows=n_rows),
+                'train.load_banco_central': dict(measure(train.load_banco_central, repeat=repeat), rows=n_rows),
+                'train.train_model': dict(measure(lambda: train.train_model(data, n_jobs=n_jobs), repeat=max(1, repeat // 2)), rows=n_rows),
+                'train.update_model': dict(measure(lambda: train.update_model(model, state, X[new], y[new], periods[new], X, y),
+                                                   repeat=repeat), rows=int(new.sum()))}
+    finally:
+        train.DATA_FILES.clear()
+        train.DATA_FILES.update(data_files)
+
+
+def bench_predict(batch_sizes, repeat):
+    '''Times LechePredictor.make_prediction for each batch size.'''
+
+    predictor = LechePredictor()
+    results = {}
+    for size in batch_sizes:
+        precipitaciones, banco_central, _ = generate_data(min(size, MAX_MONTHS), n_rows=size, seed=size)
+        setup = lambda: (precipitaciones.copy(), banco_central.copy())
+        results[f'make_prediction[{size}]'] = dict(measure(predictor.make_prediction, setup, repeat), rows=size)
+
+    return results
+
+
+def bench_http(batch_sizes, repeat):
+    '''Times the /get_predict/ and /post_predict/ endpoints (with rows and with columnar JSON) through
+    the Flask test client. The prediction cache is cleared before every request, so that the model runs every time.'''
+
+    import app as app_module
+    client = app_module.app.test_client()
+    results = {}
+
+    def check(response):
+        # a benchmark of the error path would be meaningless
+        assert b'"error"' not in response.data[:200], response.get_data(as_text=True)[:200]
+
+    precipitaciones, banco_central, _ = generate_data(1)
+    query = {col: str(value) for col, value in pd.concat([precipitaciones, banco_central], axis=1).iloc[0].items()}
+    check(client.get('/get_predict/', query_string=query))
+    results['GET /get_predict/'] = dict(measure(lambda: client.get('/get_predict/', query_string=query),
+                                                app_module.cache.clear, repeat * 10), rows=1)
+
+    for size in batch_sizes:
+        # one row per month with both datasets in the same row, like the bulk endpoint expects
+        precipitaciones, banco_central, _ = generate_data(min(size, MAX_MONTHS), n_rows=size, seed=size)
+        banco_central = banco_central.iloc[np.arange(size) % len(banco_central)].reset_index(drop=True)
+        payload = json.loads(pd.concat([precipitaciones, banco_central], axis=1).to_json())
+        check(client.post('/post_predict/', json=payload))
+        results[f'POST /post_predict/[{size}]'] = dict(measure(lambda: client.post('/post_predict/', json=payload),
+                                                               app_module.cache.clear, repeat), rows=size)
+
+        columnar = {col: list(values.values()) for col, values in payload.items()}
+        check(client.post('/post_predict/', json=columnar))
+        results[f'POST /post_predict/ columnar[{size}]'] = dict(measure(lambda: client.post('/post_predict/', json=columnar),
+                                                                        app_module.cache.clear, repeat), rows=size)
+
+    return results
+
+
+def bench_startup(repeat):
+    '''Times a cold import of the app in new interpreters, and finds the modules that take the
+    longest to import with python -X importtime.
+
+    Returns:
+        results: a dict with the import time of the app
+        report: the startup report of the app (see app.py) and the slowest modules to import'''
+
+    runs = [json.loads(subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, text=True, check=True).stdout.splitlines()[-1])
+            for _ in range(repeat)]
+    times = [run['import_seconds'] for run in runs]
+
+    # each line of -X importtime is 'import time: self [us] | cumulative | module'
+    importtime = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in importtime.splitlines()[1:]:
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            modules.append((int(parts[1]) / 1e6, parts[2].strip()))
+    # only top level packages, their submodules are included in their cumulative time
+    slowest = sorted(((seconds, name) for seconds, name in modules if '.' not in name and name != 'app'), reverse=True)[:10]
+
+    report = dict(runs[-1], slowest_imports={name: seconds for seconds, name in slowest})
+    results = {'startup.import_app': {'median': statistics.median(times), 'min': min(times), 'mean': statistics.mean(times),
+                                      'repeat': repeat, 'rows': 1}}
+    return results, report
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _load(port, path, concurrency, duration):
+    '''This function sends GET requests to path from concurrency client threads for duration seconds,
+    each on a new connection, and returns the latency of every successful request and the number of failures.'''
+
+    latencies, failures = [], []
+    deadline = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+                connection.close()
+                assert response.status == 200 and b'"error"' not in body[:200]
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                failures.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, len(failures)
+
+
+def bench_serve(concurrency, duration, workers=None):
+    '''Measures the throughput of /get_predict/ under concurrency concurrent clients, for the Flask
+    development server (python -m flask run, as in the Dockerfile before serve.py) and for the
+    multi-process server of serve.py. The prediction cache is disabled, so that the model runs for every request.
+
+    Returns:
+        results: a dict with the latencies and the number of requests per second of each server'''
+
+    precipitaciones, banco_central, _ = generate_data(1)
+    query = {col: str(value) for col, value in pd.concat([precipitaciones, banco_central], axis=1).iloc[0].items()}
+    path = '/get_predict/?' + urllib.parse.urlencode(query)
+
+    workers = workers or len(os.sched_getaffinity(0))
+    servers = {'serve.flask_dev_server': ([sys.executable, '-m', 'flask', 'run', '--port', '{port}'], {}),
+               f'serve.prefork[{workers}]': ([sys.executable, '-m', 'serve'], {'SERVE_WORKERS': str(workers)})}
+
+    results = {}
+    for name, (command, env) in servers.items():
+        port = _free_port()
+        env = dict(os.environ, PREDICTION_CACHE_SIZE='0', SERVE_HOST='127.0.0.1', SERVE_PORT=str(port), **env)
+        process = subprocess.Popen([arg.format(port=port) for arg in command], env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # waits for the server to answer
+            for _ in range(300):
+                try:
+                    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+                    connection.request('GET', '/health/')
+                    connection.getresponse().read()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            _load(port, path, concurrency, min(duration, 1.0))
+
+            latencies, failures = _load(port, path, concurrency, duration)
+            results[name] = {'median': statistics.median(latencies), 'min': min(latencies), 'mean': statistics.mean(latencies),
+                             'repeat': len(latencies), 'rows': 1, 'requests_per_second': len(latencies) / duration,
+                             'failures': failures, 'concurrency': concurrency}
+        finally:
+            process.terminate()
+            process.wait(timeout=60)
+
+    return results
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    '''This function compares the median times of results against a baseline.
+
+    Returns:
+        list: one (name, baseline median, new median, ratio, regression) tuple per benchmark in both'''
+
+    rows = []
+    for name, result in results['results'].items():
+        if name in baseline['results']:
+            ratio = result['median'] / baseline['results'][name]['median']
+            rows.append((name, baseline['results'][name]['median'], result['median'], ratio, ratio > 1 + tolerance))
+
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark training, predictions and the HTTP endpoints on synthetic data.')
+    parser.add_argument('--months', type=int, default=TRAIN_MONTHS, help='number of months of the synthetic training data')
+    parser.add_argument('--batch-sizes', type=lambda s: [int(x) for x in s.split(',')], default=BATCH_SIZES,
+                        help='comma separated batch sizes for make_prediction')
+    parser.add_argument('--http-batch-sizes', type=lambda s: [int(x) for x in s.split(',')], default=HTTP_BATCH_SIZES,
+                        help='comma separated batch sizes for /post_predict/')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs of each benchmark')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='number of processes used by train_model')
+    parser.add_argument('--only', nargs='+', choices=['train', 'predict', 'http', 'startup', 'serve'],
+                        default=['train', 'predict', 'http', 'startup', 'serve'],
+                        help='run only some groups of benchmarks')
+    parser.add_argument('--startup-budget', type=float, default=STARTUP_BUDGET,
+                        help='maximum time in seconds to import the app and load the model')
+    parser.add_argument('--concurrency', type=int, default=SERVE_CONCURRENCY, help='number of concurrent clients of the serving benchmarks')
+    parser.add_argument('--duration', type=float, default=SERVE_DURATION, help='seconds of load of each serving benchmark')
+    parser.add_argument('--workers', type=int, help='number of workers of serve.py, defaults to the number of available cores')
+    parser.add_argument('--data-dir', help='write the synthetic datasets to this directory and keep them')
+    parser.add_argument('--output', default='benchmark_results.json', help='path of the JSON results')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed slowdown before a result is a regression')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp()
+    results = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': sys.version.split()[0], 'platform': platform.platform(),
+               'cpu_count': os.cpu_count(), 'settings': {key: value for key, value in vars(args).items() if key != 'baseline'},
+               'results': {}}
+    try:
+        if 'train' in args.only:
+            results['results'].update(bench_train(write_data(data_dir, args.months), args.repeat, args.n_jobs))
+        if 'predict' in args.only:
+            results['results'].update(bench_predict(args.batch_sizes, args.repeat))
+        if 'http' in args.only:
+            results['results'].update(bench_http(args.http_batch_sizes, args.repeat))
+        if 'startup' in args.only:
+            startup_results, results['startup_report'] = bench_startup(args.repeat)
+            results['results'].update(startup_results)
+        if 'serve' in args.only:
+            results['results'].update(bench_serve(args.concurrency, args.duration, args.workers))
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    for name, result in results['results'].items():
+        if 'requests_per_second' in result:
+            print(f"{name:<32} median {result['median'] * 1000:10.2f} ms   {result['requests_per_second']:12.0f} requests/s "
+                  f"({result['concurrency']} clients, {result['failures']} failures)")
+        else:
+            print(f"{name:<32} median {result['median'] * 1000:10.2f} ms   {result['rows'] / result['median']:12.0f} rows/s")
+
+    failed = False
+    if 'startup_report' in results:
+        report = results['startup_report']
+        print('startup report:', json.dumps(report, indent=2))
+        if results['results']['startup.import_app']['median'] > args.startup_budget:
+            print(f"OVER BUDGET startup.import_app: {results['results']['startup.import_app']['median']:.3f} s > {args.startup_budget} s")
+            failed = True
+        if report['training_modules_loaded'] and not report['model_version'].startswith('pkl-'):
+            print('The app imported training modules:', report['training_modules_loaded'])
+            failed = True
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = [row for row in compare(results, json.load(f), args.tolerance) if row[4]]
+        for name, before, after, ratio, _ in regressions:
+            print(f'REGRESSION {name}: {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({ratio:.2f}x)')
+        failed = failed or bool(regressions)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,114 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+
+import log_utils
+import preprocessing
+
+
+# Datasets the forecasts are computed from
+FORECAST_FILES = ['precipitaciones', 'banco_central']
+
+# Set log configurations, and create logging decorator function
+log = log_utils.get_log(__name__, 'logs/forecast.log')
+logger = log_utils.make_logger(log)
+
+
+class ForecastTable:
+    '''This class holds the predictions of every period (year * 12 + month) that can be built from
+    the stored datasets, in an array indexed by period, so that a forecast is looked up without
+    running the pipeline. A table is never modified after it is built: a new table is built when
+    the model or the data change, and swapped in for the old one.
+
+    Attributes:
+        first_period: the period of the first value of the array
+        values: a float64 array with the prediction of each period from first_period on, NaN for
+        the periods without a prediction
+        version: the model version the predictions were made with
+        signature: the size and modification time of the data files the predictions were made from
+        built: the time the table was built (seconds since the epoch)
+
+    Methods:
+        get: returns the prediction of one period
+        between: returns the periods with a prediction within a range, and their predictions
+        stats: returns the size and range of the table
+    '''
+
+    def __init__(self, periods, predictions, version, signature):
+        periods = np.asarray(periods, dtype=np.int64)
+        self.first_period = int(periods.min()) if len(periods) else 0
+        self.values = np.full(int(periods.max()) - self.first_period + 1 if len(periods) else 0, np.nan)
+        # if a period appears more than once, its first prediction is kept
+        self.values[periods[::-1] - self.first_period] = np.asarray(predictions, dtype=np.float64)[::-1]
+        self.version = version
+        self.signature = signature
+        self.built = time.time()
+
+
+    def get(self, period):
+        '''Returns the prediction of a period (year * 12 + month), or None if there is none.'''
+
+        index = period - self.first_period
+        if 0 <= index < len(self.values) and not np.isnan(self.values[index]):
+            return float(self.values[index])
+        return None
+
+
+    def between(self, start=None, end=None):
+        '''Returns the periods from start to end (both included) that have a prediction, as a numpy
+        array, and their predictions. start and end default to the first and last periods of the table.'''
+
+        start = self.first_period if start is None else max(start, self.first_period)
+        end = self.first_period + len(self.values) - 1 if end is None else end
+        values = self.values[start - self.first_period:max(end - self.first_period + 1, 0)]
+        known = np.flatnonzero(~np.isnan(values))
+
+        return known + start, values[known]
+
+
+    def stats(self):
+        '''Returns a dict with the number of periods in the table, its range and its model version.'''
+
+        periods, _ = self.between()
+        return {'periods': len(periods), 'first': _label(periods[0]) if len(periods) else None,
+                'last': _label(periods[-1]) if len(periods) else None, 'model_version': self.version,
+                'built': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.built))}
+
+
+def _label(period):
+    year, month = divmod(int(period) - 1, 12)
+    return f'{year}-{month + 1:02d}'
+
+
+def data_signature(files=None):
+    '''This function returns the size and modification time of the datasets the forecasts are made
+    from, which changes whenever they are modified.'''
+
+    files = files or preprocessing.DATA_FILES
+    return tuple((os.path.getsize(files[name]), os.path.getmtime(files[name])) for name in FORECAST_FILES)
+
+
+@logger
+def build(predictor, files=None):
+    '''This function predicts every period covered by both the precipitaciones and the banco_central
+    datasets, with the same preprocessing as the prediction requests.
+
+    Parameters:
+        predictor: the LechePredictor making the predictions
+        files (dict): the paths of the datasets, defaults to preprocessing.DATA_FILES
+
+    Returns:
+        table: a ForecastTable with the predictions'''
+
+    files = files or preprocessing.DATA_FILES
+    signature = data_signature(files)
+
+    precipitaciones = preprocessing.prep_precipitaciones(pd.read_csv(files['precipitaciones']))
+    banco_central = preprocessing.load_banco_central(files['banco_central'])
+    data = predictor.merge_new_data(precipitaciones, banco_central).dropna()
+    predictions = predictor.predict_array(data.to_numpy(dtype=np.float64))
+
+    table = ForecastTable(data['ano'] * 12 + data['mes'], predictions, predictor.version, signature)
+    log.info('Built the forecasts of model version %s: %s', predictor.version, table.stats())
+    return table
@@ -0,0 +1,254 @@
+import os
+import queue
+import pickle
+import socket
+import hashlib
+import atexit
+import threading
+import collections
+import logging
+import functools
+import itertools
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+import pandas as pd
+
+
+# Log settings, these can be overridden with environment variables when the service is deployed.
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 5 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 3))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# If set, the log files are written to this directory instead of the directory of the paths given to get_log
+# (the tests use it to keep the files in logs/ as they are)
+LOG_DIR = os.environ.get('LOG_DIR')
+# Summarizing the arguments of a call costs tens of microseconds (milliseconds for a DataFrame, whose values are all
+# hashed), more than some of the logged functions take, so by default one call out of LOG_SAMPLE_EVERY is logged
+# (the first call is always logged)
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', 100))
+# Largest record a forked process can send to the process that writes the log files (see receive_from_forks)
+MAX_RECORD_BYTES = 64 * 1024
+
+MAX_STR_LEN = 80
+
+formatter = logging.Formatter(fmt='%(asctime)s:%(levelname)s:%(name)s:%(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+_listeners = []
+_handlers = []
+_paths = []
+# Set by receive_from_forks: the socket pair between the forked processes and this one, and the thread receiving
+_sender = None
+_receiver = None
+_forwarding = False
+
+
+class DroppingQueueHandler(QueueHandler):
+    '''This handler puts log records on a bounded queue and drops them when the queue is
+    full, so that a slow log disk never blocks the caller.
+
+    Attributes:
+        dropped: number of records dropped because the queue was full'''
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ForwardingHandler(logging.Handler):
+    '''This handler sends the log records of a forked process (e.g. a worker of serve.py) to the
+    process that writes the log files (see receive_from_forks), one datagram per record. Records
+    that cannot be sent are dropped.'''
+
+    def __init__(self, sock, path):
+        super().__init__()
+        self.sock, self.path = sock, path
+
+    def emit(self, record):
+        try:
+            self.sock.send(pickle.dumps((self.path, record.__dict__)))
+        except OSError:
+            # the record is larger than MAX_RECORD_BYTES, or the writing process is gone
+            pass
+
+
+def get_log(name, path):
+    '''This function sets up a logger that writes to a size-rotated file from a background
+    thread. The calling thread only formats the message and puts it on a queue.
+
+    Parameters:
+        name (str): name of the logger, usually the __name__ of the module using it
+        path (str): path of the log file, in LOG_DIR if it is set
+
+    Returns:
+        log: a logging.Logger ready to be used'''
+
+    if LOG_DIR:
+        path = os.path.join(LOG_DIR, os.path.basename(path))
+    log = logging.getLogger(name)
+    log.setLevel(logging.INFO)
+
+    if not any(isinstance(handler, DroppingQueueHandler) for handler in log.handlers):
+        if _forwarding:
+            writer = ForwardingHandler(_sender, path)
+        else:
+            writer = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+            writer.setFormatter(formatter)
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        handler = DroppingQueueHandler(log_queue)
+        log.addHandler(handler)
+
+        listener = QueueListener(log_queue, writer)
+        listener.start()
+        _listeners.append(listener)
+        _handlers.append(handler)
+        _paths.append(path)
+
+    return log
+
+
+@atexit.register
+def stop_listeners():
+    '''This function flushes every queued record to disk and stops the background writers.
+    It runs automatically when the interpreter exits.'''
+
+    global _receiver
+    if _receiver is not None:
+        # the records the forked processes already sent are written first
+        _receiver.stopping.set()
+        _receiver.join()
+        _receiver = None
+
+    while _listeners:
+        _listeners.pop().stop()
+
+
+def receive_from_forks():
+    '''This function is called by the master process of serve.py before it forks its workers. The
+    processes forked afterwards send their log records to this process, which writes them, so that
+    each log file is only written and rotated by one process (processes rotating the same file would
+    rename it under each other, and lose lines).'''
+
+    global _sender, _receiver
+    sock, _sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    _receiver = threading.Thread(target=_receive, args=(sock,), daemon=True)
+    _receiver.stopping = threading.Event()
+    _receiver.start()
+
+
+def _receive(sock):
+    # writes the records sent by the forked processes, until stop_listeners is called and none are left
+    handlers = dict(zip(_paths, _handlers))
+    buffer = bytearray(MAX_RECORD_BYTES)
+    sock.settimeout(0.1)
+    while True:
+        try:
+            size = sock.recv_into(buffer)
+        except socket.timeout:
+            if threading.current_thread().stopping.is_set():
+                sock.close()
+                return
+            continue
+
+        path, attributes = pickle.loads(buffer[:size])
+        if path not in handlers:
+            # a logger created after the fork
+            get_log(attributes['name'], path)
+            handlers = dict(zip(_paths, _handlers))
+        handlers[path].handle(logging.makeLogRecord(attributes))
+
+
+def _restart_listeners():
+    '''Only the thread that forks exists in a forked process (e.g. the workers of serve.py), so the
+    background writers are started again there, each with a new queue in case the old one was locked.
+    After receive_from_forks, they send the records to the process that forked instead of writing them.'''
+
+    global _forwarding, _receiver
+    if _sender is not None:
+        _forwarding, _receiver = True, None
+        _sender.settimeout(1)
+
+    for handler, listener, path in zip(_handlers, _listeners, _paths):
+        handler.queue = listener.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        if _forwarding:
+            listener.handlers = (ForwardingHandler(_sender, path),)
+        listener._thread = None
+        listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_listeners)
+
+
+def _fingerprint(data):
+    '''Returns a digest of the shape, the column names, the index labels and every value of a
+    DataFrame or Series. Unlike hash(), the digest is the same in every process and run. The index
+    is hashed with pd.util.hash_pandas_object, the numeric columns by their bytes, and the object
+    columns by pickling their values, which is several times faster than hash_pandas_object on
+    columns mixing strings and missing values (about 4 ms for a request of 500 rows and 94 columns).'''
+
+    frame = data.to_frame() if isinstance(data, pd.Series) else data
+    digest = hashlib.blake2b(pickle.dumps((data.shape, list(frame.columns)), protocol=4), digest_size=8)
+    digest.update(pd.util.hash_pandas_object(frame.index).to_numpy().tobytes())
+    for _, column in frame.items():
+        values = column.to_numpy()
+        digest.update(pickle.dumps(values.tolist(), protocol=4) if values.dtype == object else values.tobytes())
+
+    return digest.hexdigest()
+
+
+def summarize(value):
+    '''This function builds a short description of an argument for the log, instead of
+    writing out its whole repr.
+
+    Parameters:
+        value: any argument passed to a logged function
+
+    Returns:
+        str: a short summary, e.g. the shape, dtypes and hash of a DataFrame'''
+
+    if isinstance(value, pd.DataFrame):
+        dtypes = {str(dtype): count for dtype, count in collections.Counter(value.dtypes.values).items()}
+        return f'DataFrame(shape={value.shape}, dtypes={dtypes}, hash={_fingerprint(value)})'
+    if isinstance(value, pd.Series):
+        return f'Series(name={value.name!r}, len={len(value)}, dtype={value.dtype}, hash={_fingerprint(value)})'
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        return f'{type(value).__name__}(shape={value.shape}, dtype={value.dtype})'
+    if isinstance(value, str):
+        return repr(value) if len(value) <= MAX_STR_LEN else repr(value[:MAX_STR_LEN]) + '...'
+    if value is None or isinstance(value, (bool, int, float)):
+        return repr(value)
+    if isinstance(value, (list, tuple, dict, set)):
+        return f'{type(value).__name__}(len={len(value)})'
+
+    return f'<{type(value).__name__}>'
+
+
+def make_logger(log, sample_every=LOG_SAMPLE_EVERY):
+    '''This function creates the logging decorator for a module. Every decorated function
+    logs one call out of every sample_every, with its arguments summarized.
+
+    Parameters:
+        log: the logging.Logger returned by get_log
+        sample_every (int): log one call out of this many, per function
+
+    Returns:
+        logger: a decorator that logs calls to the function it decorates'''
+
+    def logger(original_func):
+        '''This function sets up the logger actions. It should be used as a decorator.'''
+
+        calls = itertools.count()
+
+        @functools.wraps(original_func)
+        def wrapper(*args, **kwargs):
+            if next(calls) % sample_every == 0 and log.isEnabledFor(logging.INFO):
+                log.info('%s function executed with args: (%s), and kwargs: {%s}', original_func.__name__,
+                         ', '.join(summarize(arg) for arg in args),
+                         ', '.join(f'{key!r}: {summarize(value)}' for key, value in kwargs.items()))
+            return original_func(*args, **kwargs)
+        return wrapper
+
+    return logger
@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import fcntl
+import bisect
+import threading
+import functools
+
+
+# Upper bounds of the histogram buckets, in seconds for latencies and in rows for request sizes
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+ROW_BUCKETS = (1, 2, 5, 10, 100, 1000, 10000, 100000)
+
+# Under serve.py, each worker process writes its metrics to a directory shared with the other processes every
+# METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the metrics of every worker, running or stopped (see share)
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+_registry = []
+# The directory shared by the worker processes, None when the metrics are those of this process only
+_directory = None
+_flush_lock = threading.Lock()
+
+
+def _format_labels(labelnames, labels, extra=''):
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    '''This class is a counter in the format of Prometheus, with one value per combination of labels.
+
+    Methods:
+        inc: adds amount to the counter of the given label values
+        values: returns the value of every combination of labels
+        collect: returns the lines of the counter in the Prometheus text format
+    '''
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+
+    def collect(self, values=None):
+        values = sorted((self.values() if values is None else values).items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        lines.extend(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}' for labels, value in values)
+        return lines
+
+
+    def _reset(self):
+        self._values, self._lock = {}, threading.Lock()
+
+
+class Gauge:
+    '''This class is a gauge in the format of Prometheus, a value that is set rather than added to.
+
+    Methods:
+        set: sets the value of the given label values
+        values: returns the value of every combination of labels
+        collect: returns the lines of the gauge in the Prometheus text format
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+
+    def collect(self, values=None):
+        values = sorted((self.values() if values is None else values).items())
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        lines.extend(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}' for labels, value in values)
+        return lines
+
+
+    def _reset(self):
+        # gauges are set, not added to, so a forked worker keeps the values of the master (e.g. startup_seconds)
+        self._lock = threading.Lock()
+
+
+class _Timer:
+    '''Context manager returned by Histogram.time, it observes the time spent in its block.'''
+
+    __slots__ = ('child', 'start')
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+class _HistogramChild:
+    '''The buckets of a histogram for one combination of labels.'''
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+
+class Histogram:
+    '''This class is a histogram with fixed buckets in the format of Prometheus, with one set of
+    buckets per combination of labels. Observing a value only costs a binary search and a few
+    additions, so it can be used on every request.
+
+    Methods:
+        labels: returns the buckets of the given label values, to observe values without looking them up
+        observe: adds a value to the histogram of the given label values
+        time: returns a context manager that observes the time spent in its block
+        values: returns the bucket counts, sum and count of every combination of labels
+        collect: returns the lines of the histogram in the Prometheus text format
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.documentation, self.labelnames = name, documentation, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._children = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+
+    def labels(self, *labels):
+        child = self._children.get(labels)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labels, _HistogramChild(self.buckets))
+        return child
+
+
+    def observe(self, value, *labels):
+        self.labels(*labels).observe(value)
+
+
+    def time(self, *labels):
+        return _Timer(self.labels(*labels))
+
+
+    def values(self):
+        with self._lock:
+            children = list(self._children.items())
+        values = {}
+        for labels, child in children:
+            with child.lock:
+                values[labels] = [list(child.counts), child.sum, child.count]
+        return values
+
+
+    def collect(self, values=None):
+        values = sorted((self.values() if values is None else values).items(), key=lambda item: item[0])
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format(bound)
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}')
+        return lines
+
+
+    def _reset(self):
+        # the children are emptied rather than replaced, since timed keeps a reference to them
+        self._lock = threading.Lock()
+        for child in self._children.values():
+            child.counts, child.sum, child.count, child.lock = [0] * len(child.counts), 0.0, 0, threading.Lock()
+
+
+def timed(stage):
+    '''This function creates a decorator that observes the time spent in the function it decorates
+    in the stage_seconds histogram, under the given stage name.'''
+
+    def decorator(original_func):
+        child = stage_seconds.labels(stage)
+
+        @functools.wraps(original_func)
+        def wrapper(*args, **kwargs):
+            with child.time():
+                return original_func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def render():
+    '''This function returns every metric in the Prometheus text exposition format. When the metrics
+    are shared (see share), they are the sum of the metrics of every worker process.'''
+
+    totals = _collect_shared() if _directory is not None else {metric.name: metric.values() for metric in _registry}
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.collect(totals.get(metric.name, {})))
+
+    return '\n'.join(lines) + '\n'
+
+
+def share(directory):
+    '''This function is called by the master process of serve.py before it forks its workers. Each worker
+    then starts its metrics from zero and writes them to a file of directory every METRICS_FLUSH_INTERVAL
+    seconds and when it renders them, and render adds up the files of every worker. When a worker has
+    exited, the master moves its metrics into the archive file of the directory (see retire), so the
+    counters keep increasing when workers are replaced. Gauges are taken from the running workers,
+    with the largest value when they differ.
+
+    Parameters:
+        directory (str): a directory used only by this server'''
+
+    global _directory
+    os.makedirs(directory, exist_ok=True)
+    _directory = directory
+
+
+def flush():
+    '''This function writes the metrics of this process to its file of the shared directory.'''
+
+    if _directory is not None:
+        with _flush_lock:
+            _write(_path(os.getpid()), {metric.name: metric.values() for metric in _registry})
+
+
+def retire(pid):
+    '''This function is called by the master once the worker pid has exited. It adds the counters
+    and histograms of the worker to the archive file and deletes the file of the worker.'''
+
+    if _directory is None:
+        return
+    with _locked(fcntl.LOCK_EX):
+        worker = _read(_path(pid))
+        if worker is None:
+            return
+        archive = _read(os.path.join(_directory, 'archive.json')) or {}
+        for metric in _registry:
+            if metric.kind != 'gauge':
+                archive[metric.name] = _merge(metric.kind, archive.get(metric.name, {}), worker.get(metric.name, {}))
+        _write(os.path.join(_directory, 'archive.json'), archive)
+        os.remove(_path(pid))
+
+
+def _collect_shared():
+    # the lock keeps retire from moving the metrics of a worker to the archive while the files are read
+    flush()
+    with _locked(fcntl.LOCK_SH):
+        archive = _read(os.path.join(_directory, 'archive.json')) or {}
+        workers = [_read(os.path.join(_directory, name)) for name in os.listdir(_directory) if name[:-len('.json')].isdigit()]
+
+    totals = {}
+    for metric in _registry:
+        total = archive.get(metric.name, {}) if metric.kind != 'gauge' else {}
+        for worker in workers:
+            total = _merge(metric.kind, total, (worker or {}).get(metric.name, {}))
+        totals[metric.name] = total
+    return totals
+
+
+def _merge(kind, total, values):
+    total = dict(total)
+    for labels, value in values.items():
+        if labels not in total:
+            total[labels] = value
+        elif kind == 'counter':
+            total[labels] = total[labels] + value
+        elif kind == 'gauge':
+            total[labels] = max(total[labels], value)
+        else:
+            counts, value_sum, count = total[labels]
+            total[labels] = [[a + b for a, b in zip(counts, value[0])], value_sum + value[1], count + value[2]]
+    return total
+
+
+def _path(pid):
+    return os.path.join(_directory, f'{pid}.json')
+
+
+def _locked(operation):
+    lock = open(os.path.join(_directory, 'lock'), 'w')
+    fcntl.flock(lock, operation)
+    # closing the file releases the lock
+    return lock
+
+
+def _write(path, metrics):
+    # label values are saved as lists, since JSON has no tuples
+    with open(path + '.tmp', 'w') as f:
+        json.dump({name: [[list(labels), value] for labels, value in values.items()] for name, values in metrics.items()}, f)
+    os.replace(path + '.tmp', path)
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return {name: {tuple(labels): value for labels, value in values} for name, values in json.load(f).items()}
+    except FileNotFoundError:
+        return None
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            # the directory was removed, the server is stopping
+            return
+
+
+def _start_worker():
+    # runs in every process forked after share: its metrics start from zero, and are written to the directory
+    global _flush_lock
+    if _directory is not None:
+        _flush_lock = threading.Lock()
+        for metric in _registry:
+            metric._reset()
+        threading.Thread(target=_flush_periodically, daemon=True).start()
+
+
+os.register_at_fork(after_in_child=_start_worker)
+
+
+# Metrics of the prediction service
+stage_seconds = Histogram('leche_stage_duration_seconds', 'Time spent in each stage of a prediction request.', ['stage'])
+request_seconds = Histogram('leche_request_duration_seconds', 'Time spent handling a request, by endpoint.', ['endpoint'])
+request_rows = Histogram('leche_request_rows', 'Number of input rows per prediction request.', ['endpoint'], buckets=ROW_BUCKETS)
+requests_total = Counter('leche_requests_total', 'Number of requests, by endpoint.', ['endpoint'])
+errors_total = Counter('leche_errors_total', 'Number of requests that returned an error, by endpoint and type of error.', ['endpoint', 'type'])
+profiles_total = Counter('leche_profiles_total', 'Number of requests profiled, by endpoint.', ['endpoint'])
+startup_seconds = Gauge('leche_startup_seconds', 'Time taken to start the app, by phase (imports and model loading).', ['phase'])
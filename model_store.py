@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import numpy as np
+
+
+# Directory of the versioned model store. Every version is a folder holding the arrays of the term table
+# (one .npy file each, so they can be memory-mapped), a manifest.json with the metadata and scalar values,
+# the pickled sklearn pipeline and the state used to update it incrementally (state.npz, see train.py). The CURRENT
+# file holds the name of the version being served.
+STORE_DIR = os.environ.get('MODEL_STORE_DIR', 'model/store')
+KEEP_VERSIONS = int(os.environ.get('MODEL_KEEP_VERSIONS', 5))
+# Path of the pickled pipeline written by train.py, used when the store is empty
+MODEL_PATH = 'model/leche_predictor.pkl'
+
+
+def publish(table, pipeline_bytes, store_dir=STORE_DIR, metadata=None, state=None):
+    '''This function saves a new model version in the store and makes it the current version.
+    The version folder is written under a temporary name and renamed when complete, and the
+    CURRENT file is replaced atomically, so readers never see a half-written version.
+
+    Parameters:
+        table: the term table of the model (see term_table.py)
+        pipeline_bytes (bytes): the pickled sklearn pipeline
+        store_dir (str): directory of the model store
+        metadata (dict): extra information saved in the manifest
+        state (dict): arrays and numbers used to update the model incrementally (see train.training_state),
+        saved in state.npz
+
+    Returns:
+        version (str): name of the new version'''
+
+    sha256 = hashlib.sha256(pipeline_bytes).hexdigest()
+    version = '{}-{}'.format(time.strftime('%Y%m%dT%H%M%S'), sha256[:12])
+    tmp_dir = os.path.join(store_dir, '.tmp-' + version)
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    arrays, scalars = {}, {}
+    for name, value in table.items():
+        if np.ndim(value) == 0:
+            scalars[name] = value.item() if hasattr(value, 'item') else value
+        else:
+            np.save(os.path.join(tmp_dir, name + '.npy'), np.ascontiguousarray(value))
+            arrays[name] = str(value.dtype)
+
+    with open(os.path.join(tmp_dir, 'pipeline.pkl'), 'wb') as f:
+        f.write(pipeline_bytes)
+    if state is not None:
+        np.savez(os.path.join(tmp_dir, 'state.npz'), **state)
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+        json.dump({'version': version, 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'pipeline_sha256': sha256,
+                   'arrays': arrays, 'scalars': scalars, 'metadata': metadata or {}}, f, indent=2)
+
+    if os.path.isdir(os.path.join(store_dir, version)):
+        # the same pipeline was already published in the same second
+        shutil.rmtree(tmp_dir)
+    else:
+        os.replace(tmp_dir, os.path.join(store_dir, version))
+    set_current(version, store_dir)
+    _remove_old_versions(store_dir)
+
+    return version
+
+
+def set_current(version, store_dir=STORE_DIR):
+    '''This function makes an existing version the current one (e.g. to roll back).'''
+
+    if not os.path.isdir(os.path.join(store_dir, version)):
+        raise ValueError(f'Model version {version} does not exist in {store_dir}')
+    with open(os.path.join(store_dir, 'CURRENT.tmp'), 'w') as f:
+        f.write(version)
+    os.replace(os.path.join(store_dir, 'CURRENT.tmp'), os.path.join(store_dir, 'CURRENT'))
+
+
+def current_version(store_dir=STORE_DIR):
+    '''This function returns the name of the current version, or None if the store is empty.'''
+
+    try:
+        with open(os.path.join(store_dir, 'CURRENT')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def list_versions(store_dir=STORE_DIR):
+    '''This function returns the names of all versions in the store, oldest first.'''
+
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(name for name in os.listdir(store_dir)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(store_dir, name)))
+
+
+def load(version, store_dir=STORE_DIR):
+    '''This function loads the term table of a version. The arrays are memory-mapped read only,
+    so every process serving the same version shares the same pages of memory.
+
+    Parameters:
+        version (str): name of the version to load
+        store_dir (str): directory of the model store
+
+    Returns:
+        table: the term table of the model
+        manifest: a dict with the metadata of the version'''
+
+    version_dir = os.path.join(store_dir, version)
+    with open(os.path.join(version_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+
+    table = dict(manifest['scalars'])
+    for name in manifest['arrays']:
+        table[name] = np.load(os.path.join(version_dir, name + '.npy'), mmap_mode='r')
+
+    return table, manifest
+
+
+def load_pipeline(version, store_dir=STORE_DIR):
+    '''This function unpickles the sklearn pipeline of a version.'''
+
+    with open(os.path.join(store_dir, version, 'pipeline.pkl'), 'rb') as f:
+        return pickle.load(f)
+
+
+def load_state(version, store_dir=STORE_DIR):
+    '''This function loads the training state saved with a version, or returns None if it has none.'''
+
+    path = os.path.join(store_dir, version, 'state.npz')
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as arrays:
+        return {name: arrays[name].item() if arrays[name].ndim == 0 else arrays[name] for name in arrays.files}
+
+
+def _remove_old_versions(store_dir):
+    '''Deletes all but the KEEP_VERSIONS newest versions, never the current one. Processes that
+    still have a deleted version memory-mapped keep reading it until they reload.'''
+
+    current = current_version(store_dir)
+    for version in list_versions(store_dir)[:-KEEP_VERSIONS]:
+        if version != current:
+            shutil.rmtree(os.path.join(store_dir, version), ignore_errors=True)
@@ -1,57 +1,119 @@
 import pickle
+import hashlib
+import numpy as np
 import pandas as pd
-import logging
 
-import train
+import metrics
+import preprocessing
+import log_utils
+import term_table
+import model_store
+from preprocessing import cols, cols_precipitaciones, cols_banco_central, cols_model
 
 
-# This list contains only the variables essential to the model, used to check if there are any 
-# missing variables in the data submitted.
-cols = ['date', 'Periodo', 'Coquimbo', 'Valparaiso', 'Metropolitana_de_Santiago', 'Libertador_Gral__Bernardo_O_Higgins', 'Maule', 'Biobio', 'La_Araucania', 'Los_Rios', 'PIB_Agropecuario_silvicola', 'PIB_Pesca', 'PIB_Mineria', 'PIB_Mineria_del_cobre', 'PIB_Otras_actividades_mineras', 'PIB_Industria_Manufacturera', 'PIB_Alimentos', 'PIB_Bebidas_y_tabaco', 'PIB_Textil', 'PIB_Maderas_y_muebles', 'PIB_Celulosa', 'PIB_Refinacion_de_petroleo', 'PIB_Quimica', 'PIB_Minerales_no_metalicos_y_metalica_basica', 'PIB_Productos_metalicos', 'PIB_Electricidad', 'PIB_Construccion', 'PIB_Comercio', 'PIB_Restaurantes_y_hoteles', 'PIB_Transporte', 'PIB_Comunicaciones', 'PIB_Servicios_financieros', 'PIB_Servicios_empresariales', 'PIB_Servicios_de_vivienda', 'PIB_Servicios_personales', 'PIB_Administracion_publica', 'PIB_a_costo_de_factores', 'PIB', 'Imacec_empalmado', 'Imacec_produccion_de_bienes', 'Imacec_minero', 'Imacec_industria', 'Imacec_resto_de_bienes', 'Imacec_comercio', 'Imacec_servicios', 'Imacec_a_costo_de_factores', 'Imacec_no_minero']
-
-# The lists below contain all variables pertinent to each dataset, used to separate the precipitaciones and 
-# banco_central data, since they are processed separately.
-cols_precipitaciones = ['date', 'Coquimbo', 'Valparaiso', 'Metropolitana_de_Santiago', 'Libertador_Gral__Bernardo_O_Higgins', 'Maule', 'Biobio', 'La_Araucania', 'Los_Rios']
-cols_banco_central = ['Periodo', 'Imacec_empalmado','Imacec_produccion_de_bienes','Imacec_minero','Imacec_industria','Imacec_resto_de_bienes','Imacec_comercio','Imacec_servicios','Imacec_a_costo_de_factores','Imacec_no_minero','PIB_Agropecuario_silvicola','PIB_Pesca','PIB_Mineria','PIB_Mineria_del_cobre','PIB_Otras_actividades_mineras','PIB_Industria_Manufacturera','PIB_Alimentos','PIB_Bebidas_y_tabaco','PIB_Textil','PIB_Maderas_y_muebles','PIB_Celulosa','PIB_Refinacion_de_petroleo','PIB_Quimica','PIB_Minerales_no_metalicos_y_metalica_basica','PIB_Productos_metalicos','PIB_Electricidad','PIB_Construccion','PIB_Comercio','PIB_Restaurantes_y_hoteles','PIB_Transporte','PIB_Comunicaciones','PIB_Servicios_financieros','PIB_Servicios_empresariales','PIB_Servicios_de_vivienda','PIB_Servicios_personales','PIB_Administracion_publica', 'PIB_a_costo_de_factores', 'Impuesto_al_valor_agregado', 'Derechos_de_Importacion', 'PIB', 'Precio_de_la_gasolina_en_EEUU_dolaresm3', 'Precio_de_la_onza_troy_de_oro_dolaresoz', 'Precio_de_la_onza_troy_de_plata_dolaresoz', 'Precio_del_cobre_refinado_BML_dolareslibra', 'Precio_del_diesel_centavos_de_dolargalon', 'Precio_del_gas_natural_dolaresmillon_de_unidades_termicas_britanicas', 'Precio_del_petroleo_Brent_dolaresbarril', 'Precio_del_kerosene_dolaresm3', 'Precio_del_petroleo_WTI_dolaresbarril', 'Precio_del_propano_centavos_de_dolargalon_DTN', 'Tipo_de_cambio_del_dolar_observado_diario', 'Ocupados', 'Ocupacion_en_Agricultura_INE', 'Ocupacion_en_Explotacion_de_minas_y_canteras_INE', 'Ocupacion_en_Industrias_manufactureras_INE', 'Ocupacion_en_Suministro_de_electricidad_INE', 'Ocupacion_en_Actividades_de_servicios_administrativos_y_de_apoyo_INE', 'Ocupacion_en_Actividades_profesionales_INE', 'Ocupacion_en_Actividades_inmobiliarias_INE', 'Ocupacion_en_Actividades_financieras_y_de_seguros_INE', 'Ocupacion_en_Informacion_y_comunicaciones_INE', 'Ocupacion_en_Transporte_y_almacenamiento_INE', 'Ocupacion_en_Actividades_de_alojamiento_y_de_servicio_de_comidas_INE', 'Ocupacion_en_Construccion_INE', 'Ocupacion_en_Comercio_INE', 'Ocupacion_en_Suministro_de_agua_evacuacion_de_aguas_residuales_INE', 'Ocupacion_en_Administracion_publica_y_defensa_INE', 'Ocupacion_en_Enseanza_INE', 'Ocupacion_en_Actividades_de_atencion_de_la_salud_humana_y_de_asistencia_social_INE', 'Ocupacion_en_Actividades_artisticas_INE', 'Ocupacion_en_Otras_actividades_de_servicios_INE', 'Ocupacion_en_Actividades_de_los_hogares_como_empleadores_INE', 'Ocupacion_en_Actividades_de_organizaciones_y_organos_extraterritoriales_INE', 'No_sabe__No_responde_Miles_de_personas', 'Tipo_de_cambio_nominal_multilateral___TCM', 'Indice_de_tipo_de_cambio_real___TCR_promedio_1986_100','Indice_de_produccion_industrial', 'Indice_de_produccion_industrial__mineria', 'Indice_de_produccion_industrial_electricidad__gas_y_agua', 'Indice_de_produccion_industrial__manufacturera', 'Generacion_de_energia_electrica_CDEC_GWh', 'Indice_de_ventas_comercio_real_IVCM', 'Indice_de_ventas_comercio_real_no_durables_IVCM', 'Indice_de_ventas_comercio_real_durables_IVCM', 'Ventas_autos_nuevos']
-
 # Set log configurations, and create logging decorator function
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
-formatter = logging.Formatter(fmt='%(asctime)s:%(levelname)s:%(name)s:%(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-file_handler = logging.FileHandler('logs/predict.log')
-file_handler.setFormatter(formatter)
-log.addHandler(file_handler)
-
-def logger(original_func):
-    '''This function sets up the logger actions. It should be used as a decorator.'''
-
-    def wrapper(*args, **kwargs):
-        log.info('{} function executed with args: {}, and kwargs: {}'.format(original_func.__name__, args, kwargs))
-        return original_func(*args, **kwargs)
-    return wrapper
+log = log_utils.get_log(__name__, 'logs/predict.log')
+logger = log_utils.make_logger(log)
 
 
 class LechePredictor:
     '''This class is used to create the precictor object.
     
     Attributes:
-        model: sklearn pipeline used to make a prediction
+        model: sklearn pipeline used to make a prediction, only loaded when first used
+        version: name of the model version being used
+        manifest: metadata of the model version
+        table: term table of the pipeline (see term_table.py), used to make predictions with numpy
 
     Methods:
         find_missing_cols: asserts that all columns needed for prediction are present in the dataset
         separate_new_data: splits input data into precipitaciones and banco_central datasets before processing
-        prep_new_data: prepares data for prediction by calling functions from train.py
+        prep_new_data: prepares data for prediction by calling functions from preprocessing.py
+        merge_new_data: merges the processed precipitaciones and banco_central data, used by prep_new_data
         find_cols_all_na: last check before the data is used for prediction. This method will make sure none of the columns are missing all values
+        compile_model: compiles the term table of the model when the model store is empty, used by predict_array
+        predict_array: predicts from a float64 array of the model variables (in the order of cols_model) using the term table
+        predict_rows: predicts rows that can be predicted on their own, returning one record per input row
         make_prediction: the method used to orchestrate prediction. It will call methods for preparing data and then output predictions
     '''
 
     @logger
-    def __init__(self):
-        '''Parameters: None'''
-        self.model = pickle.load(open('model/leche_predictor.pkl', 'rb')) 
+    def __init__(self, version=None):
+        '''Parameters:
+            version (str): version of the model store to load (see model_store.py), defaults to the
+            current version. If the store is empty, the pipeline in model/leche_predictor.pkl is used'''
+
+        self._model = None
+        self.version = version or model_store.current_version()
+
+        if self.version is not None:
+            self.table, self.manifest = model_store.load(self.version)
+        else:
+            with open(model_store.MODEL_PATH, 'rb') as f:
+                content = f.read()
+            self._model = pickle.loads(content)
+            self.version = 'pkl-' + hashlib.sha256(content).hexdigest()[:12]
+            self.manifest = {'version': self.version}
+            self.compile_model()
+
+
+    @property
+    def model(self):
+        '''The sklearn pipeline of the model. Predictions only need the term table, so the pipeline
+        is only unpickled the first time it is used.'''
+
+        if self._model is None:
+            self._model = model_store.load_pipeline(self.version)
+        return self._model
+
+
+    @logger
+    def compile_model(self):
+        '''This function compiles the term table of self.model, without pruning. It is used when the
+        model store is empty, and has to be called again if self.model is replaced.'''
+
+        self.table = term_table.compile_pipeline(self.model)
+
+
+    @logger
+    @metrics.timed('predict')
+    def predict_array(self, values):
+        '''This function makes predictions from values that have already been processed, using only
+        numpy operations on the term table of the model, without building DataFrames.
+
+        Parameters:
+            values: a float64 array with one row per prediction and one column per variable, in
+            the order of cols_model
+
+        Returns:
+            predictions: a numpy array with one prediction per row'''
+
+        return term_table.evaluate(self.table, values)
+
+
+    @logger
+    def predict_rows(self, data, periods):
+        '''This function makes the predictions of input rows that can be predicted on their own (see
+        prediction_cache.row_periods), and matches each output row to the input row it comes from.
+
+        Parameters:
+            data: a DataFrame with the raw input rows
+            periods: the period (year * 12 + month) of each input row
+
+        Returns:
+            records: a list with one dict of the processed variables and prediction per input row,
+            or None for the rows without valid values'''
+
+        precipitaciones, banco_central = self.separate_new_data(data)
+        data = self.prep_new_data(precipitaciones, banco_central)
+        data['prediction'] = self.predict_array(data.to_numpy(dtype=np.float64))
+
+        by_period = dict(zip(data['ano'] * 12 + data['mes'], data.to_dict('records')))
+        return [by_period.get(period) for period in periods]
     
 
     @logger
+    @metrics.timed('find_missing_cols')
     def find_missing_cols(self, data):
         '''This function will parse throught the data submitted and find if 
         any columns essential to the model for prediction are missing. An
@@ -60,14 +122,15 @@ class LechePredictor:
         Parameters:
             data: a Pandas DataFrame that will be checked for missing columns'''
 
-        missing = [col for col in cols if col not in data.columns]
+        columns = set(data.columns)
+        missing = [col for col in cols if col not in columns]
 
-        for col in cols:
-            assert col in data.columns, \
-                f'The following columns were missing in the request: \n\n {missing}' 
+        assert not missing, \
+            f'The following columns were missing in the request: \n\n {missing}' 
 
     
     @logger
+    @metrics.timed('separate_new_data')
     def separate_new_data(self, data):
         '''This function will separate a single dataset into the precipitaciones
         and banco_central sets. This is needed because the established processing
@@ -82,8 +145,8 @@ class LechePredictor:
             banco_central: a DataFrame with the columns from the banco_central
             training dataset'''
 
-        precipitaciones = pd.DataFrame(data=data[[col for col in cols_precipitaciones if col in cols_precipitaciones]])
-        banco_central = pd.DataFrame(data=data[[col for col in cols_banco_central if col in cols_banco_central]])
+        precipitaciones = data[cols_precipitaciones]
+        banco_central = data[cols_banco_central]
         
         return precipitaciones, banco_central
 
@@ -104,30 +167,42 @@ class LechePredictor:
             for prediction. Variables have been processed, features engineered,
             and datasets merged'''
         
-        precipitaciones = train.prep_precipitaciones(precipitaciones)
-        banco_central = train.prep_banco_central(banco_central)
+        with metrics.stage_seconds.time('prep_precipitaciones'):
+            precipitaciones = preprocessing.prep_precipitaciones(precipitaciones)
+        with metrics.stage_seconds.time('prep_banco_central'):
+            banco_central = preprocessing.prep_banco_central(banco_central)
 
-        # Separates the date/Periodo columns into month (mes) and year (ano)
-        precipitaciones['mes'] = precipitaciones['date'].apply(lambda x: x.month)
-        precipitaciones['ano'] = precipitaciones['date'].apply(lambda x: x.year)
-        banco_central['mes'] = banco_central['Periodo'].apply(lambda x: x.month)
-        banco_central['ano'] = banco_central['Periodo'].apply(lambda x: x.year)
+        with metrics.stage_seconds.time('merge'):
+            data = self.merge_new_data(precipitaciones, banco_central)
+        
+        return data
 
-        # Merges the precipitaciones and banco_central data
-        data = pd.merge(banco_central, precipitaciones, on=['mes', 'ano'], how='inner')
+
+    @logger
+    def merge_new_data(self, precipitaciones, banco_central):
+        '''This function merges the precipitaciones and banco_central data after they have been
+        processed (by prep_precipitaciones and prep_banco_central), and puts the columns in the
+        order used by the model.
+
+        Parameters:
+            precipitaciones: a DataFrame of processed precipitaciones data
+            banco_central: a DataFrame of processed banco_central data
+
+        Returns:
+            data: a DataFrame with the columns of cols_model'''
+
+        # Separates the Periodo column into month (mes) and year (ano)
+        banco_central['mes'] = banco_central['Periodo'].dt.month.astype(np.int64)
+        banco_central['ano'] = banco_central['Periodo'].dt.year.astype(np.int64)
+
+        # Merges the precipitaciones and banco_central data on the period (year * 12 + month)
+        data = preprocessing.join_on_period(banco_central, preprocessing.period_key(banco_central['Periodo']),
+                                            precipitaciones, preprocessing.period_key(precipitaciones['date']))
 
         # This line is used to order the columns of the data used for prediction, it was included after a warning from sklearn
         # saying that the prediction data columns should be in the same order as the training data columns. It is also a way
         # of dropping any columns no essential to the model for prediction.
-        data = data[['ano', 'mes', 'Coquimbo', 'Valparaiso', 'Metropolitana_de_Santiago', 'Libertador_Gral__Bernardo_O_Higgins', 'Maule', 'Biobio', 'La_Araucania', 
-                    'Los_Rios', 'PIB_Agropecuario_silvicola', 'PIB_Pesca', 'PIB_Mineria', 'PIB_Mineria_del_cobre', 'PIB_Otras_actividades_mineras', 'PIB_Industria_Manufacturera', 
-                    'PIB_Alimentos', 'PIB_Bebidas_y_tabaco', 'PIB_Textil', 'PIB_Maderas_y_muebles', 'PIB_Celulosa', 'PIB_Refinacion_de_petroleo', 'PIB_Quimica', 
-                    'PIB_Minerales_no_metalicos_y_metalica_basica', 'PIB_Productos_metalicos', 'PIB_Electricidad', 'PIB_Construccion', 'PIB_Comercio', 'PIB_Restaurantes_y_hoteles', 
-                    'PIB_Transporte', 'PIB_Comunicaciones', 'PIB_Servicios_financieros', 'PIB_Servicios_empresariales', 'PIB_Servicios_de_vivienda', 'PIB_Servicios_personales', 
-                    'PIB_Administracion_publica', 'PIB_a_costo_de_factores', 'PIB', 'Imacec_empalmado', 'Imacec_produccion_de_bienes', 'Imacec_minero', 'Imacec_industria', 
-                    'Imacec_resto_de_bienes', 'Imacec_comercio', 'Imacec_servicios', 'Imacec_a_costo_de_factores', 'Imacec_no_minero', 'num']]
-        
-        return data
+        return data[cols_model]
 
 
     @logger
@@ -162,6 +237,6 @@ class LechePredictor:
         
         data = self.prep_new_data(precipitaciones, banco_central)
         self.find_cols_all_na(data)      
-        data['prediction'] = self.model.predict(data)
+        data['prediction'] = self.predict_array(data.to_numpy(dtype=np.float64))
 
         return data
@@ -0,0 +1,132 @@
+import os
+import time
+import hashlib
+import threading
+import collections
+import numpy as np
+import pandas as pd
+
+from preprocessing import cols
+
+
+# Raw input columns the predictions depend on. The IVCM column is not in cols but is used to create the 'num' variable.
+KEY_COLUMNS = cols + ['Indice_de_ventas_comercio_real_no_durables_IVCM']
+
+# Cache settings, these can be overridden with environment variables when the service is deployed.
+PREDICTION_CACHE_SIZE = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+PREDICTION_CACHE_TTL = float(os.environ.get('PREDICTION_CACHE_TTL', 3600))
+
+# Returned by PredictionCache.get when a key is not cached, since None is a valid cached value
+MISSING = object()
+
+
+class PredictionCache:
+    '''This class is a thread-safe LRU cache with a time to live, used to store the predictions of
+    input rows that have already been seen.
+
+    Attributes:
+        max_size: maximum number of entries, the least recently used entries are evicted first
+        ttl: number of seconds an entry stays valid
+        hits, misses, evictions: counters of cache lookups and of entries removed (full or expired)
+
+    Methods:
+        make_keys: computes the cache key of every row of a DataFrame
+        get: returns the cached value of a key, or MISSING
+        put: stores a value
+        clear: removes every entry, used when the model is reloaded
+        stats: returns the counters and the size of the cache
+    '''
+
+    def __init__(self, max_size=PREDICTION_CACHE_SIZE, ttl=PREDICTION_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = self.misses = self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def make_keys(self, data, version):
+        '''This function computes a canonical hash of the model-relevant columns of each row, together
+        with the model version, so a new model never serves predictions of the previous one. Each value
+        is hashed with its type, since e.g. "123" and 123 are not validated or preprocessed the same way.
+
+        Parameters:
+            data: a DataFrame of raw input rows
+            version (str): version of the model making the predictions
+
+        Returns:
+            keys: a list with one key per row'''
+
+        prefix = version.encode() + b'\x1e'
+        # the repr of the list of values tells strings, integers, floats, booleans and None apart
+        return [hashlib.blake2b(prefix + repr(row).encode(), digest_size=16).digest()
+                for row in data[KEY_COLUMNS].to_numpy().tolist()]
+
+
+    def get(self, key):
+        '''Returns the cached value of key, or MISSING if it is not cached or has expired.'''
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+                self.evictions += 1
+            self.misses += 1
+            return MISSING
+
+
+    def put(self, key, value):
+        '''Stores value under key, evicting the least recently used entry if the cache is full.'''
+
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+
+    def clear(self):
+        '''Removes every entry from the cache.'''
+
+        with self._lock:
+            self._entries.clear()
+
+
+    def stats(self):
+        '''Returns a dict with the size of the cache and its hit, miss and eviction counters.'''
+
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'ttl': self.ttl,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def row_periods(data):
+    '''This function checks if each input row can be predicted on its own: the precipitaciones date
+    and the banco_central Periodo of the row are in the same month, and no two rows are in the same
+    month. In that case the prediction pipeline outputs exactly one row per input row that has
+    valid values, in the same order, so predictions can be cached row by row.
+
+    Parameters:
+        data: a DataFrame of raw input rows
+
+    Returns:
+        periods: a numpy array with the period (year * 12 + month) of each row, or None if the rows
+        cannot be predicted on their own'''
+
+    dates = pd.to_datetime(data['date'], format='%Y-%m-%d', errors='coerce')
+    periodos = pd.to_datetime(data['Periodo'].astype(str).str[:10], format='%Y-%m-%d', errors='coerce')
+    if dates.isna().any() or periodos.isna().any():
+        return None
+
+    periods = (dates.dt.year * 12 + dates.dt.month).to_numpy()
+    if not np.array_equal(periods, (periodos.dt.year * 12 + periodos.dt.month).to_numpy()) or len(np.unique(periods)) != len(periods):
+        return None
+
+    return periods
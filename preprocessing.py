@@ -0,0 +1,305 @@
+import os
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+import log_utils
+
+
+# The preprocessing functions shared by training (train.py) and predictions (predict.py). This module only
+# depends on pandas and numpy, so the app can be started without importing the training code.
+pd.options.mode.chained_assignment = None  # default='warn'
+
+
+# Set log configurations, and create logging decorator function
+log = log_utils.get_log(__name__, 'logs/preprocessing.log')
+logger = log_utils.make_logger(log)
+
+# Paths of the datasets, used for training and for the forecasts of the periods they cover (see forecast.py)
+DATA_FILES = {'precipitaciones': './data/precipitaciones.csv',
+              'banco_central': './data/banco_central.csv',
+              'precio_leche': './data/precio_leche.csv'}
+# Number of rows of banco_central.csv read at a time by load_banco_central
+BANCO_CENTRAL_CHUNK_SIZE = int(os.environ.get('BANCO_CENTRAL_CHUNK_SIZE', 10000))
+
+# This list contains only the variables essential to the model, used to check if there are any 
+# missing variables in the data submitted.
+cols = ['date', 'Periodo', 'Coquimbo', 'Valparaiso', 'Metropolitana_de_Santiago', 'Libertador_Gral__Bernardo_O_Higgins', 'Maule', 'Biobio', 'La_Araucania', 'Los_Rios', 'PIB_Agropecuario_silvicola', 'PIB_Pesca', 'PIB_Mineria', 'PIB_Mineria_del_cobre', 'PIB_Otras_actividades_mineras', 'PIB_Industria_Manufacturera', 'PIB_Alimentos', 'PIB_Bebidas_y_tabaco', 'PIB_Textil', 'PIB_Maderas_y_muebles', 'PIB_Celulosa', 'PIB_Refinacion_de_petroleo', 'PIB_Quimica', 'PIB_Minerales_no_metalicos_y_metalica_basica', 'PIB_Productos_metalicos', 'PIB_Electricidad', 'PIB_Construccion', 'PIB_Comercio', 'PIB_Restaurantes_y_hoteles', 'PIB_Transporte', 'PIB_Comunicaciones', 'PIB_Servicios_financieros', 'PIB_Servicios_empresariales', 'PIB_Servicios_de_vivienda', 'PIB_Servicios_personales', 'PIB_Administracion_publica', 'PIB_a_costo_de_factores', 'PIB', 'Imacec_empalmado', 'Imacec_produccion_de_bienes', 'Imacec_minero', 'Imacec_industria', 'Imacec_resto_de_bienes', 'Imacec_comercio', 'Imacec_servicios', 'Imacec_a_costo_de_factores', 'Imacec_no_minero']
+
+# The lists below contain all variables pertinent to each dataset, used to separate the precipitaciones and 
+# banco_central data, since they are processed separately.
+cols_precipitaciones = ['date', 'Coquimbo', 'Valparaiso', 'Metropolitana_de_Santiago', 'Libertador_Gral__Bernardo_O_Higgins', 'Maule', 'Biobio', 'La_Araucania', 'Los_Rios']
+cols_banco_central = ['Periodo', 'Imacec_empalmado','Imacec_produccion_de_bienes','Imacec_minero','Imacec_industria','Imacec_resto_de_bienes','Imacec_comercio','Imacec_servicios','Imacec_a_costo_de_factores','Imacec_no_minero','PIB_Agropecuario_silvicola','PIB_Pesca','PIB_Mineria','PIB_Mineria_del_cobre','PIB_Otras_actividades_mineras','PIB_Industria_Manufacturera','PIB_Alimentos','PIB_Bebidas_y_tabaco','PIB_Textil','PIB_Maderas_y_muebles','PIB_Celulosa','PIB_Refinacion_de_petroleo','PIB_Quimica','PIB_Minerales_no_metalicos_y_metalica_basica','PIB_Productos_metalicos','PIB_Electricidad','PIB_Construccion','PIB_Comercio','PIB_Restaurantes_y_hoteles','PIB_Transporte','PIB_Comunicaciones','PIB_Servicios_financieros','PIB_Servicios_empresariales','PIB_Servicios_de_vivienda','PIB_Servicios_personales','PIB_Administracion_publica', 'PIB_a_costo_de_factores', 'Impuesto_al_valor_agregado', 'Derechos_de_Importacion', 'PIB', 'Precio_de_la_gasolina_en_EEUU_dolaresm3', 'Precio_de_la_onza_troy_de_oro_dolaresoz', 'Precio_de_la_onza_troy_de_plata_dolaresoz', 'Precio_del_cobre_refinado_BML_dolareslibra', 'Precio_del_diesel_centavos_de_dolargalon', 'Precio_del_gas_natural_dolaresmillon_de_unidades_termicas_britanicas', 'Precio_del_petroleo_Brent_dolaresbarril', 'Precio_del_kerosene_dolaresm3', 'Precio_del_petroleo_WTI_dolaresbarril', 'Precio_del_propano_centavos_de_dolargalon_DTN', 'Tipo_de_cambio_del_dolar_observado_diario', 'Ocupados', 'Ocupacion_en_Agricultura_INE', 'Ocupacion_en_Explotacion_de_minas_y_canteras_INE', 'Ocupacion_en_Industrias_manufactureras_INE', 'Ocupacion_en_Suministro_de_electricidad_INE', 'Ocupacion_en_Actividades_de_servicios_administrativos_y_de_apoyo_INE', 'Ocupacion_en_Actividades_profesionales_INE', 'Ocupacion_en_Actividades_inmobiliarias_INE', 'Ocupacion_en_Actividades_financieras_y_de_seguros_INE', 'Ocupacion_en_Informacion_y_comunicaciones_INE', 'Ocupacion_en_Transporte_y_almacenamiento_INE', 'Ocupacion_en_Actividades_de_alojamiento_y_de_servicio_de_comidas_INE', 'Ocupacion_en_Construccion_INE', 'Ocupacion_en_Comercio_INE', 'Ocupacion_en_Suministro_de_agua_evacuacion_de_aguas_residuales_INE', 'Ocupacion_en_Administracion_publica_y_defensa_INE', 'Ocupacion_en_Enseanza_INE', 'Ocupacion_en_Actividades_de_atencion_de_la_salud_humana_y_de_asistencia_social_INE', 'Ocupacion_en_Actividades_artisticas_INE', 'Ocupacion_en_Otras_actividades_de_servicios_INE', 'Ocupacion_en_Actividades_de_los_hogares_como_empleadores_INE', 'Ocupacion_en_Actividades_de_organizaciones_y_organos_extraterritoriales_INE', 'No_sabe__No_responde_Miles_de_personas', 'Tipo_de_cambio_nominal_multilateral___TCM', 'Indice_de_tipo_de_cambio_real___TCR_promedio_1986_100','Indice_de_produccion_industrial', 'Indice_de_produccion_industrial__mineria', 'Indice_de_produccion_industrial_electricidad__gas_y_agua', 'Indice_de_produccion_industrial__manufacturera', 'Generacion_de_energia_electrica_CDEC_GWh', 'Indice_de_ventas_comercio_real_IVCM', 'Indice_de_ventas_comercio_real_no_durables_IVCM', 'Indice_de_ventas_comercio_real_durables_IVCM', 'Ventas_autos_nuevos']
+
+# This list contains the variables used by the model, in the same order as the training data columns. The
+# prediction data is put in this order before being passed to the model.
+cols_model = ['ano', 'mes', 'Coquimbo', 'Valparaiso', 'Metropolitana_de_Santiago', 'Libertador_Gral__Bernardo_O_Higgins', 'Maule', 'Biobio', 'La_Araucania', 'Los_Rios', 'PIB_Agropecuario_silvicola', 'PIB_Pesca', 'PIB_Mineria', 'PIB_Mineria_del_cobre', 'PIB_Otras_actividades_mineras', 'PIB_Industria_Manufacturera', 'PIB_Alimentos', 'PIB_Bebidas_y_tabaco', 'PIB_Textil', 'PIB_Maderas_y_muebles', 'PIB_Celulosa', 'PIB_Refinacion_de_petroleo', 'PIB_Quimica', 'PIB_Minerales_no_metalicos_y_metalica_basica', 'PIB_Productos_metalicos', 'PIB_Electricidad', 'PIB_Construccion', 'PIB_Comercio', 'PIB_Restaurantes_y_hoteles', 'PIB_Transporte', 'PIB_Comunicaciones', 'PIB_Servicios_financieros', 'PIB_Servicios_empresariales', 'PIB_Servicios_de_vivienda', 'PIB_Servicios_personales', 'PIB_Administracion_publica', 'PIB_a_costo_de_factores', 'PIB', 'Imacec_empalmado', 'Imacec_produccion_de_bienes', 'Imacec_minero', 'Imacec_industria', 'Imacec_resto_de_bienes', 'Imacec_comercio', 'Imacec_servicios', 'Imacec_a_costo_de_factores', 'Imacec_no_minero', 'num']
+
+
+@logger
+def to_100(x):
+    '''This function takes in a string of a number and returns
+    a float with 2-3 digits
+    
+    Parameters:
+        x (str): A string containing a number separated by periods 
+    
+    Returns:
+        float: A float of the number rounded to 3 digits (in the hundreds),
+        with 3 decimal points'''
+
+    x = x.split('.')
+    if x[0].startswith('1'): #es 100+
+        if len(x[0]) >2:
+            return float(x[0] + '.' + x[1])
+        x = x[0]+x[1]
+        return float(x[:3] + '.' + x[3:])
+    else:
+        if len(x[0])>2:
+            return float(x[0][:2] + '.' + x[0][-1])
+        x = x[0] + x[1]
+        return float(x[:2] + '.' + x[2:])
+
+
+@logger
+def convert_int(x):
+    '''This function transforms a string into an int with any '.' removed.
+    
+    Parameters:
+        x (str): A string of a number
+        
+    Returns:
+        int: An int of the input with any '.' removed'''
+
+    return int(x.replace('.', ''))
+
+
+def _check_strings(column, method):
+    '''Raises the AttributeError that to_100 and convert_int raise when a value is not a string (e.g.
+    178797615.0, which would otherwise be read as '178797615.0' and lose its decimal point).'''
+
+    if infer_dtype(column, skipna=False) not in ('string', 'empty'):
+        value = next(value for value in column if not isinstance(value, str))
+        raise AttributeError(f"'{type(value).__name__}' object has no attribute '{method}'")
+
+
+@logger
+def to_100_column(column):
+    '''This function is the column-at-a-time version of to_100. It takes in
+    a Series of strings of numbers and returns a Series of floats with 2-3
+    digits, with exactly the same values to_100 would return for each element,
+    and the same exceptions (e.g. for values that are not strings).
+
+    Parameters:
+        column: Pandas Series of strings containing numbers separated by periods
+
+    Returns:
+        Series: a float64 Series of the numbers rounded to 3 digits (in the
+        hundreds), sharing the index of the input'''
+
+    if column.empty:
+        return pd.Series([], index=column.index, name=column.name, dtype=np.float64)
+
+    _check_strings(column, 'split')
+
+    # split every value into the text before the first '.' and the text between the first and second '.'
+    parts = column.str.partition('.')
+    head, has_dot = parts[0], (parts[1] != '').values
+    second = parts[2].str.partition('.')[0]
+    joined = head + second
+
+    starts_with_1 = head.str.startswith('1').values
+    is_long = (head.str.len() > 2).values
+
+    # to_100 fails with an IndexError whenever it needs the second piece of a value without a '.'
+    if (~has_dot & (starts_with_1 | ~is_long)).any():
+        raise IndexError('list index out of range')
+
+    # the four branches of to_100, evaluated over the whole column
+    values = np.select([starts_with_1 & is_long, starts_with_1, is_long],
+                       [(head + '.' + second).values,
+                        (joined.str[:3] + '.' + joined.str[3:]).values,
+                        (head.str[:2] + '.' + head.str[-1]).values],
+                       default=(joined.str[:2] + '.' + joined.str[2:]).values)
+
+    return pd.Series(values.astype(np.float64), index=column.index, name=column.name)
+
+
+@logger
+def convert_int_column(column):
+    '''This function is the column-at-a-time version of convert_int. It
+    transforms a Series of strings into ints with any '.' removed, and raises
+    the same exceptions as convert_int (e.g. for values that are not strings).
+
+    Parameters:
+        column: Pandas Series of strings of numbers
+
+    Returns:
+        Series: an int64 Series of the input with any '.' removed, sharing
+        the index of the input'''
+
+    if column.empty:
+        return pd.Series([], index=column.index, name=column.name, dtype=np.int64)
+    _check_strings(column, 'replace')
+
+    return column.str.replace('.', '', regex=False).astype(np.int64)
+
+
+@logger
+def prep_precipitaciones(precipitaciones):
+    '''This function prepares the precipitaciones data to train the model and
+    it can also be used to prepare data for predictions
+    
+    Parameters:
+        precipitaciones: Pandas DataFrame of the raw precipitaciones dataset
+        
+    Returns:
+        precipitaciones: Pandas DataFrame of the precipitaciones dataset
+        after variable processing'''
+
+    precipitaciones['date'] = pd.to_datetime(precipitaciones['date'], format='%Y-%m-%d')
+    precipitaciones = precipitaciones.sort_values(by='date', ascending=True).reset_index(drop=True)
+    precipitaciones.dropna(how='any', axis=0)
+    precipitaciones.drop_duplicates(subset='date')
+
+    return precipitaciones
+
+
+@logger
+def prep_banco_central(banco_central):
+    '''This function prepares the banco_central data to train the model, and
+    it can also be used to prepare data for predictions
+    
+    Parameters:
+        banco_central: Pandas DataFrame of the raw banco_central dataset
+        
+    Returns:
+        banco_central: Pandas DataFrame of the banco_central dataset
+        after variable processing and feature engineering'''
+
+    banco_central['Periodo'] = banco_central['Periodo'].apply(lambda x: x[:10])
+    banco_central['Periodo'] = pd.to_datetime(banco_central['Periodo'], format='%Y-%m-%d', errors='coerce')
+    banco_central.drop_duplicates(subset='Periodo', inplace=True)
+    banco_central = banco_central[~banco_central.Periodo.isna()]
+    
+    # Preprocessing PIB columns: 
+    # 1. create dataframe slice
+    cols_pib = [x for x in list(banco_central.columns) if 'PIB' in x]
+    cols_pib.extend(['Periodo'])
+    banco_central_pib = banco_central[cols_pib]
+    banco_central_pib = banco_central_pib.dropna(how = 'any', axis = 0)
+  
+    # 2. convert to int
+    for col in cols_pib:
+        if col != 'Periodo':
+            banco_central_pib[col] = convert_int_column(banco_central_pib[col])
+
+    # Preprocessing Imacec columns: 
+    # 1. create dataframe slice
+    cols_imacec = [x for x in list(banco_central.columns) if 'Imacec' in x]
+    cols_imacec.extend(['Periodo'])
+    banco_central_imacec = banco_central[cols_imacec]
+    banco_central_imacec = banco_central_imacec.dropna(how = 'any', axis = 0)
+    # 2. remove periods and transform to float
+    for col in cols_imacec:
+        if col != 'Periodo': 
+            banco_central_imacec[col] = to_100_column(banco_central_imacec[col])
+
+    # Preprocessing IVCM columns: 
+    # 1. create slice; 2. drop NaNs; 3. create new feature 'num'
+    banco_central_iv = banco_central[['Indice_de_ventas_comercio_real_no_durables_IVCM', 'Periodo']]
+    banco_central_iv = banco_central_iv.dropna() # -unidades? #parte 
+    banco_central_iv.sort_values(by = 'Periodo', ascending=True)
+    banco_central_iv['num'] = to_100_column(banco_central_iv['Indice_de_ventas_comercio_real_no_durables_IVCM'])
+
+    # Merge slices together, then return final dataframe
+    banco_central_num = pd.merge(banco_central_pib, banco_central_imacec, on = 'Periodo', how = 'inner')
+    banco_central_num = pd.merge(banco_central_num, banco_central_iv, on = 'Periodo', how = 'inner')
+
+    return banco_central_num
+
+
+def banco_central_columns():
+    '''This function returns the columns of banco_central.csv used by prep_banco_central to prepare
+    the model variables: Periodo, the PIB and Imacec columns and the IVCM column used to create 'num'.'''
+
+    return [col for col in cols_banco_central
+            if col == 'Periodo' or 'PIB' in col or 'Imacec' in col or col == 'Indice_de_ventas_comercio_real_no_durables_IVCM']
+
+
+@logger
+def load_banco_central(path=None, chunksize=BANCO_CENTRAL_CHUNK_SIZE):
+    '''This function reads and prepares the banco_central dataset chunksize rows at a time, so
+    that memory use does not grow with the size of the file. Only the columns returned by
+    banco_central_columns are read, and each chunk goes through prep_banco_central.
+    The result is the same as prep_banco_central(pd.read_csv(path, dtype=str)):
+    - a Periodo already seen in a previous chunk is dropped, like drop_duplicates does, and
+    rows with a Periodo that cannot be parsed are dropped
+    - every value is read as the string in the file, also in a column that only contains numbers
+    (e.g. '101'), which pd.read_csv would otherwise read as numbers, which to_100 and convert_int reject
+    
+    Parameters:
+        path (str): path of the banco_central csv file, defaults to DATA_FILES['banco_central']
+        chunksize (int): number of rows read at a time
+        
+    Returns:
+        banco_central: Pandas DataFrame of the banco_central dataset after variable processing
+        and feature engineering'''
+
+    path = path or DATA_FILES['banco_central']
+    seen = set()
+    parts = []
+
+    for chunk in pd.read_csv(path, usecols=banco_central_columns(), dtype=str, chunksize=chunksize):
+        # drops the periods of previous chunks, duplicates within the chunk are dropped by prep_banco_central
+        periodo = pd.to_datetime(chunk['Periodo'].apply(lambda x: x[:10]), format='%Y-%m-%d', errors='coerce')
+        new = ~periodo.isin(seen) & periodo.notna()
+        seen.update(periodo[new])
+        parts.append(prep_banco_central(chunk[new]))
+
+    # empty chunks would turn the numeric columns into object columns, and a file without rows has no chunks
+    parts = [part for part in parts if len(part)] or [prep_banco_central(pd.read_csv(path, usecols=banco_central_columns(),
+                                                                                      dtype=str, nrows=0))]
+    return pd.concat(parts, ignore_index=True)
+
+
+@logger
+def period_key(dates):
+    '''This function computes the integer period key (year * 12 + month) used to join
+    the datasets by month.
+
+    Parameters:
+        dates: Pandas Series of datetimes
+
+    Returns:
+        numpy array of int64 with the period of each date'''
+
+    return dates.dt.year.to_numpy(dtype=np.int64) * 12 + dates.dt.month.to_numpy(dtype=np.int64)
+
+
+@logger
+def join_on_period(left, left_period, right, right_period):
+    '''This function joins two DataFrames on their period keys, giving the same result as an
+    inner pd.merge on the year and month columns. The right keys are sorted once and each left
+    key is found with a binary search, so no hash table of keys is built.
+
+    Parameters:
+        left, right: Pandas DataFrames to join, the columns of right are added after the columns of left
+        left_period, right_period: numpy arrays of the period key of each row of left and right
+
+    Returns:
+        DataFrame: one row for each pair of rows of left and right with the same period'''
+
+    order = np.argsort(right_period, kind='stable')
+    sorted_period = right_period[order]
+    # like pd.merge, rows of left with the same period are kept together, in order of first appearance
+    left_rows = np.argsort(pd.factorize(left_period)[0], kind='stable')
+    starts = np.searchsorted(sorted_period, left_period[left_rows], side='left')
+    counts = np.searchsorted(sorted_period, left_period[left_rows], side='right') - starts
+
+    left_index = np.repeat(left_rows, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right_index = order[np.repeat(starts, counts) + offsets]
+
+    return pd.concat([left.take(left_index).reset_index(drop=True),
+                      right.take(right_index).reset_index(drop=True)], axis=1)
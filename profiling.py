@@ -0,0 +1,190 @@
+import io
+import os
+import re
+import json
+import time
+import uuid
+import random
+import pstats
+import cProfile
+
+
+# Profiling settings, these can be overridden with environment variables when the service is deployed.
+# A request is profiled when it has the PROFILE_HEADER header and the admin token (see app.py), or, with a
+# PROFILE_SAMPLE_RATE above 0, at random with that probability. The PROFILE_MAX_FILES most recent profiles
+# are kept in PROFILE_DIR, older ones are deleted.
+PROFILE_HEADER = 'X-Profile'
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+
+# Number of functions listed in the text reports, and the orders they can be sorted in
+REPORT_LIMIT = 40
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls', 'pcalls', 'filename', 'name')
+
+# Profile ids are '<nanoseconds since the epoch>-<request id>', so that they sort by time across worker processes
+PROFILE_ID = re.compile(r'^[0-9]{19,}-[A-Za-z0-9_-]{1,64}$')
+REQUEST_ID = re.compile(r'[^A-Za-z0-9_-]')
+
+
+def sampled(rate=PROFILE_SAMPLE_RATE):
+    '''Returns True with probability rate, to profile a random sample of the requests.'''
+
+    return rate > 0 and random.random() < rate
+
+
+def request_id(header=None):
+    '''Returns the request id given in a header (only letters, digits, '-' and '_' are kept), or a new
+    random one.'''
+
+    request_id = REQUEST_ID.sub('', header or '')[:64]
+    return request_id or uuid.uuid4().hex[:16]
+
+
+class ProfileStore:
+    '''This class keeps the profiles of single requests in a directory, as a ring of the max_files
+    most recent ones. Each profile is saved in the pstats format (<id>.prof, which can be opened with
+    pstats, snakeviz, etc.), next to a JSON file with its request id, endpoint, number of input rows
+    and duration (<id>.json). The files are written to a temporary name and renamed, and nothing is
+    kept in memory, so several worker processes (see serve.py) can share the same directory.
+
+    Attributes:
+        directory: the directory of the profiles, created when the first profile is saved
+        max_files: the number of profiles kept
+
+    Methods:
+        start: starts profiling the calling thread
+        new_id: returns the id of a new profile
+        save: stops a profiler and saves its profile
+        list: returns the metadata of every profile kept, most recent first
+        get: returns the metadata of a profile
+        path: returns the path of the pstats file of a profile
+        report: returns a profile as text, as printed by pstats
+    '''
+
+    def __init__(self, directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES):
+        self.directory = directory
+        self.max_files = max_files
+
+
+    @staticmethod
+    def start():
+        '''Returns a cProfile.Profile that is profiling the calling thread, until save is called.'''
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+
+    @staticmethod
+    def new_id(request_id):
+        '''Returns the id of a new profile of the request request_id. It can be given to save, to know
+        the id of a profile before it is saved (e.g. for a streamed response).'''
+
+        return f'{time.time_ns()}-{request_id}'
+
+
+    def save(self, profiler, request_id, profile_id=None, **metadata):
+        '''This function stops profiler, saves its profile with its metadata, and deletes the oldest
+        profiles beyond max_files.
+
+        Parameters:
+            profiler: the cProfile.Profile returned by start
+            request_id (str): the id of the profiled request (see request_id)
+            profile_id (str): the id of the profile, returned by new_id, or None for a new one
+            metadata: other values saved with the profile (e.g. endpoint, rows, seconds)
+
+        Returns:
+            profile_id: the id of the profile, used to retrieve it'''
+
+        profiler.disable()
+        os.makedirs(self.directory, exist_ok=True)
+        profile_id = profile_id or self.new_id(request_id)
+
+        for extension, write in (('.prof', profiler.dump_stats),
+                                 ('.json', lambda path: _write_json(path, dict(metadata, id=profile_id, request_id=request_id,
+                                                                               created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                                               pid=os.getpid())))):
+            path = os.path.join(self.directory, profile_id + extension)
+            write(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+        self._trim()
+        return profile_id
+
+
+    def _ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len('.json')] for name in names if name.endswith('.json') and PROFILE_ID.match(name[:-len('.json')]))
+
+
+    def _trim(self):
+        ids = self._ids()
+        for profile_id in ids[:max(len(ids) - self.max_files, 0)]:
+            for extension in ('.json', '.prof'):
+                try:
+                    os.remove(os.path.join(self.directory, profile_id + extension))
+                except FileNotFoundError:
+                    # another worker deleted it first
+                    pass
+
+
+    def list(self):
+        '''Returns the metadata of every profile kept, most recent first.'''
+
+        profiles = (self.get(profile_id) for profile_id in reversed(self._ids()))
+        return [profile for profile in profiles if profile is not None]
+
+
+    def get(self, profile_id):
+        '''Returns the metadata of a profile as a dict, or None if there is no such profile.'''
+
+        if not PROFILE_ID.match(profile_id):
+            return None
+        try:
+            with open(os.path.join(self.directory, profile_id + '.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def path(self, profile_id):
+        '''Returns the path of the pstats file of a profile, or None if there is no such profile.'''
+
+        path = os.path.join(self.directory, profile_id + '.prof')
+        return path if PROFILE_ID.match(profile_id) and os.path.exists(path) else None
+
+
+    def report(self, profile_id, sort='cumulative', limit=REPORT_LIMIT, pattern=None):
+        '''This function returns a profile as text: its metadata, then the limit functions that come
+        first in the sort order, as printed by pstats.
+
+        Parameters:
+            profile_id (str): the id of the profile
+            sort (str): one of SORT_KEYS
+            limit (int): number of functions listed
+            pattern (str): a regular expression, only the functions whose file or name match it are listed
+            (e.g. 'predict|preprocessing')
+
+        Returns:
+            str: the report, or None if there is no such profile'''
+
+        assert sort in SORT_KEYS, f"sort must be one of {', '.join(SORT_KEYS)}"
+        metadata, path = self.get(profile_id), self.path(profile_id)
+        if metadata is None or path is None:
+            return None
+
+        stream = io.StringIO()
+        stream.write(''.join(f'{key}: {value}\n' for key, value in metadata.items()))
+        stats = pstats.Stats(path, stream=stream)
+        stats.sort_stats(sort).print_stats(*([pattern] if pattern else []), limit)
+
+        return stream.getvalue()
+
+
+def _write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
@@ -0,0 +1,177 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype
+
+import metrics
+from preprocessing import cols, cols_precipitaciones, cols_banco_central
+
+
+# Types of values (see pandas.api.types.infer_dtype) accepted for the banco_central columns, which are strings of
+# digits separated by periods (e.g. '101.421.423'). Numbers are rejected: the periods are thousands separators in some
+# columns and decimal points in others (see preprocessing.to_100), which a number like 101421.423 cannot tell apart
+DOTTED_TYPES = ('string', 'empty')
+
+# Maximum number of row positions listed in each error message
+MAX_ERROR_ROWS = 10
+
+
+class SchemaError(ValueError):
+    '''Raised when a request does not match the input schema. The errors attribute lists every
+    problem found in the request, not only the first one.'''
+
+    def __init__(self, errors):
+        super().__init__(f'The request has {len(errors)} error(s): ' + ' '.join(errors))
+        self.errors = errors
+
+
+def _rows(mask):
+    rows = np.flatnonzero(mask)
+    listed = ', '.join(str(row) for row in rows[:MAX_ERROR_ROWS])
+    return listed + (f' and {len(rows) - MAX_ERROR_ROWS} more' if len(rows) > MAX_ERROR_ROWS else '')
+
+
+class InputSchema:
+    '''This class validates columnar prediction requests ({"column": [values...]}) and turns them
+    into the DataFrame used by the predictor. The checks of every column are compiled once when
+    the schema is created, so each request only pays for set operations and whole-column
+    conversions, and every error of the request is reported at once.
+
+    Attributes:
+        columns: the columns of the DataFrames built, in the order of cols_precipitaciones and cols_banco_central
+        required: the columns the predictions depend on, a request without any of them is rejected
+        kinds: the kind of values of each column ('date', 'periodo', 'number', 'dotted' or 'other')
+
+    Methods:
+        is_columnar: True if a JSON payload is in the columnar format
+        to_frame: validates a columnar payload and returns it as a DataFrame
+    '''
+
+    def __init__(self):
+        self.columns = cols_precipitaciones + [col for col in cols_banco_central if col not in cols_precipitaciones]
+        # The IVCM column is not in cols but is used to create the 'num' variable
+        self._required_order = cols + ['Indice_de_ventas_comercio_real_no_durables_IVCM']
+        self.required = frozenset(self._required_order)
+
+        self.kinds = {}
+        for col in self.columns:
+            if col == 'date':
+                self.kinds[col] = 'date'
+            elif col == 'Periodo':
+                self.kinds[col] = 'periodo'
+            elif col in cols_precipitaciones:
+                self.kinds[col] = 'number'
+            elif col in self.required:
+                self.kinds[col] = 'dotted'
+            else:
+                self.kinds[col] = 'other'
+
+        self._convert = {'date': self._check_date, 'periodo': self._check_periodo, 'number': self._to_number,
+                         'dotted': self._check_dotted, 'other': lambda col, values, errors: values}
+
+
+    @staticmethod
+    def is_columnar(payload):
+        '''Returns True if payload is a dict with at least one list of values, rather than the
+        {"column": {"index": value}} format of DataFrame.to_json or a list of rows.'''
+
+        return isinstance(payload, dict) and any(isinstance(values, list) for values in payload.values())
+
+
+    @metrics.timed('validate_schema')
+    def to_frame(self, payload):
+        '''This function checks a columnar payload against the schema and converts it to a DataFrame.
+        Columns that are not used by the predictions may be left out (they are filled with nulls),
+        and columns that are not in the schema are ignored.
+
+        Parameters:
+            payload: a dict with a list of values for each column
+
+        Returns:
+            data: a DataFrame with one row per value and the columns of self.columns
+
+        Raises:
+            SchemaError: with the list of every problem found in the payload'''
+
+        errors = []
+
+        not_lists = sorted(col for col, values in payload.items() if not isinstance(values, list))
+        if not_lists:
+            errors.append(f'The values of the following columns are not lists: {not_lists}.')
+
+        missing_cols = self.required.difference(payload)
+        if missing_cols:
+            missing = [col for col in self._required_order if col in missing_cols]
+            errors.append(f'The following columns were missing in the request: {missing}.')
+
+        lengths = pd.Series({col: len(values) for col, values in payload.items()
+                             if col in self.kinds and isinstance(values, list)}, dtype=np.int64)
+        n_rows = int(lengths.mode().max()) if not lengths.empty else 0
+        uneven = lengths[lengths != n_rows]
+        if not uneven.empty:
+            errors.append(f'All columns must have the same number of values ({n_rows}), but the following do not: '
+                          f'{dict(uneven.items())}.')
+        elif not lengths.empty and n_rows == 0:
+            errors.append('There are no rows to predict, the lists of values are empty.')
+
+        data = {}
+        for col in self.columns:
+            values = payload.get(col)
+            # copying the values into an object array never makes a 2-dimensional array out of nested lists
+            array = np.full(n_rows, None, dtype=object)
+            if isinstance(values, list) and len(values) == n_rows:
+                array[:] = values
+                data[col] = self._convert[self.kinds[col]](col, array, errors)
+            else:
+                data[col] = array
+
+        if errors:
+            raise SchemaError(errors)
+
+        return pd.DataFrame(data, columns=self.columns)
+
+
+    @staticmethod
+    def _check_date(col, values, errors):
+        bad = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce').isna() & ~pd.isna(values)
+        if bad.any():
+            errors.append(f"'{col}' must be a date in the format YYYY-MM-DD, in rows {_rows(bad)}.")
+        return values
+
+
+    @staticmethod
+    def _check_periodo(col, values, errors):
+        # 'empty' is only inferred when there are no rows, which to_frame reports on its own
+        if infer_dtype(values, skipna=False) not in ('string', 'empty'):
+            bad = [not isinstance(value, str) for value in values]
+            errors.append(f"'{col}' must be a string starting with a date in the format YYYY-MM-DD, in rows {_rows(bad)}.")
+        return values
+
+
+    @staticmethod
+    def _to_number(col, values, errors):
+        try:
+            return values.astype(np.float64)
+        except (TypeError, ValueError):
+            # nulls, or values that are not numbers
+            bad = [not _is_float(value) for value in values]
+            if any(bad):
+                errors.append(f"'{col}' must be a number, in rows {_rows(bad)}.")
+            return pd.to_numeric(values, errors='coerce').astype(np.float64)
+
+
+    @staticmethod
+    def _check_dotted(col, values, errors):
+        # the contents of the strings are only checked when they are converted, since the rows
+        # with missing values are dropped before (as with DataFrame.to_json requests)
+        if infer_dtype(values, skipna=True) not in DOTTED_TYPES:
+            bad = [not (isinstance(value, str) or value is None) for value in values]
+            errors.append(f"'{col}' must be a string of digits separated by periods, in rows {_rows(bad)}.")
+        return values
+
+
+def _is_float(value):
+    try:
+        float(value)
+        return True
+    except (TypeError, ValueError):
+        return value is None
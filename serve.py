@@ -0,0 +1,242 @@
+import os
+
+
+def available_cpus():
+    '''Returns the number of cores the process may run on, which can be fewer than the cores of the
+    machine in a container.'''
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# Settings of the production server, these can be overridden with environment variables when the service is deployed.
+# SERVE_WORKERS processes (one per available core by default) accept the connections of SERVE_HOST:SERVE_PORT. Each
+# worker handles one request at a time, unless SERVE_THREADED is set (which micro-batching needs, see batching.py).
+# Workers that are stopped get SERVE_GRACEFUL_TIMEOUT seconds to finish their requests before they are killed.
+SERVE_HOST = os.environ.get('SERVE_HOST', '0.0.0.0')
+SERVE_PORT = int(os.environ.get('SERVE_PORT', 5000))
+SERVE_WORKERS = int(os.environ.get('SERVE_WORKERS', 0)) or available_cpus()
+SERVE_THREADED = os.environ.get('SERVE_THREADED', '0') not in ('', '0')
+SERVE_BACKLOG = int(os.environ.get('SERVE_BACKLOG', 128))
+SERVE_GRACEFUL_TIMEOUT = float(os.environ.get('SERVE_GRACEFUL_TIMEOUT', 30))
+
+# Number of threads of the BLAS and OpenMP libraries in each worker. The workers already use every core, so
+# more threads per worker would only compete with each other. The libraries read these variables when they
+# are loaded, so they are set before numpy is imported (variables that are already set are kept).
+SERVE_BLAS_THREADS = os.environ.get('SERVE_BLAS_THREADS', '1')
+BLAS_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+for variable in BLAS_THREAD_VARIABLES:
+    os.environ.setdefault(variable, SERVE_BLAS_THREADS)
+
+import gc
+import time
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+from werkzeug.serving import make_server
+
+# importing the app loads the model, the forecasts and the input schema once, in the master process
+import app as app_module
+import metrics
+import log_utils
+
+
+# Set log configurations
+log = log_utils.get_log(__name__, 'logs/serve.log')
+
+
+def run_worker(sock, threaded):
+    '''This function runs in each worker process, forked from the master with the app already loaded.
+    It serves requests from the listening socket of the master until it gets SIGTERM or SIGINT,
+    then finishes the requests in progress and exits. It never returns.
+
+    Parameters:
+        sock: the listening socket shared by every worker
+        threaded (bool): True to handle each request in its own thread'''
+
+    status = 0
+    try:
+        server = make_server(SERVE_HOST, SERVE_PORT, app_module.app, threaded=threaded, fd=sock.fileno())
+        # request threads are waited for when the server is closed
+        server.daemon_threads = False
+
+        # serve_forever only stops when shutdown is called from another thread
+        stop = lambda signum, frame: threading.Thread(target=server.shutdown, daemon=True).start()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        # a model loaded through /admin/reload/ in this worker is loaded by the master and every worker is replaced
+        master = os.getppid()
+        app_module.reload_callbacks.append(lambda version: os.kill(master, signal.SIGHUP))
+
+        server.serve_forever()
+        server.server_close()
+    except BaseException:
+        log.exception('Worker %s failed', os.getpid())
+        status = 1
+    finally:
+        # the worker must not return into the code of the master it was forked from
+        try:
+            metrics.flush()
+        except OSError:
+            log.exception('Could not save the metrics of worker %s', os.getpid())
+        log_utils.stop_listeners()
+        os._exit(status)
+
+
+class PreforkServer:
+    '''This class is the master process of the production server. The app (and so the model) is
+    loaded once by the master, which then forks the worker processes: the workers share the memory
+    of the model copy-on-write instead of loading a copy each, and start in milliseconds.
+
+    The master only watches the workers. A worker that dies is replaced. On SIGHUP, or when the
+    model or the forecasts of the master change (e.g. through MODEL_WATCH_INTERVAL or /admin/reload/
+    in a worker), the master loads the current model and replaces every worker: the new workers start
+    before the old ones are stopped, and the old ones finish their requests first, so no request is
+    dropped. On SIGTERM or SIGINT, the workers are stopped the same way and the master exits.
+
+    The workers share their metrics through a temporary directory (see metrics.share), so /metrics
+    returns the metrics of the whole server whichever worker answers it, and send their log records
+    to the master, which writes every log file (see log_utils.receive_from_forks).
+
+    Attributes:
+        workers: number of worker processes
+        generation: number of times the workers were replaced
+        pids: the generation of each running worker, by process id
+
+    Methods:
+        run: serves until SIGTERM or SIGINT
+    '''
+
+    def __init__(self, host=SERVE_HOST, port=SERVE_PORT, workers=SERVE_WORKERS, threaded=SERVE_THREADED,
+                 graceful_timeout=SERVE_GRACEFUL_TIMEOUT):
+        self.host, self.port = host, port
+        self.workers = workers
+        self.threaded = threaded
+        self.graceful_timeout = graceful_timeout
+        self.generation = 0
+        self.pids = {}
+        self._started = {}
+        self._deadlines = {}
+        self._signals = []
+        self._served = None
+        self.socket = None
+        self.metrics_dir = None
+
+
+    def run(self):
+        '''Listens on host:port, forks the workers and supervises them until SIGTERM or SIGINT.'''
+
+        self.socket = socket.create_server((self.host, self.port), backlog=SERVE_BACKLOG)
+        self.metrics_dir = tempfile.mkdtemp(prefix='leche-metrics-')
+        metrics.share(self.metrics_dir)
+        log_utils.receive_from_forks()
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+
+        self._prepare_fork()
+        log.info('Serving %s:%s with %s workers (threaded: %s), model version %s', self.host, self.port, self.workers,
+                 self.threaded, app_module.predictor.version)
+
+        while True:
+            self._reap()
+            received, self._signals = self._signals, []
+            if signal.SIGTERM in received or signal.SIGINT in received:
+                break
+            if signal.SIGHUP in received or self._served != (app_module.predictor, app_module.forecasts):
+                self._restart(reload=signal.SIGHUP in received)
+
+            current = [pid for pid, generation in self.pids.items() if generation == self.generation]
+            for _ in range(self.workers - len(current)):
+                self._spawn()
+            time.sleep(0.1)
+
+        self._stop()
+
+
+    def _prepare_fork(self):
+        # objects that exist before the fork are moved out of the reach of the garbage collector, whose
+        # passes would otherwise write to them and make each worker copy the memory pages they are in
+        gc.collect()
+        gc.freeze()
+        self._served = (app_module.predictor, app_module.forecasts)
+
+
+    def _spawn(self):
+        # the locks of the app are held during the fork, so a worker is never forked while the model
+        # watcher thread of the master holds them (they would stay locked forever in the worker)
+        with app_module.reload_lock, app_module.forecast_lock:
+            pid = os.fork()
+        if pid == 0:
+            run_worker(self.socket, self.threaded)
+
+        self.pids[pid] = self.generation
+        self._started[pid] = time.monotonic()
+
+
+    def _terminate(self, pids):
+        for pid in pids:
+            if pid not in self._deadlines:
+                self._deadlines[pid] = time.monotonic() + self.graceful_timeout
+                os.kill(pid, signal.SIGTERM)
+
+
+    def _reap(self):
+        # collects the workers that exited, and kills the stopped workers that are past their deadline
+        while self.pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            generation = self.pids.pop(pid, None)
+            started = self._started.pop(pid, time.monotonic())
+            metrics.retire(pid)
+            if self._deadlines.pop(pid, None) is None and generation == self.generation:
+                log.warning('Worker %s exited unexpectedly with status %s', pid, os.waitstatus_to_exitcode(status))
+                # a worker that fails as soon as it starts would otherwise be replaced in a busy loop
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+
+        now = time.monotonic()
+        for pid, deadline in list(self._deadlines.items()):
+            if now > deadline and pid in self.pids:
+                log.warning('Worker %s did not stop within %s seconds and was killed', pid, self.graceful_timeout)
+                os.kill(pid, signal.SIGKILL)
+                self._deadlines[pid] = float('inf')
+
+
+    def _restart(self, reload):
+        # replaces every worker with a worker forked from the current state of the master
+        if reload:
+            try:
+                if not app_module.reload_predictor():
+                    app_module.refresh_forecasts()
+            except Exception:
+                log.exception('Could not reload the model, the workers are restarted with version %s',
+                              app_module.predictor.version)
+
+        old = list(self.pids)
+        self.generation += 1
+        self._prepare_fork()
+        for _ in range(self.workers):
+            self._spawn()
+        self._terminate(old)
+        log.info('Restarted the workers (generation %s) with model version %s', self.generation, app_module.predictor.version)
+
+
+    def _stop(self):
+        self._terminate(list(self.pids))
+        while self.pids:
+            self._reap()
+            time.sleep(0.1)
+        self.socket.close()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        log.info('Stopped')
+
+
+if __name__ == '__main__':
+    PreforkServer().run()
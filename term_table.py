@@ -0,0 +1,105 @@
+import numpy as np
+
+
+# Number of (row, term) values evaluated at once, this bounds the memory used by evaluate
+MAX_CHUNK_VALUES = 1_000_000
+
+
+def compile_pipeline(model, X=None, tolerance=0.0, model_sha256=''):
+    '''This function compiles a fitted StandardScaler -> SelectKBest -> PolynomialFeatures -> Ridge
+    pipeline into a term table: the scaler constants of the selected variables, and one row of
+    exponents and one coefficient per polynomial term. Terms are pruned when their contribution is
+    negligible, so that evaluating the table only costs as much as the terms that matter.
+
+    The contribution of a term to a prediction is its coefficient times its value, which is
+    measured on every row of the training data X. Terms are considered from the smallest largest
+    contribution up, and a term is dropped when, together with the terms already dropped, the
+    largest absolute change of the predictions over the rows of X stays within tolerance. The
+    largest change is stored as error_bound: it is exact on the training rows, and inputs like
+    the training data change by about as much.
+
+    Parameters:
+        model: the fitted sklearn pipeline
+        X: the training data (a DataFrame or array in the order of the model variables). Without
+        it only the terms with a coefficient of exactly 0 are pruned
+        tolerance (float): maximum absolute change of the predictions on X allowed by pruning
+        model_sha256 (str): hash of the serialized pipeline the table is compiled from
+
+    Returns:
+        table: a dict of numpy arrays describing the pruned polynomial'''
+
+    scaler = model.named_steps['scale']
+    features = model.named_steps['selector'].get_support(indices=True)
+    means = scaler.mean_[features] if scaler.with_mean else np.zeros(len(features))
+    scales = scaler.scale_[features] if scaler.with_std else np.ones(len(features))
+    exponents = model.named_steps['poly'].powers_
+    coef = model.named_steps['model'].coef_
+
+    if X is None:
+        keep = coef != 0
+        error_bound = 0.0
+    else:
+        scaled = (np.asarray(X, dtype=np.float64)[:, features] - means) / scales
+        contributions = np.ones((len(scaled), len(coef)))
+        for i in range(scaled.shape[1]):
+            contributions *= scaled[:, i, None] ** exponents[:, i]
+        contributions *= coef
+        largest = np.abs(contributions).max(axis=0, initial=0.0)
+
+        keep = np.ones(len(coef), dtype=bool)
+        dropped = np.zeros(len(scaled))
+        error_bound = 0.0
+        for term in np.argsort(largest, kind='stable'):
+            # no term left can be dropped on its own
+            if largest[term] > tolerance:
+                break
+            error = np.abs(dropped + contributions[:, term]).max(initial=0.0)
+            if error <= tolerance:
+                dropped += contributions[:, term]
+                keep[term] = False
+                error_bound = error
+
+    return {'features': features,
+            'means': means,
+            'scales': scales,
+            'exponents': exponents[keep],
+            'coef': coef[keep],
+            'intercept': np.float64(model.named_steps['model'].intercept_),
+            'n_inputs': np.int64(len(scaler.mean_)),
+            'n_terms_total': np.int64(len(coef)),
+            'tolerance': np.float64(tolerance),
+            'error_bound': np.float64(error_bound),
+            'model_sha256': np.str_(model_sha256)}
+
+
+def evaluate(table, values):
+    '''This function makes predictions directly from a term table. Rows are evaluated in chunks
+    so that memory use is bounded, and only the terms kept in the table are computed.
+
+    Parameters:
+        table: a dict returned by compile_pipeline or model_store.load
+        values: a float64 array with one row per prediction, in the order of the model variables
+
+    Returns:
+        predictions: a numpy array with one prediction per row'''
+
+    values = np.ascontiguousarray(values, dtype=np.float64).reshape(-1, int(table['n_inputs']))
+    # The sklearn pipeline rejects missing or infinite values in any of its inputs, so the table does too
+    if not np.isfinite(values).all():
+        raise ValueError('Input X contains NaN.' if np.isnan(values).any() else
+                         "Input X contains infinity or a value too large for dtype('float64').")
+    scaled = (values[:, table['features']] - table['means']) / table['scales']
+    exponents, coef = table['exponents'], table['coef']
+
+    predictions = np.empty(len(scaled))
+    chunk_rows = max(1, MAX_CHUNK_VALUES // max(1, len(coef)))
+    for start in range(0, len(scaled), chunk_rows):
+        chunk = scaled[start:start + chunk_rows]
+        # Each polynomial term is the product of the selected variables raised to their exponents
+        terms = np.ones((len(chunk), len(coef)))
+        for i in range(chunk.shape[1]):
+            terms *= chunk[:, i, None] ** exponents[:, i]
+        predictions[start:start + chunk_rows] = terms @ coef + table['intercept']
+
+    return predictions
+
@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+import pytest
+
+
+def pytest_configure(config):
+    # the modules read these when they are imported, before any fixture runs, so they are set when pytest starts:
+    # the logs, the model store and the profiles of the tests go to a temporary directory, which keeps the files in
+    # logs/ as they are, and the app uses model/leche_predictor.pkl
+    config.tmp_dir = tempfile.mkdtemp(prefix='leche-tests-')
+    for name, folder in [('LOG_DIR', 'logs'), ('MODEL_STORE_DIR', 'store'), ('PROFILE_DIR', 'profiles')]:
+        os.environ[name] = os.path.join(config.tmp_dir, folder)
+    os.makedirs(os.environ['LOG_DIR'])
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(config.tmp_dir, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def rows():
+    '''The rows of data/ with the precipitaciones and banco_central values of the same month.'''
+
+    # imported here, since the modules set up their logs when they are imported
+    import pandas as pd
+    from preprocessing import DATA_FILES
+
+    precipitaciones = pd.read_csv(DATA_FILES['precipitaciones'])
+    banco_central = pd.read_csv(DATA_FILES['banco_central']).drop_duplicates('Periodo')
+    precipitaciones['month'], banco_central['month'] = precipitaciones['date'].str[:7], banco_central['Periodo'].str[:7]
+    return banco_central.merge(precipitaciones, on='month').drop(columns='month')
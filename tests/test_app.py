@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import pickle
+import subprocess
+import pytest
+
+import app
+import model_store
+import term_table
+
+
+# Imports the app, predicts a row and prints the training modules that were imported
+STARTUP_SCRIPT = '''
+import sys, json, app
+row = json.loads(sys.stdin.read())
+response = app.app.test_client().get('/get_predict/', query_string=row)
+print(json.dumps({'prediction': json.loads(response.get_data())[0]['prediction'], 'report': app.startup_report,
+                  'loaded': [name for name in ('train', 'sklearn', 'scipy', 'joblib') if name in sys.modules]}))
+'''
+
+
+@pytest.fixture(scope='module')
+def client():
+    return app.app.test_client()
+
+
+@pytest.fixture(scope='module')
+def expected(rows):
+    '''The prediction of each (ano, mes) of the rows.'''
+
+    data = app.predictor.make_prediction(*app.predictor.separate_new_data(rows))
+    return {(int(ano), int(mes)): prediction for ano, mes, prediction in zip(data['ano'], data['mes'], data['prediction'])}
+
+
+@pytest.fixture(scope='module')
+def valid(rows, expected):
+    '''The rows that have a prediction.'''
+
+    return rows[[(int(date[:4]), int(date[5:7])) in expected for date in rows['date']]]
+
+
+def _lines(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def _bulk(client, body, content_type='application/x-ndjson', chunk_size=10):
+    return client.post(f'/bulk_predict/?chunk_size={chunk_size}', data=body, content_type=content_type)
+
+
+@pytest.mark.parametrize('content_type', ['application/x-ndjson', 'text/csv'])
+def test_bulk_predict(client, valid, expected, content_type):
+    body = valid.to_json(orient='records', lines=True) if content_type != 'text/csv' else valid.to_csv(index=False)
+    lines = _lines(_bulk(client, body, content_type, chunk_size=50))
+
+    assert len(lines) == len(expected)
+    assert {(line['ano'], line['mes']): line['prediction'] for line in lines} == pytest.approx(expected, rel=0, abs=1e-9)
+
+
+def test_failed_chunks_do_not_stop_the_stream(client, valid):
+    chunks = [valid[:10], valid[10:20].drop(columns='PIB'), valid[20:30]]
+    lines = _lines(_bulk(client, ''.join(chunk.to_json(orient='records', lines=True) for chunk in chunks)))
+
+    errors = [line for line in lines if 'error' in line]
+    assert len(errors) == 1 and errors[0]['chunk'] == 1 and 'PIB' in errors[0]['error']
+    assert len(lines) == 1 + sum(len(chunk) for chunk in (chunks[0], chunks[2]))
+
+
+def test_unreadable_body_ends_the_stream(client, valid):
+    body = valid[:25].to_json(orient='records', lines=True) + '{not json\n' + valid[25:40].to_json(orient='records', lines=True)
+    lines = _lines(_bulk(client, body))
+
+    assert len(lines) == 21
+    assert 'error' in lines[-1] and lines[-1]['chunk'] == 2
+
+
+def test_bulk_predict_checks_the_request(client, valid):
+    body = valid[:5].to_json(orient='records', lines=True)
+
+    assert 'error' in _bulk(client, body, chunk_size=0).get_json()
+    assert 'error' in _bulk(client, body, chunk_size='many').get_json()
+    assert _bulk(client, body, content_type='application/json').get_data(as_text=True).startswith('Content-Type not supported')
+
+
+def test_app_starts_without_the_training_code(tmp_path, valid, expected):
+    model = app.predictor.model
+    model_store.publish(term_table.compile_pipeline(model), pickle.dumps(model), str(tmp_path))
+    row = valid.iloc[0]
+
+    query = json.dumps({col: str(value) for col, value in row.items()})
+    result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT], input=query, capture_output=True, text=True, check=True,
+                            env=dict(os.environ, MODEL_STORE_DIR=str(tmp_path)), cwd=os.path.dirname(os.path.dirname(__file__)))
+    result = json.loads(result.stdout.splitlines()[-1])
+
+    assert result['report']['training_modules_loaded'] == [] and result['loaded'] == []
+    assert result['prediction'] == pytest.approx(expected[int(row['date'][:4]), int(row['date'][5:7])], rel=0, abs=1e-9)
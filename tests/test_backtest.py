@@ -0,0 +1,67 @@
+import functools
+import numpy as np
+import pytest
+from sklearn.feature_selection import mutual_info_regression
+
+import train
+import backtest
+import benchmark
+
+
+PARAM_GRID = {'selector__k': [3, 5],
+              'poly__degree': [1, 2],
+              'model__alpha': [1, 0.01]}
+
+
+@pytest.fixture(scope='module')
+def data():
+    # the months are shuffled, backtest sorts them
+    return train.preprocess(*benchmark.generate_data(60)).sample(frac=1, random_state=0)
+
+
+def _refit_errors(data, horizons, min_train, window, step, seed):
+    '''errors[origin, candidate, horizon] of the pipeline fitted at every origin, the backtest without shared transforms.'''
+
+    data = data.iloc[np.argsort(train._training_periods(data), kind='stable')]
+    X, y = data.drop(['Precio_leche'], axis = 1), data['Precio_leche'].to_numpy()
+    candidates = [{'selector__k': k, 'poly__degree': degree, 'model__alpha': alpha} for k in PARAM_GRID['selector__k']
+                  for degree in PARAM_GRID['poly__degree'] for alpha in PARAM_GRID['model__alpha']]
+
+    errors = np.full((len(range(min_train, len(X), step)), len(candidates), horizons), np.nan)
+    for i, origin in enumerate(range(min_train, len(X), step)):
+        train_rows, test_rows = slice(max(0, origin - window) if window else 0, origin), slice(origin, origin + horizons)
+        for j, params in enumerate(candidates):
+            # every candidate draws the same noise, like the scores computed once per origin
+            score_func = functools.partial(mutual_info_regression, random_state=seed + origin)
+            model = train.build_pipeline().set_params(selector__score_func=score_func, **params)
+            model.fit(X[train_rows], y[train_rows])
+            predictions = model.predict(X[test_rows])
+            errors[i, j, :len(predictions)] = predictions - y[test_rows]
+    return candidates, errors
+
+
+@pytest.mark.parametrize('window', [0, 24])
+def test_backtest_matches_refitting_at_every_origin(data, window):
+    report = backtest.backtest(data, horizons=6, min_train=36, window=window, step=5, param_grid=PARAM_GRID, n_jobs=1, seed=3)
+    candidates, errors = _refit_errors(data, horizons=6, min_train=36, window=window, step=5, seed=3)
+
+    assert report['origins'] == 5 and report['rows_per_horizon'] == [5, 5, 5, 5, 4, 4]
+    assert [candidate['params'] for candidate in report['candidates']] == candidates
+    rmse = np.sqrt(np.nanmean(errors ** 2, axis=0))
+    assert np.allclose([candidate['rmse_by_horizon'] for candidate in report['candidates']], rmse, rtol=1e-9, atol=0)
+    assert np.allclose([candidate['mae_by_horizon'] for candidate in report['candidates']], np.nanmean(np.abs(errors), axis=0),
+                       rtol=1e-9, atol=0)
+
+    best = int(np.argmin(np.sqrt(np.nanmean(errors ** 2, axis=(0, 2)))))
+    assert report['best'] == candidates[best]
+    # the first origin predicts the 37th month one month ahead, and the 42nd month six months ahead, which the second origin
+    # predicts one month ahead
+    assert report['periods'][0]['month'] == backtest._label(train._training_periods(data).min() + 36)
+    assert report['periods'][0]['errors_by_horizon'][0] == pytest.approx(errors[0, best, 0], rel=1e-9)
+    assert report['periods'][5]['errors_by_horizon'][0] == pytest.approx(errors[1, best, 0], rel=1e-9)
+    assert report['periods'][5]['errors_by_horizon'][5] == pytest.approx(errors[0, best, 5], rel=1e-9)
+
+
+def test_backtest_needs_more_months_than_min_train(data):
+    with pytest.raises(AssertionError):
+        backtest.backtest(data, min_train=60, param_grid=PARAM_GRID, n_jobs=1)
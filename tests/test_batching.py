@@ -0,0 +1,77 @@
+import threading
+import pandas as pd
+import pytest
+
+from batching import PredictionBatcher
+from predict import LechePredictor
+
+
+@pytest.fixture(scope='module')
+def predictor():
+    return LechePredictor()
+
+
+@pytest.fixture(scope='module')
+def single_rows(predictor, rows):
+    '''(row, period, record) of the rows of data/ that have a prediction, each predicted on its own.'''
+
+    dates = pd.to_datetime(rows['date'])
+    periods = (dates.dt.year * 12 + dates.dt.month).to_numpy()
+    records = predictor.predict_rows(rows, periods)
+    return [(rows.iloc[[i]], periods[i], record) for i, record in enumerate(records) if record is not None]
+
+
+def _predict_together(batcher, predictor, calls):
+    '''Calls batcher.predict_row from one thread per (row, period) and returns the result or exception of each.'''
+
+    results = [None] * len(calls)
+
+    def call(i, row, period):
+        try:
+            results[i] = batcher.predict_row(predictor, row, period)
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i, row, period)) for i, (row, period) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_concurrent_rows_are_predicted_together(predictor, single_rows):
+    batcher = PredictionBatcher(window_ms=5000, max_size=4)
+    results = _predict_together(batcher, predictor, [(row, period) for row, period, _ in single_rows[:4]])
+
+    assert results == [pytest.approx(record, rel=0, abs=1e-9) for _, _, record in single_rows[:4]]
+    assert batcher.stats()['batch_sizes'] == {'4': 1}
+    assert batcher.stats()['fallbacks'] == 0
+
+
+def test_rows_of_the_same_period_are_not_batched(predictor, single_rows):
+    row, period, record = single_rows[0]
+    batcher = PredictionBatcher(window_ms=50, max_size=4)
+
+    assert _predict_together(batcher, predictor, [(row, period), (row, period)]) == [pytest.approx(record)] * 2
+    assert batcher.stats()['batch_sizes'] == {'1': 2}
+
+
+def test_failed_batch_is_predicted_row_by_row(predictor, single_rows):
+    (row, period, record), (other, other_period, _) = single_rows[:2]
+    bad = other.assign(PIB='not a number')
+    with pytest.raises(Exception) as alone:
+        predictor.predict_rows(bad, [other_period])
+
+    batcher = PredictionBatcher(window_ms=5000, max_size=2)
+    result, error = _predict_together(batcher, predictor, [(row, period), (bad, other_period)])
+
+    assert result == pytest.approx(record, rel=0, abs=1e-9)
+    assert type(error) is alone.type and str(error) == str(alone.value)
+    assert batcher.stats()['fallbacks'] == 1
+
+
+def test_batching_is_disabled_without_a_window():
+    assert not PredictionBatcher(window_ms=0).enabled
+    assert not PredictionBatcher(window_ms=5, max_size=1).enabled
+    assert PredictionBatcher(window_ms=5, max_size=2).enabled
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import train
+import benchmark
+from preprocessing import DATA_FILES, to_100, convert_int
+
+
+def test_dotted_numbers_are_parsed_back():
+    values = np.array([101.421423, 92.5256728, 1234567.89, 987654321.0])
+
+    # to_100 only keeps the first digits
+    assert [to_100(text) for text in benchmark._dotted(values[:2])] == pytest.approx(values[:2], rel=1e-3)
+    assert [convert_int(text) for text in benchmark._dotted(values[2:])] == [123456789, 987654321]
+
+
+def test_synthetic_data_is_like_the_real_data():
+    real = [pd.read_csv(DATA_FILES[name]) for name in ('precipitaciones', 'banco_central', 'precio_leche')]
+    synthetic = benchmark.generate_data(36, seed=1)
+
+    for real_frame, synthetic_frame in zip(real, synthetic):
+        assert list(synthetic_frame.columns) == list(real_frame.columns)
+    assert len(synthetic[0]) == len(synthetic[1]) == len(synthetic[2]) == 36
+    assert set(synthetic[2]['Mes']) == set(real[2]['Mes'])
+
+    data = train.preprocess(*synthetic)
+    assert len(data) == 36 and not data.isna().any().any()
+
+
+def test_precipitaciones_repeat_the_months():
+    precipitaciones = benchmark.generate_data(12, n_rows=30)[0]
+
+    assert len(precipitaciones) == 30
+    assert precipitaciones['date'].tolist() == precipitaciones['date'][:12].tolist() * 2 + precipitaciones['date'][:6].tolist()
+
+
+def test_synthetic_data_depends_on_the_seed():
+    first, again, other = (benchmark.generate_data(12, seed=seed)[2] for seed in (0, 0, 1))
+
+    pd.testing.assert_frame_equal(first, again)
+    assert not first.equals(other)
+
+
+def test_write_data(tmp_path):
+    files = benchmark.write_data(str(tmp_path), 24)
+
+    assert files.keys() == DATA_FILES.keys()
+    assert open(files['precio_leche'], 'rb').read().count(b'\r\n') == 25
+    pd.testing.assert_frame_equal(pd.read_csv(files['precio_leche']), benchmark.generate_data(24)[2])
+
+
+def test_compare_reports_regressions():
+    baseline = {'results': {'a': {'median': 1.0}, 'b': {'median': 1.0}, 'old': {'median': 1.0}}}
+    results = {'results': {'a': {'median': 1.2}, 'b': {'median': 1.3}, 'new': {'median': 1.0}}}
+
+    assert benchmark.compare(results, baseline, tolerance=0.25) == [('a', 1.0, 1.2, 1.2, False), ('b', 1.0, 1.3, 1.3, True)]
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+import app
+import forecast
+from forecast import ForecastTable
+
+
+def test_lookups():
+    table = ForecastTable([24245, 24242, 24243, 24243], [5.0, 2.0, 3.0, 30.0], 'v1', ())
+
+    assert table.get(24242) == 2.0 and table.get(24245) == 5.0
+    # the first prediction of a period is kept
+    assert table.get(24243) == 3.0
+    assert table.get(24244) is None and table.get(24241) is None and table.get(24246) is None
+
+    periods, predictions = table.between(24243, 24250)
+    assert periods.tolist() == [24243, 24245] and predictions.tolist() == [3.0, 5.0]
+    assert table.between()[0].tolist() == [24242, 24243, 24245]
+    assert len(table.between(24230, 24240)[0]) == 0
+    assert table.stats()['first'] == '2020-02' and table.stats()['last'] == '2020-05'
+
+
+def test_empty_table():
+    table = ForecastTable([], [], 'v1', ())
+
+    assert table.get(24242) is None
+    assert len(table.between()[0]) == 0
+    assert table.stats()['periods'] == 0
+
+
+def test_build_predicts_every_month_of_the_data(rows):
+    predictor = app.predictor
+    data = predictor.make_prediction(*predictor.separate_new_data(rows))
+    table = forecast.build(predictor)
+
+    periods, predictions = table.between()
+    assert periods.tolist() == sorted(data['ano'] * 12 + data['mes'])
+    assert np.allclose(predictions, data.sort_values(['ano', 'mes'])['prediction'], rtol=0, atol=1e-9)
+    assert table.version == predictor.version and table.signature == forecast.data_signature()
+
+
+@pytest.fixture(scope='module')
+def client():
+    return app.app.test_client()
+
+
+def test_forecast_endpoints(client):
+    (period, *_), (prediction, *_) = app.forecasts.between()
+    year, month = divmod(int(period) - 1, 12)
+
+    assert client.get(f'/forecast/{year}/{month + 1}/').get_json() == {'ano': year, 'mes': month + 1, 'prediction': prediction,
+                                                                       'model_version': app.predictor.version}
+    assert client.get(f'/forecast/{year - 1}/{month + 1}/').status_code == 404
+    assert client.get(f'/forecast/{year}/13/').status_code == 400
+
+    forecasts = client.get(f'/forecast/?start={year}-{month + 1:02d}&end={year}-12').get_json()['forecasts']
+    assert forecasts[0] == {'ano': year, 'mes': month + 1, 'prediction': prediction}
+    assert len(forecasts) == len(app.forecasts.between(period, year * 12 + 12)[0])
+    assert len(client.get('/forecast/').get_json()['forecasts']) == len(app.forecasts.between()[0])
+    assert client.get('/forecast/?start=2019-13').status_code == 400
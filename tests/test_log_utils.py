@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+import log_utils
+from log_utils import _fingerprint
+
+CODE = '''
+import pandas as pd
+import log_utils
+from log_utils import _fingerprint
+print(_fingerprint(pd.DataFrame({'a': ['x', 'y', None], 'b': [1.5, float('nan'), 3.0]}, index=['p', 'q', 'r'])))
+'''
+
+
+def test_fingerprint_is_stable_across_processes():
+    digests = {subprocess.run([sys.executable, '-c', CODE], capture_output=True, text=True, check=True,
+                              env=dict(os.environ, PYTHONHASHSEED=str(seed))).stdout for seed in (1, 2)}
+    assert len(digests) == 1
+
+
+def test_fingerprint_depends_on_the_values():
+    data = pd.DataFrame({'a': np.arange(1000.0), 'b': ['x'] * 1000})
+    changed = data.copy()
+    changed.loc[500, 'a'] = -1
+    changed_text = data.copy()
+    changed_text.loc[500, 'b'] = 'y'
+    assert _fingerprint(data) == _fingerprint(data.copy())
+    assert _fingerprint(data) != _fingerprint(changed)
+    assert _fingerprint(data) != _fingerprint(changed_text)
+    assert _fingerprint(data) != _fingerprint(data.set_axis(range(1, 1001)))
+    assert _fingerprint(data['a']) != _fingerprint(data)
+
+
+def test_forked_processes_send_their_records_to_the_parent(tmp_path, monkeypatch):
+    for name in ('_sender', '_receiver', '_forwarding'):
+        monkeypatch.setattr(log_utils, name, getattr(log_utils, name))
+    monkeypatch.setattr(log_utils, 'LOG_DIR', str(tmp_path))
+    path = tmp_path / 'fork.log'
+    log = log_utils.get_log('test_fork', str(path))
+    log_utils.receive_from_forks()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            log.info('written by the parent for %s', os.getpid())
+            log_utils.stop_listeners()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+    for _ in range(50):
+        if path.read_text():
+            break
+        time.sleep(0.1)
+    assert path.read_text().endswith(f':INFO:test_fork:written by the parent for {pid}\n')
@@ -0,0 +1,93 @@
+import os
+import json
+import pytest
+
+import metrics
+
+
+def test_render():
+    metrics.requests_total.inc('test')
+    metrics.request_seconds.observe(0.002, 'test')
+
+    lines = metrics.render().splitlines()
+    assert 'leche_requests_total{endpoint="test"} 1' in lines
+    assert 'leche_request_duration_seconds_bucket{endpoint="test",le="0.0025"} 1' in lines
+
+
+def _run_worker(requests):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            for _ in range(requests):
+                metrics.requests_total.inc('shared')
+                metrics.request_seconds.observe(0.002, 'shared')
+            metrics.flush()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    return pid
+
+
+def test_shared_metrics_add_up_the_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, '_directory', None)
+    metrics.share(str(tmp_path))
+
+    # one worker exited and was retired by the master, the other one is still running
+    metrics.retire(_run_worker(1))
+    running = _run_worker(2)
+
+    lines = metrics.render().splitlines()
+    assert 'leche_requests_total{endpoint="shared"} 3' in lines
+    assert 'leche_request_duration_seconds_count{endpoint="shared"} 3' in lines
+
+    # the counters do not go back when the running worker is replaced
+    metrics.retire(running)
+    assert 'leche_requests_total{endpoint="shared"} 3' in metrics.render().splitlines()
+    assert sorted(os.listdir(tmp_path)) == sorted(['archive.json', 'lock', f'{os.getpid()}.json'])
+
+
+def _samples(client, name):
+    '''Returns the value of every sample of a metric on /metrics, by its labels.'''
+
+    samples = {}
+    for line in client.get('/metrics').get_data(as_text=True).splitlines():
+        if line.startswith(name + '{'):
+            labels, value = line[len(name):].rsplit(' ', 1)
+            samples[labels] = float(value)
+    return samples
+
+
+def _stage_counts(client):
+    return {labels[len('{stage="'):-len('"}')]: count
+            for labels, count in _samples(client, 'leche_stage_duration_seconds_count').items()}
+
+
+@pytest.mark.parametrize('columnar', [False, True])
+def test_prediction_requests_time_every_stage(rows, columnar):
+    import app
+
+    app.cache.clear()
+    client = app.app.test_client()
+    body = json.loads(rows[rows['date'].between('2015-01-01', '2015-03-01')].to_json())
+    if columnar:
+        body = {col: list(values.values()) for col, values in body.items()}
+
+    before = _stage_counts(client)
+    assert len(json.loads(client.post('/post_predict/', json=body).get_data())) == 3
+    after = _stage_counts(client)
+
+    stages = ['parse_json', 'cache_lookup', 'separate_new_data', 'prep_precipitaciones', 'prep_banco_central', 'merge',
+              'predict', 'to_json'] + (['validate_schema'] if columnar else ['find_missing_cols'])
+    assert {stage: after[stage] - before.get(stage, 0) for stage in stages} == dict.fromkeys(stages, 1)
+    assert _samples(client, 'leche_request_rows_count')['{endpoint="post_predict"}'] >= 1
+
+
+def test_errors_are_counted_by_type(rows):
+    import app
+
+    client = app.app.test_client()
+    labels = '{endpoint="post_predict",type="AssertionError"}'
+    before = _samples(client, 'leche_errors_total').get(labels, 0)
+
+    assert 'error' in json.loads(client.post('/post_predict/', json=json.loads(rows[:2].drop(columns='PIB').to_json())).get_data())
+    assert _samples(client, 'leche_errors_total')[labels] == before + 1
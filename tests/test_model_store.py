@@ -0,0 +1,102 @@
+import os
+import time
+import shutil
+import pickle
+import numpy as np
+import pytest
+
+import model_store
+import term_table
+
+
+TABLE = {'features': np.array([0, 2]),
+         'coef': np.array([1.5, -2.0]),
+         'intercept': np.float64(3.0),
+         'n_inputs': np.int64(3),
+         'model_sha256': np.str_('abc')}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''Versions are named after the second they are published in, the clock is moved by hand instead.'''
+
+    now = [time.mktime((2024, 1, 1, 0, 0, 0, 0, 1, -1))]
+    strftime = time.strftime
+    monkeypatch.setattr(model_store.time, 'strftime', lambda format, t=None: strftime(format, t or time.localtime(now[0])))
+    return now
+
+
+def test_published_versions_are_loaded_memory_mapped(tmp_path, clock):
+    state = {'xtx': np.eye(2), 'updates': 3}
+    version = model_store.publish(TABLE, pickle.dumps('pipeline'), str(tmp_path), metadata={'rows': 10}, state=state)
+    table, manifest = model_store.load(version, str(tmp_path))
+
+    assert version.startswith('20240101T000000-')
+    assert model_store.current_version(str(tmp_path)) == version
+    assert isinstance(table['coef'], np.memmap) and not table['coef'].flags.writeable
+    assert table.keys() == TABLE.keys()
+    for name, value in TABLE.items():
+        assert np.array_equal(table[name], value)
+    assert manifest['metadata'] == {'rows': 10}
+    assert model_store.load_pipeline(version, str(tmp_path)) == 'pipeline'
+    loaded_state = model_store.load_state(version, str(tmp_path))
+    assert loaded_state['updates'] == 3 and np.array_equal(loaded_state['xtx'], state['xtx'])
+
+
+def test_versions_without_state(tmp_path, clock):
+    version = model_store.publish(TABLE, pickle.dumps('pipeline'), str(tmp_path))
+
+    assert model_store.load_state(version, str(tmp_path)) is None
+
+
+def test_empty_store(tmp_path):
+    assert model_store.current_version(str(tmp_path)) is None
+    assert model_store.list_versions(str(tmp_path / 'missing')) == []
+
+
+def test_only_the_newest_versions_are_kept(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(model_store, 'KEEP_VERSIONS', 2)
+    versions = []
+    for i in range(4):
+        versions.append(model_store.publish(TABLE, pickle.dumps(i), str(tmp_path)))
+        clock[0] += 1
+
+    assert model_store.list_versions(str(tmp_path)) == versions[2:]
+    assert not [name for name in os.listdir(tmp_path) if name.startswith('.tmp')]
+
+
+def test_set_current(tmp_path, clock):
+    first = model_store.publish(TABLE, pickle.dumps(1), str(tmp_path))
+    clock[0] += 1
+    model_store.publish(TABLE, pickle.dumps(2), str(tmp_path))
+
+    model_store.set_current(first, str(tmp_path))
+    assert model_store.current_version(str(tmp_path)) == first
+    with pytest.raises(ValueError):
+        model_store.set_current('20000101T000000-000000000000', str(tmp_path))
+
+
+def test_app_reloads_a_published_version(monkeypatch):
+    import app
+
+    monkeypatch.setattr(app, 'predictor', app.predictor)
+    monkeypatch.setattr(app, 'forecasts', app.forecasts)
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+    client = app.app.test_client()
+    values = np.random.default_rng(0).normal(size=(5, int(app.predictor.table['n_inputs'])))
+    expected = app.predictor.predict_array(values)
+
+    model = app.predictor.model
+    try:
+        version = model_store.publish(term_table.compile_pipeline(model), pickle.dumps(model))
+        app.cache.put('key', 'cached')
+        response = client.post('/admin/reload/', headers={'X-Admin-Token': 'secret'})
+
+        assert response.get_json() == {'version': version, 'reloaded': True}
+        assert app.predictor.version == version
+        assert app.cache.stats()['size'] == 0
+        assert np.allclose(app.predictor.predict_array(values), expected, rtol=0, atol=1e-9)
+        assert client.post('/admin/reload/', headers={'X-Admin-Token': 'secret'}).get_json()['reloaded'] is False
+        assert client.post('/admin/reload/').status_code == 403
+    finally:
+        shutil.rmtree(model_store.STORE_DIR, ignore_errors=True)
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import preprocessing
+from predict import LechePredictor
+from preprocessing import cols_model
+
+
+@pytest.fixture(scope='module')
+def predictor():
+    return LechePredictor()
+
+
+def test_predictions_match_the_pipeline(predictor, rows):
+    result = predictor.make_prediction(*predictor.separate_new_data(rows))
+
+    assert list(result.columns) == cols_model + ['prediction']
+    assert len(result) > 0
+    assert np.allclose(result['prediction'], predictor.model.predict(result[cols_model]), rtol=0, atol=1e-9)
+
+
+def test_predict_rows_matches_each_row(predictor, rows):
+    result = predictor.make_prediction(*predictor.separate_new_data(rows))
+    by_period = dict(zip(result['ano'] * 12 + result['mes'], result.to_dict('records')))
+
+    dates = pd.to_datetime(rows['date'])
+    periods = (dates.dt.year * 12 + dates.dt.month).to_numpy()
+    chosen = [i for i, period in enumerate(periods) if period in by_period][:20:4][::-1]
+
+    # the last period has no output row, like a row without valid values
+    records = predictor.predict_rows(rows.iloc[chosen], np.append(periods[chosen], 0))
+    assert records[-1] is None
+    assert records[:-1] == [pytest.approx(by_period[period], rel=0, abs=1e-9) for period in periods[chosen]]
+
+
+def test_prep_new_data_matches_merging_on_year_and_month(predictor, rows):
+    # precipitaciones of the same months, in another order and with a repeated month
+    precipitaciones, banco_central = predictor.separate_new_data(rows)
+    precipitaciones = pd.concat([precipitaciones[::-1], precipitaciones[:3]], ignore_index=True)
+    data = predictor.prep_new_data(precipitaciones.copy(), banco_central.copy())
+
+    # the merge the period keys replace
+    precipitaciones = preprocessing.prep_precipitaciones(precipitaciones)
+    banco_central = preprocessing.prep_banco_central(banco_central)
+    for frame, col in [(precipitaciones, 'date'), (banco_central, 'Periodo')]:
+        frame['mes'], frame['ano'] = frame[col].dt.month, frame[col].dt.year
+    expected = pd.merge(banco_central, precipitaciones, on=['mes', 'ano'])[cols_model]
+
+    assert len(data) > 0
+    pd.testing.assert_frame_equal(data, expected)
+
+
+@pytest.mark.parametrize('value', [np.nan, np.inf])
+def test_predict_array_rejects_missing_and_infinite_values(predictor, value):
+    values = np.ones((2, len(cols_model)))
+    values[1, 3] = value
+
+    with pytest.raises(ValueError):
+        predictor.predict_array(values)
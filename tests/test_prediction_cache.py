@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+
+import prediction_cache
+from prediction_cache import PredictionCache, MISSING, KEY_COLUMNS, row_periods
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def _rows(*values):
+    return pd.DataFrame([{col: value for col in KEY_COLUMNS} for value in values])
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = PredictionCache(max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is MISSING
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'max_size': 2, 'ttl': cache.ttl, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = PredictionCache(ttl=10)
+    cache.put('a', None)
+    clock[0] += 9
+    assert cache.get('a') is None
+
+    clock[0] += 2
+    assert cache.get('a') is MISSING
+    assert cache.stats()['size'] == 0 and cache.stats()['evictions'] == 1
+
+
+def test_empty_cache_stores_nothing():
+    cache = PredictionCache(max_size=0)
+    cache.put('a', 1)
+
+    assert cache.get('a') is MISSING
+
+
+def test_keys_depend_on_the_model_version():
+    cache = PredictionCache()
+    rows = _rows('1', '2')
+
+    assert cache.make_keys(rows, 'v1') == cache.make_keys(rows.copy(), 'v1')
+    assert len(set(cache.make_keys(rows, 'v1'))) == 2
+    assert set(cache.make_keys(rows, 'v1')).isdisjoint(cache.make_keys(rows, 'v2'))
+
+
+def test_keys_depend_on_the_type_of_the_values():
+    cache = PredictionCache()
+    keys = [cache.make_keys(_rows(value), 'v1')[0] for value in ('123', 123, 123.0, None)]
+
+    assert len(set(keys)) == len(keys)
+
+
+def test_keys_ignore_columns_the_model_does_not_use():
+    cache = PredictionCache()
+    rows = _rows('1')
+
+    assert cache.make_keys(rows.assign(other='a'), 'v1') == cache.make_keys(rows.assign(other='b'), 'v1')
+
+
+def test_row_periods():
+    data = pd.DataFrame({'date': ['2020-01-01', '2020-02-01'], 'Periodo': ['2020-01-01 00:00:00 UTC', '2020-02-01 00:00:00 UTC']})
+
+    assert row_periods(data).tolist() == [2020 * 12 + 1, 2020 * 12 + 2]
+    assert row_periods(data.assign(Periodo=data['Periodo'][::-1].to_numpy())) is None
+    assert row_periods(pd.concat([data, data])) is None
+    assert row_periods(data.assign(date=['2020-01-01', 'enero'])) is None
@@ -0,0 +1,81 @@
+import pandas as pd
+import pytest
+
+import train
+import benchmark
+
+
+def _write(files, frames, months):
+    precipitaciones, banco_central, precio_leche = frames
+    precipitaciones[:months].to_csv(files['precipitaciones'], index=False)
+    banco_central.to_csv(files['banco_central'], index=False)
+    precio_leche[:months].to_csv(files['precio_leche'], index=False, lineterminator='\r\n')
+
+
+def _load(cache_dir, caplog):
+    '''Returns the result of load_preprocessed and the first word of what it logged about the cache.'''
+
+    caplog.clear()
+    data = train.load_preprocessed(cache_dir)
+    messages = [record.getMessage().split()[0] for record in caplog.records
+                if record.name == 'train' and 'preprocessed data' in record.getMessage().lower()]
+    return data, messages
+
+
+@pytest.fixture
+def frames():
+    return benchmark.generate_data(72)
+
+
+@pytest.fixture
+def cache_dir(tmp_path, frames, monkeypatch, caplog):
+    caplog.set_level('INFO', logger='train')
+    files = {name: str(tmp_path / f'{name}.csv') for name in train.DATA_FILES}
+    for name, path in files.items():
+        monkeypatch.setitem(train.DATA_FILES, name, path)
+    _write(files, frames, 60)
+    return str(tmp_path / 'cache')
+
+
+def test_cached_data_is_the_preprocessed_data(cache_dir, caplog):
+    expected = train.preprocess(*train.load_data())
+
+    data, messages = _load(cache_dir, caplog)
+    assert messages == ['Rebuilding']
+    pd.testing.assert_frame_equal(data, expected)
+
+    data, messages = _load(cache_dir, caplog)
+    assert messages == ['Preprocessed']
+    pd.testing.assert_frame_equal(data, expected)
+
+
+def test_appended_rows_are_processed_on_their_own(cache_dir, frames, caplog):
+    _load(cache_dir, caplog)
+    _write(train.DATA_FILES, frames, 72)
+
+    data, messages = _load(cache_dir, caplog)
+    assert messages == ['Updating']
+    assert len(data) == 72
+    pd.testing.assert_frame_equal(data, train.preprocess(*train.load_data()))
+
+    assert _load(cache_dir, caplog)[1] == ['Preprocessed']
+
+
+def test_changed_rows_rebuild_the_cache(cache_dir, frames, caplog):
+    _load(cache_dir, caplog)
+    precipitaciones, banco_central, precio_leche = frames
+    precio_leche.loc[0, 'Precio_leche'] += 1
+    _write(train.DATA_FILES, (precipitaciones, banco_central, precio_leche), 60)
+
+    data, messages = _load(cache_dir, caplog)
+    assert messages == ['Rebuilding']
+    pd.testing.assert_frame_equal(data, train.preprocess(*train.load_data()))
+
+
+def test_preprocessing_changes_rebuild_the_cache(cache_dir, monkeypatch, caplog):
+    data = _load(cache_dir, caplog)[0]
+    monkeypatch.setattr(train, 'preprocessing_version', lambda: 'another version')
+
+    rebuilt, messages = _load(cache_dir, caplog)
+    assert messages == ['Rebuilding']
+    pd.testing.assert_frame_equal(rebuilt, data)
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from preprocessing import (DATA_FILES, to_100, convert_int, to_100_column, convert_int_column, load_banco_central,
+                           prep_banco_central, period_key, join_on_period)
+
+
+def _columns(names):
+    data = pd.read_csv(DATA_FILES['banco_central'], dtype=str)
+    return [data[col].dropna() for col in data.columns if any(name in col for name in names)]
+
+
+def _check_same(scalar, column_func, column):
+    '''The column function returns the values of the scalar function, or raises its exception.'''
+
+    expected, error = [], None
+    for value in column:
+        try:
+            expected.append(scalar(value))
+        except Exception as e:
+            error = error or type(e)
+
+    if error is not None:
+        with pytest.raises(error):
+            column_func(column)
+    else:
+        result = column_func(column)
+        assert result.index.equals(column.index)
+        assert np.array_equal(result.to_numpy(), np.array(expected, dtype=result.dtype))
+
+
+@pytest.mark.parametrize('column', _columns(['Imacec', 'Indice_de_ventas_comercio_real_no_durables_IVCM']), ids=lambda column: column.name)
+def test_to_100_column_matches_to_100(column):
+    _check_same(to_100, to_100_column, column)
+
+
+@pytest.mark.parametrize('column', _columns(['PIB']), ids=lambda column: column.name)
+def test_convert_int_column_matches_convert_int(column):
+    _check_same(convert_int, convert_int_column, column)
+
+
+@pytest.mark.parametrize('value', [178797615.0, 178797615, 101.5])
+def test_numbers_are_rejected(value):
+    column = pd.Series(['101.421.423', value], dtype=object)
+    for scalar, column_func in ((to_100, to_100_column), (convert_int, convert_int_column)):
+        with pytest.raises(AttributeError):
+            scalar(value)
+        with pytest.raises(AttributeError):
+            column_func(column)
+
+
+def test_empty_columns():
+    assert to_100_column(pd.Series([], dtype=object)).dtype == np.float64
+    assert convert_int_column(pd.Series([], dtype=object)).dtype == np.int64
+
+
+def test_load_banco_central_reads_numbers_as_strings(tmp_path):
+    # a PIB column without thousands separators only contains numbers, which pd.read_csv would read as numbers
+    data = pd.read_csv(DATA_FILES['banco_central'], dtype=str)
+    data['PIB_Pesca'] = data['PIB_Pesca'].str.replace('.', '', regex=False)
+    path = tmp_path / 'banco_central.csv'
+    data.to_csv(path, index=False)
+
+    result = load_banco_central(str(path), chunksize=50)
+    pd.testing.assert_frame_equal(result, prep_banco_central(pd.read_csv(path, dtype=str)))
+    pd.testing.assert_series_equal(result['PIB_Pesca'], load_banco_central(chunksize=50)['PIB_Pesca'])
+
+
+def test_load_banco_central_without_rows(tmp_path):
+    path = tmp_path / 'banco_central.csv'
+    pd.read_csv(DATA_FILES['banco_central'], dtype=str).iloc[:0].to_csv(path, index=False)
+
+    result = load_banco_central(str(path), chunksize=50)
+    assert len(result) == 0
+    pd.testing.assert_frame_equal(result, prep_banco_central(pd.read_csv(path, dtype=str)).reset_index(drop=True))
+
+
+def test_period_key():
+    dates = pd.to_datetime(pd.Series(['2019-01-01', '2019-12-31', '2020-01-15']))
+
+    assert period_key(dates).tolist() == [2019 * 12 + 1, 2019 * 12 + 12, 2020 * 12 + 1]
+
+
+def test_join_on_period_matches_merge():
+    rng = np.random.default_rng(0)
+    left = pd.DataFrame({'a': rng.normal(size=40), 'b': np.arange(40)}, index=rng.permutation(40))
+    right = pd.DataFrame({'c': rng.normal(size=30)}, index=np.arange(30) * 2)
+    # periods missing on either side, and repeated on both
+    left_period, right_period = rng.integers(0, 15, len(left)), rng.integers(5, 20, len(right))
+
+    expected = pd.merge(left.assign(period=left_period), right.assign(period=right_period), on='period').drop(columns='period')
+    pd.testing.assert_frame_equal(join_on_period(left, left_period, right, right_period), expected)
+
+    empty = join_on_period(left, left_period, right, right_period + 100)
+    assert len(empty) == 0 and list(empty.columns) == ['a', 'b', 'c']
@@ -0,0 +1,106 @@
+import os
+import pstats
+import pytest
+
+import app
+import profiling
+from profiling import ProfileStore
+
+
+def _work():
+    return sum(range(1000))
+
+
+def _save(store, request_id, **metadata):
+    profiler = store.start()
+    _work()
+    return store.save(profiler, request_id, **metadata)
+
+
+def test_only_the_newest_profiles_are_kept(tmp_path):
+    store = ProfileStore(str(tmp_path / 'profiles'), max_files=3)
+    assert store.list() == []
+
+    ids = [_save(store, f'request{i}', endpoint='get_predict', rows=i) for i in range(5)]
+
+    assert [profile['id'] for profile in store.list()] == ids[:1:-1]
+    assert sorted(os.listdir(tmp_path / 'profiles')) == sorted(profile_id + extension for profile_id in ids[2:]
+                                                               for extension in ('.json', '.prof'))
+    assert store.get(ids[0]) is None and store.path(ids[0]) is None
+    assert store.get(ids[4])['request_id'] == 'request4' and store.get(ids[4])['rows'] == 4
+    assert pstats.Stats(store.path(ids[4])).total_calls > 0
+
+
+def test_profile_ids(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    profile_id = store.new_id('abc')
+
+    assert _save(store, 'abc', profile_id=profile_id) == profile_id
+    assert store.get(profile_id)['id'] == profile_id
+    # ids that are not ids of profiles are not looked up on disk
+    open(tmp_path / 'other.json', 'w').write('{}')
+    assert store.get('other') is None and store.path('../' + profile_id) is None
+    assert [profile['id'] for profile in store.list()] == [profile_id]
+
+    assert profiling.request_id('a b/c-d_e') == 'abc-d_e'
+    assert len(profiling.request_id('../..')) == 16 and len(profiling.request_id('x' * 100)) == 64
+
+
+def test_report(tmp_path):
+    store = ProfileStore(str(tmp_path))
+    profile_id = _save(store, 'abc', endpoint='get_predict')
+    report = store.report(profile_id, sort='tottime', limit=5, pattern='_work')
+
+    assert report.startswith('endpoint: get_predict\n') and f'id: {profile_id}\n' in report
+    assert '(_work)' in report and 'sum' not in report
+    assert '{built-in method builtins.sum}' in store.report(profile_id)
+    assert store.report(store.new_id('other')) is None
+    with pytest.raises(AssertionError):
+        store.report(profile_id, sort='time of day')
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'profiles', ProfileStore(str(tmp_path), max_files=2))
+    monkeypatch.setattr(app, 'ADMIN_TOKEN', 'secret')
+    return app.app.test_client()
+
+
+def test_requests_are_profiled_with_the_admin_token(client, tmp_path):
+    assert 'X-Profile-Id' not in client.get('/health/', headers={'X-Profile': '1'}).headers
+    assert 'X-Profile-Id' not in client.get('/health/', headers={'X-Profile': '1', 'X-Admin-Token': 'wrong'}).headers
+    assert os.listdir(tmp_path) == []
+
+    headers = {'X-Admin-Token': 'secret'}
+    ids = [client.get('/health/', headers=dict(headers, **{'X-Profile': '1', 'X-Request-Id': f'request{i}'})).headers['X-Profile-Id']
+           for i in range(3)]
+
+    profiles = client.get('/admin/profiles/', headers=headers).get_json()
+    assert [profile['id'] for profile in profiles] == ids[:0:-1]
+    assert profiles[0]['request_id'] == 'request2' and profiles[0]['endpoint'] == 'health' and profiles[0]['status'] == 200
+
+    report = client.get(f'/admin/profiles/{ids[2]}/?sort=ncalls&limit=3', headers=headers)
+    assert report.mimetype == 'text/plain' and 'request_id: request2' in report.get_data(as_text=True)
+    download = client.get(f'/admin/profiles/{ids[2]}/?format=pstats', headers=headers)
+    assert download.get_data() == open(tmp_path / f'{ids[2]}.prof', 'rb').read()
+
+    assert client.get(f'/admin/profiles/{ids[0]}/', headers=headers).status_code == 404
+    assert client.get(f'/admin/profiles/{ids[2]}/?format=pstats', headers={'X-Admin-Token': 'wrong'}).status_code == 403
+    assert client.get(f'/admin/profiles/{ids[2]}/?sort=time', headers=headers).status_code == 400
+    assert client.get(f'/admin/profiles/{ids[2]}/?limit=all', headers=headers).status_code == 400
+    assert client.get('/admin/profiles/').status_code == 403
+
+
+def test_streamed_responses_are_profiled_until_the_end(client, rows):
+    headers = {'X-Admin-Token': 'secret'}
+    body = rows[rows['date'].between('2015-01-01', '2015-05-01')]
+    response = client.post('/bulk_predict/', data=body.to_json(orient='records', lines=True), content_type='application/x-ndjson',
+                           headers=dict(headers, **{'X-Profile': '1'}))
+    profile_id = response.headers['X-Profile-Id']
+    assert len(response.get_data(as_text=True).splitlines()) == len(body) == 5
+    response.close()
+
+    profile, = client.get('/admin/profiles/', headers=headers).get_json()
+    assert profile['id'] == profile_id and profile['endpoint'] == 'bulk_predict' and profile['rows'] == 5
+    # the predictions, made while the response is sent, are in the profile
+    assert 'predict.py:' in client.get(f'/admin/profiles/{profile_id}/?filter=predict', headers=headers).get_data(as_text=True)
@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+from preprocessing import DATA_FILES
+from schema import InputSchema, SchemaError
+
+
+def _payload(rows=2):
+    precipitaciones = pd.read_csv(DATA_FILES['precipitaciones']).head(rows)
+    banco_central = pd.read_csv(DATA_FILES['banco_central'], dtype=str).dropna(subset=['Imacec_empalmado']).head(rows)
+    payload = {col: precipitaciones[col].tolist() for col in precipitaciones.columns}
+    payload.update({col: banco_central[col].tolist() for col in banco_central.columns})
+    return payload
+
+
+def test_valid_payload():
+    schema = InputSchema()
+    data = schema.to_frame(_payload())
+    assert list(data.columns) == schema.columns
+    assert len(data) == 2
+
+
+@pytest.mark.parametrize('value', [178797615.0, 178797615])
+def test_dotted_numbers_are_rejected(value):
+    payload = _payload()
+    payload['PIB_Agropecuario_silvicola'][0] = value
+    with pytest.raises(SchemaError) as e:
+        InputSchema().to_frame(payload)
+    assert e.value.errors == ["'PIB_Agropecuario_silvicola' must be a string of digits separated by periods, in rows 0."]
+
+
+def test_empty_payload():
+    with pytest.raises(SchemaError) as e:
+        InputSchema().to_frame({col: [] for col in InputSchema().columns})
+    assert e.value.errors == ['There are no rows to predict, the lists of values are empty.']
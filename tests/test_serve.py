@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+import urllib.request
+import pytest
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _workers(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return set(map(int, f.read().split()))
+
+
+def _wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.1)
+
+
+def _requests_total(url, endpoint):
+    lines = urllib.request.urlopen(f'{url}/metrics').read().decode().splitlines()
+    return sum(float(line.split()[-1]) for line in lines if line.startswith(f'leche_requests_total{{endpoint="{endpoint}"}}'))
+
+
+@pytest.fixture
+def server(tmp_path):
+    '''A serve.py master with 2 workers, which writes its logs to tmp_path.'''
+
+    port = _free_port()
+    env = dict(os.environ, SERVE_HOST='127.0.0.1', SERVE_PORT=str(port), SERVE_WORKERS='2', SERVE_GRACEFUL_TIMEOUT='5',
+               METRICS_FLUSH_INTERVAL='0.1', LOG_DIR=str(tmp_path))
+    process = subprocess.Popen([sys.executable, 'serve.py'], env=env, cwd=os.path.dirname(os.path.dirname(__file__)),
+                               stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+
+    def ready():
+        try:
+            return urllib.request.urlopen(f'{url}/health/').status == 200 and len(_workers(process.pid)) == 2
+        except OSError:
+            return False
+
+    try:
+        _wait_for(ready, timeout=60)
+        yield process, url
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+
+
+def test_dead_workers_are_replaced(server, tmp_path):
+    process, url = server
+    for _ in range(10):
+        urllib.request.urlopen(f'{url}/')
+    _wait_for(lambda: _requests_total(url, 'index') == 10)
+
+    # a worker that dies is replaced, and the metrics it counted are kept
+    first, second = sorted(_workers(process.pid))
+    os.kill(first, signal.SIGKILL)
+    _wait_for(lambda: first not in _workers(process.pid) and len(_workers(process.pid)) == 2)
+    assert second in _workers(process.pid)
+    for _ in range(5):
+        assert urllib.request.urlopen(f'{url}/').status == 200
+    _wait_for(lambda: _requests_total(url, 'index') == 15)
+    assert f'Worker {first} exited unexpectedly with status -9' in (tmp_path / 'serve.log').read_text()
+
+    # the records of the workers are written by the master
+    assert 'index function executed' in (tmp_path / 'app.log').read_text()
+
+
+def test_sighup_replaces_every_worker_without_dropping_requests(server, tmp_path):
+    process, url = server
+    old = _workers(process.pid)
+
+    process.send_signal(signal.SIGHUP)
+    for _ in range(20):
+        assert urllib.request.urlopen(f'{url}/').status == 200
+    _wait_for(lambda: len(_workers(process.pid)) == 2 and not _workers(process.pid) & old)
+
+    _wait_for(lambda: _requests_total(url, 'index') == 20)
+    assert 'Restarted the workers (generation 1)' in (tmp_path / 'serve.log').read_text()
+    assert 'exited unexpectedly' not in (tmp_path / 'serve.log').read_text()
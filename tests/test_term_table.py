@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import train
+import term_table
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.normal(100, 20, (200, 8)), columns=[f'x{i}' for i in range(8)])
+    y = X['x0'] + 0.01 * X['x1'] * X['x2'] + rng.normal(0, 0.01, len(X))
+    return X, y
+
+
+@pytest.fixture(scope='module')
+def model(data):
+    return train.build_pipeline().set_params(selector__k=5, poly__degree=4, model__alpha=0.01).fit(*data)
+
+
+def test_evaluate_matches_the_pipeline(data, model):
+    X, _ = data
+    table = term_table.compile_pipeline(model)
+
+    assert len(table['coef']) == table['n_terms_total'] - np.sum(model.named_steps['model'].coef_ == 0)
+    assert np.allclose(term_table.evaluate(table, X.to_numpy()), model.predict(X), rtol=0, atol=1e-9)
+
+
+def test_evaluate_in_chunks(data, model, monkeypatch):
+    X, _ = data
+    table = term_table.compile_pipeline(model)
+    expected = term_table.evaluate(table, X.to_numpy())
+
+    monkeypatch.setattr(term_table, 'MAX_CHUNK_VALUES', 1000)
+    assert np.allclose(term_table.evaluate(table, X.to_numpy()), expected, rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('tolerance', [1e-3, 1e-2, 1e-1])
+def test_pruning_stays_within_the_tolerance(data, model, tolerance):
+    X, _ = data
+    table = term_table.compile_pipeline(model, X, tolerance=tolerance)
+    error = np.abs(term_table.evaluate(table, X.to_numpy()) - model.predict(X)).max()
+
+    assert len(table['coef']) < table['n_terms_total'] - 1
+    assert error <= tolerance
+    assert error == pytest.approx(table['error_bound'], abs=1e-9)
+
+
+def test_evaluate_rejects_missing_values(model):
+    values = np.full((1, 8), 100.0)
+    values[0, 3] = np.nan
+
+    with pytest.raises(ValueError, match='NaN'):
+        term_table.evaluate(term_table.compile_pipeline(model), values)
@@ -0,0 +1,106 @@
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.model_selection import GridSearchCV
+
+import train
+import benchmark
+import model_store
+
+
+PARAM_GRID = {'selector__k': [3, 5, 10],
+              'poly__degree': [1, 2, 3],
+              'model__alpha': [1, 0.1, 0.01]}
+
+
+@pytest.fixture(scope='module')
+def data():
+    return train.preprocess(*benchmark.generate_data(120))
+
+
+def test_fast_grid_search_matches_grid_search(data):
+    X, y = data.drop(['Precio_leche'], axis = 1), data['Precio_leche']
+
+    best_params, scores = train.fast_grid_search(X, y, n_jobs=1, param_grid=PARAM_GRID)
+    grid = GridSearchCV(train.build_pipeline(), PARAM_GRID, cv=train.CV_FOLDS, scoring='r2').fit(X, y)
+
+    assert best_params == grid.best_params_
+    assert np.allclose(scores, grid.cv_results_['mean_test_score'])
+
+
+def test_merge_data_matches_merging_on_year_and_month():
+    precipitaciones, banco_central, precio_leche = benchmark.generate_data(48, n_rows=60)
+    precipitaciones = train.prep_precipitaciones(precipitaciones)
+    banco_central = train.prep_banco_central(banco_central)
+    precio_leche = train.prep_leche(precio_leche)[:40]
+
+    # the merge the period keys replace
+    for frame, col in [(precipitaciones, 'date'), (banco_central, 'Periodo')]:
+        frame['mes'], frame['ano'] = frame[col].dt.month, frame[col].dt.year
+    expected = pd.merge(precio_leche, precipitaciones, on=['mes', 'ano']).drop(columns='date')
+    expected = pd.merge(expected, banco_central, on=['mes', 'ano'])
+    expected = expected.drop(columns=['Periodo', 'Indice_de_ventas_comercio_real_no_durables_IVCM', 'mes_pal'])
+
+    data = train.merge_data(precipitaciones.drop(columns=['mes', 'ano']), banco_central.drop(columns=['mes', 'ano']), precio_leche)
+    assert len(data) == 52
+    pd.testing.assert_frame_equal(data, expected, check_like=True)
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    '''Points the model store functions used by train_incremental to an empty store (their default store_dir is bound at import).'''
+
+    for function in (model_store.current_version, model_store.load_state, model_store.load_pipeline):
+        monkeypatch.setattr(function, '__defaults__', (str(tmp_path),))
+    return str(tmp_path)
+
+
+def _publish(model, state, store):
+    return model_store.publish({'coef': np.zeros(1)}, pickle.dumps(model), store, state=state)
+
+
+def _split(data, n):
+    X, y, periods = data.drop(['Precio_leche'], axis = 1), data['Precio_leche'], train._training_periods(data)
+    return (X[:n], y[:n], periods[:n]), (X[n:], y[n:], periods[n:]), (X, y)
+
+
+def test_update_model_matches_refitting_the_scaler_and_ridge(data):
+    (X, y, periods), (X_new, y_new, periods_new), (X_all, y_all) = _split(data, 96)
+    model = train.build_pipeline().set_params(selector__k=5, poly__degree=2, model__alpha=0.1).fit(X, y)
+    state = train.training_state(model, X, y, periods)
+    before = model.predict(X_all)
+
+    updated, updated_state = train.update_model(model, state, X_new, y_new, periods_new, X_all, y_all)
+    refit, _ = train.update_model(model, {key: value for key, value in state.items() if key not in ('gram', 'moment')},
+                                  X_new, y_new, periods_new, X_all, y_all)
+
+    assert np.allclose(updated.predict(X_all), refit.predict(X_all), rtol=0, atol=1e-8)
+    assert np.allclose(updated.named_steps['model'].coef_, refit.named_steps['model'].coef_, rtol=0, atol=1e-8)
+    assert np.array_equal(updated.named_steps['selector'].get_support(), model.named_steps['selector'].get_support())
+    assert updated_state['periods'].tolist() == periods.tolist() + periods_new.tolist() and updated_state['updates'] == 1
+    # the model given is not modified
+    assert np.array_equal(model.predict(X_all), before)
+
+
+def test_train_incremental(data, store):
+    (X, y, periods), _, (X_all, y_all) = _split(data, 96)
+
+    # without a current model the hyperparameters are searched
+    model, state = train.train_incremental(data[:96], n_jobs=1)
+    assert state['updates'] == 0 and state['periods'].tolist() == periods.tolist()
+    _publish(model, state, store)
+    assert train.train_incremental(data[:96], n_jobs=1)[0] is None
+
+    updated, updated_state = train.train_incremental(data, n_jobs=1, drift_tolerance=np.inf)
+    assert updated_state['updates'] == 1 and updated_state['drift_rows'] == 24
+    assert updated.get_params()['model__alpha'] == model.get_params()['model__alpha']
+    expected, _ = train.update_model(model, state, X_all[96:], y_all[96:], train._training_periods(data)[96:], X_all, y_all)
+    assert np.allclose(updated.predict(X_all), expected.predict(X_all), rtol=0, atol=1e-8)
+
+    # after full_every updates, or when the error on the new rows grows, the hyperparameters are searched again
+    assert train.train_incremental(data, n_jobs=1, full_every=0, drift_tolerance=np.inf)[1]['updates'] == 0
+    assert train.train_incremental(data, n_jobs=1, drift_tolerance=0)[1]['updates'] == 0
+    # as well as when rows the model was trained on are gone
+    _publish(updated, updated_state, store)
+    assert train.train_incremental(data[1:], n_jobs=1)[1]['updates'] == 0
@@ -1,15 +1,33 @@
 import pandas as pd
 import numpy as np 
+import io
+import os
+import copy
+import math
+import json
 import locale
 import pickle
-import logging
-
-from sklearn.model_selection import GridSearchCV
+import hashlib
+import inspect
+import argparse
+import itertools
+import functools
+from scipy import linalg
+
+from joblib import Parallel, delayed
+from sklearn.model_selection import GridSearchCV, ParameterGrid, check_cv
 from sklearn.preprocessing import StandardScaler, PolynomialFeatures
 from sklearn.pipeline import Pipeline
 from sklearn.linear_model import Ridge
 from sklearn.feature_selection import SelectKBest, mutual_info_regression
 
+import log_utils
+import term_table
+import model_store
+from preprocessing import (DATA_FILES, to_100, convert_int, to_100_column, convert_int_column,
+                           prep_precipitaciones, prep_banco_central, banco_central_columns, load_banco_central,
+                           period_key, join_on_period)
+
 
 # set global options for timezone and pandas chained_assignment
 locale.setlocale(locale.LC_TIME, 'es_ES.UTF-8')
@@ -17,19 +35,19 @@ pd.options.mode.chained_assignment = None  # default='warn'
 
 
 # Set log configurations, and create logging decorator function
-log = logging.getLogger(__name__)
-log.setLevel(logging.INFO)
-formatter = logging.Formatter(fmt='%(asctime)s:%(levelname)s:%(name)s:%(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-file_handler = logging.FileHandler('logs/train.log')
-file_handler.setFormatter(formatter)
-log.addHandler(file_handler)
+log = log_utils.get_log(__name__, 'logs/train.log')
+logger = log_utils.make_logger(log)
+
+# Cache of the preprocessed training data (the paths of the datasets are in preprocessing.DATA_FILES).
+# Rows can be appended to the precipitaciones and precio_leche files without rebuilding the whole cache.
+APPENDABLE_FILES = ['precipitaciones', 'precio_leche']
+CACHE_DIR = './cache'
+CACHE_FORMAT = 1
+# Size of the blocks used to hash the datasets
+HASH_BLOCK_SIZE = 1024 * 1024
 
-def logger(original_func):
-    '''This function sets up the logger actions. It should be used as a decorator.'''
-    def wrapper(*args, **kwargs):
-        log.info('{} function executed with args: {}, and kwargs: {}'.format(original_func.__name__, args, kwargs))
-        return original_func(*args, **kwargs)
-    return wrapper
+# Path of the serialized pipeline. Trained models are also published to the model store (see model_store.py)
+MODEL_PATH = model_store.MODEL_PATH
 
 
 @logger
@@ -47,125 +65,13 @@ def load_data():
         used to train the model
     '''
 
-    precipitaciones = pd.read_csv('./data/precipitaciones.csv')
-    banco_central = pd.read_csv('./data/banco_central.csv')
-    precio_leche = pd.read_csv('./data/precio_leche.csv')
+    precipitaciones = pd.read_csv(DATA_FILES['precipitaciones'])
+    banco_central = pd.read_csv(DATA_FILES['banco_central'])
+    precio_leche = pd.read_csv(DATA_FILES['precio_leche'])
 
     return precipitaciones, banco_central, precio_leche
 
 
-@logger
-def to_100(x):
-    '''This function takes in a string of a number and returns
-    a float with 2-3 digits
-    
-    Parameters:
-        x (str): A string containing a number separated by periods 
-    
-    Returns:
-        float: A float of the number rounded to 3 digits (in the hundreds),
-        with 3 decimal points'''
-
-    x = x.split('.')
-    if x[0].startswith('1'): #es 100+
-        if len(x[0]) >2:
-            return float(x[0] + '.' + x[1])
-        x = x[0]+x[1]
-        return float(x[:3] + '.' + x[3:])
-    else:
-        if len(x[0])>2:
-            return float(x[0][:2] + '.' + x[0][-1])
-        x = x[0] + x[1]
-        return float(x[:2] + '.' + x[2:])
-
-
-@logger
-def convert_int(x):
-    '''This function transforms a string into an int with any '.' removed.
-    
-    Parameters:
-        x (str): A string of a number
-        
-    Returns:
-        int: An int of the input with any '.' removed'''
-
-    return int(x.replace('.', ''))
-    
-
-@logger
-def prep_precipitaciones(precipitaciones):
-    '''This function prepares the precipitaciones data to train the model and
-    it can also be used to prepare data for predictions
-    
-    Parameters:
-        precipitaciones: Pandas DataFrame of the raw precipitaciones dataset
-        
-    Returns:
-        precipitaciones: Pandas DataFrame of the precipitaciones dataset
-        after variable processing'''
-
-    precipitaciones['date'] = pd.to_datetime(precipitaciones['date'], format='%Y-%m-%d')
-    precipitaciones = precipitaciones.sort_values(by='date', ascending=True).reset_index(drop=True)
-    precipitaciones.dropna(how='any', axis=0)
-    precipitaciones.drop_duplicates(subset='date')
-
-    return precipitaciones
-
-
-@logger
-def prep_banco_central(banco_central):
-    '''This function prepares the banco_central data to train the model, and
-    it can also be used to prepare data for predictions
-    
-    Parameters:
-        banco_central: Pandas DataFrame of the raw banco_central dataset
-        
-    Returns:
-        banco_central: Pandas DataFrame of the banco_central dataset
-        after variable processing and feature engineering'''
-
-    banco_central['Periodo'] = banco_central['Periodo'].apply(lambda x: x[:10])
-    banco_central['Periodo'] = pd.to_datetime(banco_central['Periodo'], format='%Y-%m-%d', errors='coerce')
-    banco_central.drop_duplicates(subset='Periodo', inplace=True)
-    banco_central = banco_central[~banco_central.Periodo.isna()]
-    
-    # Preprocessing PIB columns: 
-    # 1. create dataframe slice
-    cols_pib = [x for x in list(banco_central.columns) if 'PIB' in x]
-    cols_pib.extend(['Periodo'])
-    banco_central_pib = banco_central[cols_pib]
-    banco_central_pib = banco_central_pib.dropna(how = 'any', axis = 0)
-  
-    # 2. convert to int
-    for col in cols_pib:
-        if col != 'Periodo':
-            banco_central_pib[col] = banco_central_pib[col].apply(lambda x: convert_int(x))
-
-    # Preprocessing Imacec columns: 
-    # 1. create dataframe slice
-    cols_imacec = [x for x in list(banco_central.columns) if 'Imacec' in x]
-    cols_imacec.extend(['Periodo'])
-    banco_central_imacec = banco_central[cols_imacec]
-    banco_central_imacec = banco_central_imacec.dropna(how = 'any', axis = 0)
-    # 2. remove periods and transform to float
-    for col in cols_imacec:
-        if col != 'Periodo': 
-            banco_central_imacec[col] = banco_central_imacec[col].apply(lambda x: to_100(x))
-
-    # Preprocessing IVCM columns: 
-    # 1. create slice; 2. drop NaNs; 3. create new feature 'num'
-    banco_central_iv = banco_central[['Indice_de_ventas_comercio_real_no_durables_IVCM', 'Periodo']]
-    banco_central_iv = banco_central_iv.dropna() # -unidades? #parte 
-    banco_central_iv.sort_values(by = 'Periodo', ascending=True)
-    banco_central_iv['num'] = banco_central_iv['Indice_de_ventas_comercio_real_no_durables_IVCM'].apply(lambda x: to_100(x))
-
-    # Merge slices together, then return final dataframe
-    banco_central_num = pd.merge(banco_central_pib, banco_central_imacec, on = 'Periodo', how = 'inner')
-    banco_central_num = pd.merge(banco_central_num, banco_central_iv, on = 'Periodo', how = 'inner')
-
-    return banco_central_num
-
-
 @logger
 def prep_leche(precio_leche):
     '''This function prepares the precio_leche data to train the model.
@@ -179,9 +85,7 @@ def prep_leche(precio_leche):
         after variable processing'''
 
     precio_leche.rename(columns = {'Anio': 'ano', 'Mes': 'mes_pal'}, inplace = True) # precio = nominal, sin iva en clp/litro
-    precio_leche['mes'] = pd.to_datetime(precio_leche['mes_pal'], format = '%b')
-    precio_leche['mes'] = precio_leche['mes'].apply(lambda x: x.month)
-    precio_leche['mes-ano'] = precio_leche.apply(lambda x: f'{x.mes}-{x.ano}', axis = 1)
+    precio_leche['mes'] = pd.to_datetime(precio_leche['mes_pal'], format = '%b').dt.month.astype(np.int64)
 
     return precio_leche
 
@@ -203,16 +107,15 @@ def merge_data(precipitaciones, banco_central, precio_leche):
         the data that will be used to train the model
         '''
 
-    precipitaciones['mes'] = precipitaciones.date.apply(lambda x: x.month)
-    precipitaciones['ano'] = precipitaciones.date.apply(lambda x: x.year)
-
-    precio_leche_pp = pd.merge(precio_leche, precipitaciones, on = ['mes', 'ano'], how = 'inner')
-    precio_leche_pp.drop('date', axis = 1, inplace = True)
+    periodo_leche = precio_leche['ano'].to_numpy(dtype=np.int64) * 12 + precio_leche['mes'].to_numpy(dtype=np.int64)
+    precio_leche_pp = join_on_period(precio_leche, periodo_leche,
+                                     precipitaciones.drop('date', axis = 1), period_key(precipitaciones['date']))
 
-    banco_central['mes'] = banco_central['Periodo'].apply(lambda x: x.month)
-    banco_central['ano'] = banco_central['Periodo'].apply(lambda x: x.year)
-    precio_leche_pp_pib = pd.merge(precio_leche_pp, banco_central, on = ['mes', 'ano'], how = 'inner')
-    precio_leche_pp_pib.drop(['Periodo', 'Indice_de_ventas_comercio_real_no_durables_IVCM', 'mes-ano', 'mes_pal'], axis =1, inplace = True)
+    periodo_leche = precio_leche_pp['ano'].to_numpy(dtype=np.int64) * 12 + precio_leche_pp['mes'].to_numpy(dtype=np.int64)
+    precio_leche_pp_pib = join_on_period(precio_leche_pp, periodo_leche,
+                                         banco_central.drop(['Periodo', 'Indice_de_ventas_comercio_real_no_durables_IVCM'], axis = 1),
+                                         period_key(banco_central['Periodo']))
+    precio_leche_pp_pib.drop('mes_pal', axis = 1, inplace = True)
 
     return precio_leche_pp_pib
 
@@ -238,47 +141,557 @@ def preprocess(precipitaciones, banco_central, precio_leche):
                       prep_leche(precio_leche))
 
 
+
+def preprocessing_version():
+    '''This function hashes the source code of every function used to preprocess the
+    training data, so that the cache is rebuilt whenever any of them changes.
+
+    Returns:
+        str: a hex digest identifying the current preprocessing code'''
+
+    digest = hashlib.sha256(str(CACHE_FORMAT).encode())
+    for func in [to_100_column, convert_int_column, prep_precipitaciones, prep_banco_central, banco_central_columns,
+                 load_banco_central, prep_leche, period_key, join_on_period, merge_data]:
+        digest.update(inspect.getsource(func).encode())
+
+    return digest.hexdigest()
+
+
+def _save_frame(data, path):
+    '''Saves a DataFrame column by column in a numpy .npz file. The file is written
+    under a temporary name first, so a crash never leaves a half-written cache.'''
+
+    arrays = {str(i): data[col].values for i, col in enumerate(data.columns)}
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, __columns__=np.array(data.columns, dtype=object), **arrays)
+    os.replace(path + '.tmp', path)
+
+
+def _load_frame(path):
+    '''Loads a DataFrame saved with _save_frame.'''
+
+    with np.load(path, allow_pickle=True) as arrays:
+        columns = list(arrays['__columns__'])
+        return pd.DataFrame({col: arrays[str(i)] for i, col in enumerate(columns)}, columns=columns)
+
+
+def _hash_file(path, size=None):
+    '''Returns the sha256 hex digest of the first size bytes of a file (the whole file by
+    default), reading it in blocks so it is never held in memory.'''
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        remaining = os.path.getsize(path) if size is None else size
+        while remaining > 0:
+            block = f.read(min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            digest.update(block)
+            remaining -= len(block)
+
+    return digest.hexdigest()
+
+
+def _appended_rows(manifest, version, files):
+    '''Finds the rows appended to the precipitaciones and precio_leche files since the
+    cache was written. Returns None when anything else changed, in which case the
+    cache has to be rebuilt from scratch.'''
+
+    if manifest is None or manifest['version'] != version:
+        return None
+
+    appended = {}
+    for name, info in files.items():
+        old = manifest['files'][name]
+        if info['sha256'] == old['sha256']:
+            continue
+
+        if name not in APPENDABLE_FILES or info['size'] < old['size'] or _hash_file(DATA_FILES[name], old['size']) != old['sha256']:
+            return None
+        with open(DATA_FILES[name], 'rb') as f:
+            header = f.readline().rstrip(b'\r\n')
+            f.seek(max(old['size'] - 1, 0))
+            last = f.read(1) if old['size'] else b''
+            tail = f.read()
+        # the last line of the old file must not have been extended
+        if not (last == b'\n' or tail.startswith((b'\r\n', b'\n'))):
+            return None
+
+        appended[name] = pd.read_csv(io.BytesIO(header + b'\n' + tail))
+
+    return appended
+
+
+@logger
+def load_preprocessed(cache_dir=CACHE_DIR):
+    '''This function returns the same DataFrame as running load_data and preprocess, but
+    reuses the cached result of a previous run when possible. The cache is keyed by
+    a hash of the training datasets and of the preprocessing code. If rows were only
+    appended to the precipitaciones or precio_leche files, only the new rows are
+    processed.
+
+    Parameters:
+        cache_dir (str): directory where the preprocessed data is stored
+
+    Returns:
+        DataFrame: a DataFrame of the merged data, ready to train the model'''
+
+    version = preprocessing_version()
+    files = {name: {'size': os.path.getsize(path), 'sha256': _hash_file(path)} for name, path in DATA_FILES.items()}
+    key = hashlib.sha256(json.dumps([version, files], sort_keys=True).encode()).hexdigest()
+
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    manifest = None
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    if manifest is not None and manifest['key'] == key:
+        log.info('Preprocessed data loaded from cache %s', key)
+        return _load_frame(os.path.join(cache_dir, 'merged.npz'))
+
+    appended = _appended_rows(manifest, version, files)
+    if appended is not None:
+        log.info('Updating preprocessed data cache with appended rows: %s', {name: len(rows) for name, rows in appended.items()})
+        sources = {name: _load_frame(os.path.join(cache_dir, f'{name}.npz')) for name in DATA_FILES}
+        if 'precipitaciones' in appended:
+            sources['precipitaciones'] = prep_precipitaciones(pd.concat([sources['precipitaciones'],
+                                                                         prep_precipitaciones(appended['precipitaciones'])],
+                                                                        ignore_index=True))
+        if 'precio_leche' in appended:
+            sources['precio_leche'] = pd.concat([sources['precio_leche'], prep_leche(appended['precio_leche'])], ignore_index=True)
+    else:
+        log.info('Rebuilding preprocessed data cache %s', key)
+        sources = {'precipitaciones': prep_precipitaciones(pd.read_csv(DATA_FILES['precipitaciones'])),
+                   'banco_central': load_banco_central(DATA_FILES['banco_central']),
+                   'precio_leche': prep_leche(pd.read_csv(DATA_FILES['precio_leche']))}
+
+    data = merge_data(sources['precipitaciones'], sources['banco_central'], sources['precio_leche'])
+
+    # The manifest is written last, so the cache is only used once every file is in place
+    os.makedirs(cache_dir, exist_ok=True)
+    for name, source in sources.items():
+        _save_frame(source.reset_index(drop=True), os.path.join(cache_dir, f'{name}.npz'))
+    _save_frame(data, os.path.join(cache_dir, 'merged.npz'))
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'key': key, 'version': version, 'files': files}, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return data
+
+# Hyperparameters searched when training the model
+PARAM_GRID = {'selector__k': [3, 4, 5, 6, 7, 10],
+              'poly__degree': [1, 2, 3, 5, 7],
+              'model__alpha': [1, 0.5, 0.2, 0.1, 0.05, 0.02, 0.01]}
+CV_FOLDS = 3
+# Seed of the random noise mutual_info_regression adds to the data, so the selected variables do not depend on
+# numpy's global random state (or on the order the candidates are fitted in)
+MI_RANDOM_STATE = 0
+
+# Incremental training (python -m train --incremental): the hyperparameters are searched again after FULL_SEARCH_EVERY
+# incremental updates, or when the error of the model on the new rows grows above DRIFT_TOLERANCE times its
+# leave-one-out error on the training data. The Ridge sufficient statistics are only kept for models with up to MAX_STATE_TERMS polynomial
+# terms (their size grows with the square of the number of terms), larger models are refit with the same hyperparameters.
+FULL_SEARCH_EVERY = int(os.environ.get('FULL_SEARCH_EVERY', 12))
+DRIFT_TOLERANCE = float(os.environ.get('DRIFT_TOLERANCE', 2.0))
+MAX_STATE_TERMS = 2000
+
+
+def build_pipeline():
+    '''This function creates the (unfitted) sklearn pipeline used by the model.'''
+
+    return Pipeline([('scale', StandardScaler()),
+                     ('selector', SelectKBest(functools.partial(mutual_info_regression, random_state=MI_RANDOM_STATE))),
+                     ('poly', PolynomialFeatures()),
+                     ('model', Ridge())])
+
+
+def _ridge_path_predictions(X_train, y_train, X_test, alphas):
+    '''Fits Ridge (with intercept) for every alpha and returns the predictions of each alpha on the
+    test data (one column per alpha). Like Ridge's cholesky solver, it solves (X.T @ X + alpha) w = X.T @ y,
+    or (X @ X.T + alpha) c = y when there are more polynomial terms than training rows, so the results
+    match Ridge up to rounding; the Gram matrix, which costs the most, is computed once for all alphas.'''
+
+    X_offset, y_offset = X_train.mean(axis=0), y_train.mean()
+    X_train, y_train, X_test = X_train - X_offset, y_train - y_offset, X_test - X_offset
+    dual = X_train.shape[1] > X_train.shape[0]
+    gram = X_train @ X_train.T if dual else X_train.T @ X_train
+    target = y_train if dual else X_train.T @ y_train
+
+    predictions = np.empty((len(X_test), len(alphas)))
+    for i, alpha in enumerate(alphas):
+        A = gram.copy()
+        A.flat[::len(A) + 1] += alpha
+        try:
+            coef = linalg.solve(A, target, assume_a='pos', overwrite_a=True)
+        except linalg.LinAlgError:
+            # singular matrix, Ridge falls back to a least squares solution too
+            coef = linalg.lstsq(A, target)[0]
+        predictions[:, i] = X_test @ (X_train.T @ coef if dual else coef)
+    return predictions + y_offset
+
+
+def candidate_predictions(X_train, y_train, X_test, random_state, param_grid=PARAM_GRID):
+    '''This function fits every candidate of param_grid on the training data and predicts the test
+    data. The scaler and the mutual information scores are computed once, each polynomial expansion
+    once per (k, degree), and all alphas are solved together.
+
+    Parameters:
+        X_train, y_train, X_test: numpy arrays of the training data, its target and the test data
+        random_state: the random state of mutual_info_regression
+        param_grid (dict): the values of selector__k, poly__degree and model__alpha to try
+
+    Yields:
+        (k, degree, predictions): the predictions of each (k, degree), with one column per alpha'''
+
+    scaler = StandardScaler().fit(X_train)
+    X_train, X_test = scaler.transform(X_train), scaler.transform(X_test)
+    mi_scores = mutual_info_regression(X_train, y_train, random_state=random_state)
+
+    for k in param_grid['selector__k']:
+        selector = SelectKBest(lambda X, y: mi_scores, k=k).fit(X_train, y_train)
+        X_train_k, X_test_k = selector.transform(X_train), selector.transform(X_test)
+
+        for degree in param_grid['poly__degree']:
+            poly = PolynomialFeatures(degree).fit(X_train_k)
+            yield k, degree, _ridge_path_predictions(poly.transform(X_train_k), y_train, poly.transform(X_test_k),
+                                                     param_grid['model__alpha'])
+
+
+def _score_fold(X_train, y_train, X_test, y_test, param_grid=PARAM_GRID):
+    '''Scores every candidate of param_grid on one cross-validation fold, from the predictions of
+    candidate_predictions (the mutual information scores are computed once for the fold).
+
+    Returns:
+        dict: r-squared score on the test data of each (k, degree, alpha)'''
+
+    total = ((y_test - y_test.mean()) ** 2).sum()
+    scores = {}
+    for k, degree, predictions in candidate_predictions(X_train, y_train, X_test, MI_RANDOM_STATE, param_grid):
+        residuals = ((y_test[:, None] - predictions) ** 2).sum(axis=0)
+        scores.update({(k, degree, alpha): score for alpha, score in zip(param_grid['model__alpha'], 1 - residuals / total)})
+
+    return scores
+
+
+def fast_grid_search(X, y, n_jobs=-1, param_grid=PARAM_GRID):
+    '''This function finds the best parameters in param_grid like GridSearchCV(cv=CV_FOLDS,
+    scoring='r2') does with build_pipeline(), but computes the scaler and the mutual information
+    scores once per fold, each polynomial expansion once per (fold, k, degree), solves all alphas
+    together and runs the folds in parallel. The mutual information scores use MI_RANDOM_STATE, like
+    the selector of build_pipeline, so the scores are GridSearchCV's (up to rounding of the ridge solver).
+
+    Parameters:
+        X: Pandas DataFrame of the features
+        y: Pandas Series of the target
+        n_jobs (int): number of processes used to score the folds, -1 uses all cores
+        param_grid (dict): the values of selector__k, poly__degree and model__alpha to try
+
+    Returns:
+        dict: the best parameters, in the format of GridSearchCV.best_params_
+        list: the mean cross-validation score of each candidate, in ParameterGrid order'''
+
+    X, y = X.to_numpy(dtype=np.float64), y.to_numpy(dtype=np.float64)
+    candidates = list(ParameterGrid(param_grid))
+    splits = check_cv(CV_FOLDS, y, classifier=False).split(X, y)
+
+    fold_scores = Parallel(n_jobs=n_jobs)(delayed(_score_fold)(X[train_idx], y[train_idx], X[test_idx], y[test_idx], param_grid)
+                                          for train_idx, test_idx in splits)
+    mean_scores = [float(np.mean([scores[params['selector__k'], params['poly__degree'], params['model__alpha']]
+                                  for scores in fold_scores]))
+                   for params in candidates]
+
+    return candidates[int(np.argmax(mean_scores))], mean_scores
+
+
 @logger
-def train_model(data):
+def train_model(data, search='fast', n_jobs=-1):
     '''This function uses the training data (after processing) to train and
     optimize the model. Then, returns the best performing pipeline (based on
     r-squared score).
     
     Parameters:
         data: Pandas DataFrame of the merged datasets (ready for the model)
+        search (str): 'fast' to search the parameters with fast_grid_search,
+        or 'grid' to use sklearn's GridSearchCV. Both find the same parameters
+        n_jobs (int): number of processes used by the fast search, -1 uses all cores
     
     Returns:
         pipeline (sklearn): an optimized pipeline that will be used to
         predict data
         '''
 
-    np.random.seed(0)
     X = data.drop(['Precio_leche'], axis = 1)
     y = data['Precio_leche']
 
-    pipe = Pipeline([('scale', StandardScaler()),
-                    ('selector', SelectKBest(mutual_info_regression)),
-                    ('poly', PolynomialFeatures()),
-                    ('model', Ridge())])
+    if search == 'grid':
+        grid = GridSearchCV(estimator = build_pipeline(), param_grid = PARAM_GRID, cv = CV_FOLDS, scoring = 'r2')
+        grid.fit(X, y)
+        model = grid.best_estimator_
+    else:
+        best_params, _ = fast_grid_search(X, y, n_jobs=n_jobs)
+        model = build_pipeline().set_params(**best_params).fit(X, y)
+
+    log.info('Successfully created model.')
 
-    params = {'selector__k': [3, 4, 5, 6, 7, 10],
-              'poly__degree': [1, 2, 3, 5, 7],
-              'model__alpha': [1, 0.5, 0.2, 0.1, 0.05, 0.02, 0.01]}
+    return model
+
+
+def _training_periods(data):
+    '''Returns the period (year * 12 + month) of each row of the training data.'''
+
+    return data['ano'].to_numpy(dtype=np.int64) * 12 + data['mes'].to_numpy(dtype=np.int64)
+
+
+def _reference_terms(model, state, X):
+    '''Returns the polynomial terms of the selected variables of X, scaled with the reference means
+    and scales of state instead of the current scaler of the model.'''
+
+    features = model.named_steps['selector'].get_support(indices=True)
+    U = (np.asarray(X, dtype=np.float64)[:, features] - state['ref_means']) / state['ref_scales']
+    return model.named_steps['poly'].transform(U)
+
+
+def _rescale_terms(powers, a, b):
+    '''Returns the matrix T that turns polynomial terms of variables u into the same terms of
+    a * u + b: each term (a * u + b) ** e is expanded with the binomial theorem into terms u ** f,
+    with f <= e, which are also in powers since PolynomialFeatures keeps every term up to its degree.'''
+
+    index = {tuple(p): i for i, p in enumerate(powers.tolist())}
+    T = np.zeros((len(powers), len(powers)))
+    for j, e in enumerate(powers.tolist()):
+        for f in itertools.product(*(range(ei + 1) for ei in e)):
+            T[index[f], j] = np.prod([math.comb(ei, fi) * a[i] ** fi * b[i] ** (ei - fi) for i, (ei, fi) in enumerate(zip(e, f))])
+
+    return T
+
+
+def _loo_rmse(model, X, y):
+    '''Returns the leave-one-out error (root mean squared) of the Ridge of a pipeline, with its scaler,
+    selected variables and hyperparameters fixed. It is computed in closed form from the diagonal
+    of the hat matrix, in the space of the terms or of the rows, whichever is smaller.'''
+
+    steps = model.named_steps
+    Z = steps['poly'].transform(steps['selector'].transform(steps['scale'].transform(X)))
+    Z = Z - Z.mean(axis=0)
+    if Z.shape[1] <= len(Z):
+        hat = np.einsum('ij,ji->i', Z, np.linalg.solve(Z.T @ Z + steps['model'].alpha * np.eye(Z.shape[1]), Z.T))
+    else:
+        K = Z @ Z.T
+        hat = np.diag(np.linalg.solve(K + steps['model'].alpha * np.eye(len(K)), K))
+    residuals = (np.asarray(y, dtype=np.float64) - model.predict(X)) / (1 - hat - 1 / len(Z))
+
+    return float(np.sqrt(np.mean(residuals ** 2)))
+
+
+@logger
+def training_state(model, X, y, periods):
+    '''This function computes the state used to update a model with new rows without searching
+    the hyperparameters again (see update_model): the periods trained on, the scaler of the
+    selected variables when the state was created (the reference scaler), the Ridge sufficient
+    statistics (M'M and M'y, where M are the polynomial terms of the variables scaled with the
+    reference scaler) and the leave-one-out error of the model, which the error on new rows is
+    compared to in order to detect drift.
+
+    Parameters:
+        model: the trained sklearn pipeline
+        X: Pandas DataFrame of the training data, without the target
+        y: Pandas Series of the target
+        periods: numpy array with the period of each row
+
+    Returns:
+        state: a dict of numpy arrays and numbers'''
 
-    grid = GridSearchCV(estimator = pipe, param_grid = params, cv = 3, scoring = 'r2')
-    grid.fit(X, y)
+    scaler = model.named_steps['scale']
+    features = model.named_steps['selector'].get_support(indices=True)
+    y = np.asarray(y, dtype=np.float64)
 
-    logging.info('Successfully created model.')
+    state = {'periods': np.asarray(periods, dtype=np.int64),
+             'ref_means': scaler.mean_[features].copy(), 'ref_scales': scaler.scale_[features].copy(),
+             'reference_rmse': _loo_rmse(model, X, y),
+             'drift_sse': 0.0, 'drift_rows': 0, 'updates': 0}
 
-    return grid.best_estimator_
+    if len(model.named_steps['poly'].powers_) <= MAX_STATE_TERMS:
+        M = _reference_terms(model, state, X)
+        state['gram'], state['moment'] = M.T @ M, M.T @ y
+
+    return state
+
+
+@logger
+def update_model(model, state, X_new, y_new, periods_new, X, y):
+    '''This function updates a trained pipeline with new rows, keeping its hyperparameters and
+    selected variables. The scaler statistics are updated with the new rows (partial_fit), the
+    terms of the new rows are added to the Ridge sufficient statistics of state, and the Ridge is
+    solved again from the statistics, transformed to the updated scaler with _rescale_terms. This
+    gives the same model as fitting the scaler and the Ridge on all rows, in time that does not
+    depend on the number of rows already trained on.
+
+    Parameters:
+        model: the trained sklearn pipeline, it is not modified
+        state: the training state of the model (see training_state)
+        X_new, y_new, periods_new: the new rows, their target and their periods
+        X, y: all the training rows, only used when state has no sufficient statistics
+
+    Returns:
+        model: the updated pipeline
+        state: the updated training state'''
+
+    model, state = copy.deepcopy(model), dict(state)
+    scaler, selector = model.named_steps['scale'], model.named_steps['selector']
+    poly, ridge = model.named_steps['poly'], model.named_steps['model']
+    features = selector.get_support(indices=True)
+    y_new = np.asarray(y_new, dtype=np.float64)
+    bias = np.flatnonzero(poly.powers_.sum(axis=1) == 0)
+
+    if 'gram' in state and len(bias):
+        M = _reference_terms(model, state, X_new)
+        state['gram'] = state['gram'] + M.T @ M
+        state['moment'] = state['moment'] + M.T @ y_new
+
+        scaler.partial_fit(X_new)
+        # the variables scaled with the new scaler are a * u + b, where u are the variables scaled with the reference scaler
+        a = state['ref_scales'] / scaler.scale_[features]
+        b = (state['ref_means'] - scaler.mean_[features]) / scaler.scale_[features]
+        T = _rescale_terms(poly.powers_, a, b)
+
+        # Ridge with intercept on the terms Z = M @ T: the terms and the target are centered before solving
+        gram, moment = T.T @ state['gram'] @ T, T.T @ state['moment']
+        n = state['gram'][bias[0], bias[0]]
+        z_mean, y_mean = T.T @ state['gram'][:, bias[0]] / n, state['moment'][bias[0]] / n
+        A = gram - n * np.outer(z_mean, z_mean) + ridge.alpha * np.eye(len(gram))
+        ridge.coef_ = np.linalg.solve(A, moment - n * z_mean * y_mean)
+        ridge.intercept_ = y_mean - z_mean @ ridge.coef_
+    else:
+        scaler.fit(X)
+        ridge.fit(poly.transform(selector.transform(scaler.transform(X))), y)
+
+    state['periods'] = np.concatenate([state['periods'], np.asarray(periods_new, dtype=np.int64)])
+    state['updates'] += 1
+
+    return model, state
+
+
+@logger
+def train_incremental(data, search='fast', n_jobs=-1, full_every=FULL_SEARCH_EVERY, drift_tolerance=DRIFT_TOLERANCE):
+    '''This function updates the current model of the model store with the rows of the training data
+    it was not trained on (see update_model). The hyperparameters are searched again with train_model
+    instead when the current model has no training state, when rows it was trained on are no longer
+    in the data, after full_every incremental updates, or when the error of the model on the new
+    rows (before updating it, accumulated since the last search) is more than drift_tolerance times
+    its leave-one-out error on the training data.
+
+    Parameters:
+        data: Pandas DataFrame of the merged datasets (ready for the model)
+        search (str), n_jobs (int): passed to train_model when the hyperparameters are searched
+        full_every (int): number of incremental updates between two searches
+        drift_tolerance (float): largest ratio between the error on new rows and the leave-one-out error
+
+    Returns:
+        model: the updated pipeline, or None if there are no new rows
+        state: the training state of the model'''
+
+    X = data.drop(['Precio_leche'], axis = 1)
+    y = data['Precio_leche']
+    periods = _training_periods(data)
+
+    version = model_store.current_version()
+    state = model_store.load_state(version) if version is not None else None
+    reason = None
+
+    if state is None:
+        reason = 'the current model has no training state'
+    elif not np.isin(state['periods'], periods).all():
+        reason = 'rows the model was trained on are not in the data anymore'
+    else:
+        new = ~np.isin(periods, state['periods'])
+        if not new.any():
+            log.info('Model version %s is up to date, there are no new rows', version)
+            return None, state
+
+        model = model_store.load_pipeline(version)
+        errors = model.predict(X[new]) - y[new].to_numpy(dtype=np.float64)
+        state = dict(state, drift_sse=state['drift_sse'] + float(np.sum(errors ** 2)),
+                     drift_rows=state['drift_rows'] + int(new.sum()))
+        drift = np.sqrt(state['drift_sse'] / state['drift_rows']) / max(state['reference_rmse'], np.finfo(float).tiny)
+
+        if state['updates'] >= full_every:
+            reason = f'{full_every} incremental updates since the last search'
+        elif drift > drift_tolerance:
+            reason = f'the error on the new rows is {drift:.2f} times the leave-one-out error'
+
+    if reason is not None:
+        log.info('Searching the hyperparameters again: %s', reason)
+        model = train_model(data, search=search, n_jobs=n_jobs)
+        return model, training_state(model, X, y, periods)
+
+    log.info('Updating model version %s with %d new rows', version, new.sum())
+    return update_model(model, state, X[new], y[new], periods[new], X, y)
+
+
+@logger
+def export_model(model, X, pipeline_bytes, tolerance, state=None):
+    '''This function compiles the trained pipeline into a term table (see term_table.py) with
+    negligible polynomial terms pruned, publishes it as a new version of the model store and
+    logs how many terms were kept and the resulting error bound.
+
+    Parameters:
+        model: the trained sklearn pipeline
+        X: Pandas DataFrame of the training data, without the target
+        pipeline_bytes (bytes): the pickled pipeline
+        tolerance (float): maximum change of the predictions on X allowed by pruning
+        state (dict): the training state of the model (see training_state), saved with the version
+
+    Returns:
+        version (str): the model store version that was published'''
+
+    table = term_table.compile_pipeline(model, X, tolerance=tolerance,
+                                        model_sha256=hashlib.sha256(pipeline_bytes).hexdigest())
+    max_error = np.abs(term_table.evaluate(table, X) - model.predict(X)).max()
+    version = model_store.publish(table, pipeline_bytes, metadata={'params': {key: value for key, value in model.get_params().items()
+                                                                               if key in PARAM_GRID},
+                                                                    'max_train_error': float(max_error),
+                                                                    'rows': len(X),
+                                                                    'incremental_updates': state['updates'] if state else None},
+                                state=state)
+
+    log.info('Published model version %s: term table with %d of %d terms, error bound %.3g (max error on training data %.3g)',
+             version, len(table['coef']), table['n_terms_total'], table['error_bound'], max_error)
+
+    return version
 
 
 if __name__ == '__main__':
-    # 1. Load data
-    precipitaciones, banco_central, precio_leche = load_data()
-    # 2. Process and merge data
-    data = preprocess(precipitaciones, banco_central, precio_leche)
-    # 3. Train the model pipeline
-    model = train_model(data)
-    # 4. Serialize the pipeline as a pickle file
-    pickle.dump(model, open('model/leche_predictor.pkl', 'wb'))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Train the milk price model and save it in model/leche_predictor.pkl')
+    parser.add_argument('--search', choices=['fast', 'grid'], default='fast',
+                        help='search the hyperparameters with fast_grid_search (default) or with GridSearchCV')
+    parser.add_argument('--n-jobs', type=int, default=-1, help='number of processes used by the fast search')
+    parser.add_argument('--prune-tolerance', type=float, default=0.01,
+                        help='maximum change of the predictions on the training data allowed when pruning the polynomial terms '
+                             'of the exported term table (the prices have 2 decimals)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='update the current model with the new rows, keeping its hyperparameters (see train_incremental)')
+    parser.add_argument('--full-every', type=int, default=FULL_SEARCH_EVERY,
+                        help='with --incremental, number of incremental updates after which the hyperparameters are searched again')
+    parser.add_argument('--drift-tolerance', type=float, default=DRIFT_TOLERANCE,
+                        help='with --incremental, search the hyperparameters again when the error on the new rows is larger than '
+                             'this many times the leave-one-out error of the model')
+    args = parser.parse_args()
+
+    # 1. Load, process and merge data (reusing the cached result when the data has not changed)
+    data = load_preprocessed()
+    # 2. Train the model pipeline, or update the current one with the new rows
+    if args.incremental:
+        model, state = train_incremental(data, search=args.search, n_jobs=args.n_jobs,
+                                         full_every=args.full_every, drift_tolerance=args.drift_tolerance)
+        if model is None:
+            raise SystemExit(0)
+    else:
+        model = train_model(data, search=args.search, n_jobs=args.n_jobs)
+        state = training_state(model, data.drop(['Precio_leche'], axis = 1), data['Precio_leche'], _training_periods(data))
+    # 3. Serialize the pipeline as a pickle file
+    content = pickle.dumps(model)
+    with open(MODEL_PATH, 'wb') as f:
+        f.write(content)
+    # 4. Publish the pruned term table used for predictions as a new model version
+    export_model(model, data.drop(['Precio_leche'], axis = 1), content, args.prune_tolerance, state)
\ No newline at end of file